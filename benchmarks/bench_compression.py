@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""
+bench_compression.py
+====================
+
+Sweep HDF5 compression settings across representative synthetic data, and
+compare with astropy's FITS tile compression (CompImageHDU).
+
+Data sets are images, and numeric, string (fixed-width bytes and unicode)
+and bool table columns. For each data set and combination of filter, level,
+shuffle, scaleoffset and chunk shape, this measures the compression ratio
+and the compress (write) and decompress (read) throughput in MB/s. Files
+are held in memory (HDF5 core driver, in-memory FITS), so disk speed
+doesn't affect the results.
+
+Thresholds for ratio and throughput are read from a JSON file (default
+compression_thresholds.json, next to this script), and the script exits
+with an error if the file can't be read, or if any result falls below its
+threshold. Results can also be checked against a
+previous run with --baseline.
+
+Usage:
+
+    python bench_compression.py [--scale small] [--thresholds FILE] [--baseline old.json]
+"""
+
+import io
+import os
+import sys
+import json
+import argparse
+import itertools
+
+import numpy as np
+import h5py
+from astropy.io import fits as pf
+
+from fits2hdf.io import hdfcompress as bs
+
+import synthetic
+from common import measure, Results, load_results
+
+
+def synthetic_data(scale='small'):
+    """ Representative data sets: name, array """
+    n = synthetic.SCALES[scale]
+    side = int(512 * np.sqrt(n))
+    cols = synthetic.make_table_columns(100000 * n, n_numeric=5)
+    names = np.asarray(cols[5].array)
+    return [
+        ('image_int16', synthetic.make_image((side, side), 'int16')),
+        ('image_int32_smooth', synthetic.make_image((side, side), 'int32', noise=False)),
+        ('image_float32', synthetic.make_image((side, side), 'float32')),
+        ('column_int64', cols[2].array),
+        ('column_float64', cols[4].array),
+        ('column_string', names.astype('S16')),
+        ('column_unicode', names.astype('U16')),
+        ('column_bool', np.asarray(cols[6].array) == ord('T')),
+    ]
+
+
+def hdf5_configs(data, workers=1):
+    """ Yield (settings, dataset kwargs) for each combination to test on data """
+    filters = [('none', [None], [False])]
+    filters.append(('gzip', [1, 4, 9], [False, True]))
+    filters.append(('lzf', [None], [False, True]))
+    if bs.USE_BITSHUFFLE:
+        filters.append(('bitshuffle', [None], [False]))
+
+    scaleoffsets = [None]
+    if data.dtype.kind in 'iu':
+        # Lossless for integers
+        scaleoffsets.append(0)
+
+    if data.ndim == 1:
+        # contiguous is how string and bool columns were written before
+        # create_dataset compressed them
+        chunk_shapes = [('contiguous', None), ('auto', True), ('guess', bs.guess_chunk(data.shape)),
+                        ('65536', (min(65536, data.shape[0]), ))]
+    else:
+        chunk_shapes = [('auto', True), ('guess', bs.guess_chunk(data.shape)),
+                        ('rows', (min(64, data.shape[0]), ) + data.shape[1:]),
+                        ('tiles_128', tuple(min(128, n) for n in data.shape))]
+
+    for (filt, levels, shuffles), scaleoffset, (chunk_name, chunks) in \
+            itertools.product(filters, scaleoffsets, chunk_shapes):
+        for level, shuffle in itertools.product(levels, shuffles):
+            if filt == 'none' and scaleoffset is None and chunk_name not in ('auto', 'contiguous'):
+                continue
+            if chunk_name == 'contiguous' and (filt != 'none' or scaleoffset is not None):
+                continue
+            kwargs = {'chunks': chunks}
+            if filt != 'none':
+                kwargs['compression'] = filt
+            if level is not None:
+                kwargs['compression_opts'] = level
+            if shuffle:
+                kwargs['shuffle'] = True
+            if scaleoffset is not None:
+                kwargs['scaleoffset'] = scaleoffset
+            if workers > 1:
+                kwargs['workers'] = workers
+            settings = {'filter': filt, 'level': level, 'shuffle': shuffle,
+                        'scaleoffset': scaleoffset, 'chunks': chunk_name}
+            yield settings, kwargs
+
+
+def config_label(settings):
+    label = settings['filter']
+    if settings['level'] is not None:
+        label += '-%i' % settings['level']
+    if settings['shuffle']:
+        label += '+shuf'
+    if settings['scaleoffset'] is not None:
+        label += '+so%i' % settings['scaleoffset']
+    return label + '/' + settings['chunks']
+
+
+def bench_hdf5(data, kwargs, repeat):
+    """ Return compress time, decompress time and stored size for one setting """
+    counter = itertools.count()
+
+    def new_file():
+        # In memory, with no chunk cache, so every read decompresses
+        return h5py.File('bench_%i.h5' % next(counter), 'w', driver='core',
+                         backing_store=False, rdcc_nbytes=0)
+
+    def compress():
+        with new_file() as h:
+            bs.create_dataset(h, 'DATA', data, **kwargs)
+            h.flush()
+
+    t_compress, peak = measure(compress, repeat, memory=False)
+
+    with new_file() as h:
+        dset = bs.create_dataset(h, 'DATA', data, **kwargs)
+        h.flush()
+        stored = dset.id.get_storage_size()
+        # read_dataset decodes unicode, which is stored as UTF-8
+        t_decompress, peak = measure(lambda: bs.read_dataset(dset), repeat, memory=False)
+        lossless = np.array_equal(bs.read_dataset(dset), data)
+    return t_compress, t_decompress, stored, lossless
+
+
+def bench_tile_compression(data, compression_type, repeat):
+    """ Return compress time, decompress time and size for astropy CompImageHDU """
+    def compress():
+        buf = io.BytesIO()
+        pf.HDUList([pf.PrimaryHDU(), pf.CompImageHDU(data, compression_type=compression_type)]
+                   ).writeto(buf)
+        return buf
+
+    t_compress, peak = measure(compress, repeat, memory=False)
+    compressed = compress().getvalue()
+
+    def decompress():
+        # astropy closes the file object on exit, so a new one is needed each time
+        with pf.open(io.BytesIO(compressed)) as hdul:
+            return np.array(hdul[1].data)
+
+    t_decompress, peak = measure(decompress, repeat, memory=False)
+    lossless = np.array_equal(decompress(), data)
+    return t_compress, t_decompress, len(compressed), lossless
+
+
+def add_result(results, name, data, label, settings, timings):
+    t_compress, t_decompress, stored, lossless = timings
+    return results.add(name, label, t_compress, data.nbytes, None,
+                       ratio=float(data.nbytes) / stored if stored else None,
+                       compress_mb_s=data.nbytes / 1e6 / t_compress,
+                       decompress_mb_s=data.nbytes / 1e6 / t_decompress,
+                       lossless=lossless, data=name, **settings)
+
+
+def run(results, scale='small', repeat=3, workers=1):
+    for name, data in synthetic_data(scale):
+        for settings, kwargs in hdf5_configs(data, workers):
+            label = config_label(settings)
+            try:
+                timings = bench_hdf5(data, kwargs, repeat)
+            except Exception as e:
+                results.add(name, label, error="%s: %s" % (e.__class__.__name__, e))
+                continue
+            add_result(results, name, data, label, settings, timings)
+
+        if data.ndim == 2:
+            tile_types = ['RICE_1', 'GZIP_1', 'GZIP_2', 'HCOMPRESS_1']
+            if data.dtype.kind in 'iu' and data.min() >= 0 and data.max() < 2**24:
+                tile_types.append('PLIO_1')
+            for compression_type in tile_types:
+                settings = {'filter': 'fits_' + compression_type, 'level': None, 'shuffle': False,
+                            'scaleoffset': None, 'chunks': 'tiles'}
+                label = 'fits_' + compression_type
+                try:
+                    timings = bench_tile_compression(data, compression_type, repeat)
+                except Exception as e:
+                    results.add(name, label, error="%s: %s" % (e.__class__.__name__, e))
+                    continue
+                add_result(results, name, data, label, settings, timings)
+
+
+def check_thresholds(results, thresholds):
+    """ Check results against thresholds, returning a list of failures
+
+    Each threshold is a dictionary with keys to match results on (any of
+    data, filter, level, shuffle, scaleoffset, chunks), and one or more of
+    min_ratio, min_compress_mb_s and min_decompress_mb_s.
+    """
+    limits = {'min_ratio': 'ratio', 'min_compress_mb_s': 'compress_mb_s',
+              'min_decompress_mb_s': 'decompress_mb_s'}
+    failures = []
+    for threshold in thresholds:
+        match = dict((k, v) for k, v in threshold.items() if k not in limits)
+        for r in results:
+            if r['error'] is not None or any(r.get(k) != v for k, v in match.items()):
+                continue
+            for limit, key in limits.items():
+                if limit in threshold and r[key] is not None and r[key] < threshold[limit]:
+                    failures.append("%s %s: %s %.2f < %.2f" % (r['case'], r['operation'], key,
+                                                                r[key], threshold[limit]))
+    return failures
+
+
+def check_baseline(results, baseline, tolerance):
+    """ Compare ratio and throughput with a previous run, returning a list of regressions """
+    old = dict(((r['case'], r['operation']), r) for r in baseline['results'] if r['error'] is None)
+    failures = []
+    for r in results:
+        r_old = old.get((r['case'], r['operation']))
+        if r_old is None or r['error'] is not None:
+            continue
+        for key in ('ratio', 'compress_mb_s', 'decompress_mb_s'):
+            if r[key] is not None and r_old[key] is not None and r[key] < r_old[key] * (1 - tolerance):
+                failures.append("%s %s: %s %.2f, was %.2f" % (r['case'], r['operation'], key,
+                                                             r[key], r_old[key]))
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark HDF5 compression settings against FITS tile compression.')
+    parser.add_argument('-s', '--scale', dest='scale', default='small', choices=sorted(synthetic.SCALES),
+                        help='Size of synthetic data. Defaults to small')
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=3,
+                        help='Number of timed runs (fastest is reported). Defaults to 3')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+                        help='Compression threads for fits2hdf (see hdfcompress.write_parallel). Defaults to 1')
+    parser.add_argument('-t', '--thresholds', dest='thresholds',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             'compression_thresholds.json'),
+                        help='JSON file of thresholds. Defaults to compression_thresholds.json in '
+                             'the benchmarks directory')
+    parser.add_argument('-b', '--baseline', dest='baseline', default=None,
+                        help='Results of a previous run to check for regressions')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.2,
+                        help='Fractional drop from baseline counted as a regression. Defaults to 0.2')
+    parser.add_argument('-o', '--output', dest='output', default='bench_compression.json',
+                        help='JSON results file. Defaults to bench_compression.json')
+    args = parser.parse_args()
+
+    try:
+        with open(args.thresholds) as fh:
+            thresholds = json.load(fh)['thresholds']
+    except IOError as e:
+        print("FAILED: cannot read thresholds file %s (%s)" % (args.thresholds, e))
+        sys.exit(1)
+
+    results = Results('compression', {'scale': args.scale, 'repeat': args.repeat,
+                                      'workers': args.workers})
+    run(results, args.scale, args.repeat, args.workers)
+    results.save(args.output)
+
+    failures = check_thresholds(results.results, thresholds)
+    if args.baseline is not None:
+        failures += check_baseline(results.results, load_results(args.baseline), args.tolerance)
+
+    if failures:
+        print("\nFAILED:")
+        for failure in failures:
+            print("  " + failure)
+        sys.exit(1)
+    if not thresholds and args.baseline is None:
+        print("\nNo thresholds in %s and no baseline: nothing was checked" % args.thresholds)
+    else:
+        print("\nAll thresholds passed")
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+bench_conversion.py
+===================
+
+Benchmark the core conversion paths on synthetic data (see synthetic.py):
+
+    read_fits -> export_hdf -> read_hdf -> create_fits / export_fits
+    pyhdfits.open
+
+Throughput (MB/s) is relative to the size of the input FITS file. Results
+are printed, and saved as JSON for comparison between commits with common.py.
+
+Usage:
+
+    python bench_conversion.py [--scale small] [--output results.json]
+"""
+
+import os
+import shutil
+import argparse
+import tempfile
+
+from fits2hdf import pyhdfits
+from fits2hdf.io.fitsio import read_fits, create_fits, export_fits
+from fits2hdf.io.hdfio import read_hdf, export_hdf
+
+import synthetic
+from common import measure, Results
+
+
+def run_case(results, name, fits_file, work_dir, repeat=3, hdf_opts=None):
+    """ Benchmark all conversion paths for one FITS file """
+    hdf_opts = hdf_opts or {}
+    hdf_file = os.path.join(work_dir, name + '.h5')
+    fits_out = os.path.join(work_dir, name + '.fits')
+    nbytes = os.path.getsize(fits_file)
+
+    def read_fits_case():
+        read_fits(fits_file).close()
+
+    def export_hdf_case():
+        export_hdf(hdul_fits, hdf_file, **hdf_opts)
+
+    def read_hdf_case():
+        read_hdf(hdf_file, mode='r')
+
+    def create_fits_case():
+        create_fits(hdul_hdf)
+
+    def export_fits_case():
+        if os.path.exists(fits_out):
+            os.remove(fits_out)
+        export_fits(hdul_hdf, fits_out)
+
+    def pyhdfits_open_case():
+        pyhdfits.open(hdf_file)
+
+    hdul_fits = hdul_hdf = None
+    operations = [('read_fits', read_fits_case), ('export_hdf', export_hdf_case),
+                  ('read_hdf', read_hdf_case), ('create_fits', create_fits_case),
+                  ('export_fits', export_fits_case), ('pyhdfits.open', pyhdfits_open_case)]
+    for operation, func in operations:
+        try:
+            # Set up the inputs each stage needs from the one before
+            if operation == 'export_hdf':
+                hdul_fits = read_fits(fits_file)
+            elif operation == 'create_fits':
+                hdul_hdf = read_hdf(hdf_file, mode='r')
+            time_taken, peak_mem = measure(func, repeat)
+        except Exception as e:
+            results.add(name, operation, error="%s: %s" % (e.__class__.__name__, e))
+            continue
+
+        extra = {}
+        if operation == 'export_hdf':
+            extra['size_out'] = os.path.getsize(hdf_file)
+        results.add(name, operation, time_taken, nbytes, peak_mem, **extra)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark FITS <-> HDF5 conversion on synthetic data.')
+    parser.add_argument('-s', '--scale', dest='scale', default='small', choices=sorted(synthetic.SCALES),
+                        help='Size of synthetic data. Defaults to small')
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=3,
+                        help='Number of timed runs per operation (fastest is reported). Defaults to 3')
+    parser.add_argument('-c', '--compression', dest='comp', type=str, default=None,
+                        help='HDF5 compression for export_hdf (e.g. gzip, lzf). Defaults to None')
+    parser.add_argument('--case', dest='cases', action='append', default=None,
+                        help='Only run this case (can be repeated)')
+    parser.add_argument('-d', '--data-dir', dest='data_dir', default=None,
+                        help='Directory for synthetic FITS files, kept between runs. '
+                             'Defaults to a temporary directory')
+    parser.add_argument('-o', '--output', dest='output', default='bench_conversion.json',
+                        help='JSON results file. Defaults to bench_conversion.json')
+    args = parser.parse_args()
+
+    hdf_opts = {}
+    if args.comp is not None:
+        hdf_opts['compression'] = args.comp
+
+    work_dir = tempfile.mkdtemp()
+    data_dir = args.data_dir or os.path.join(work_dir, 'data')
+    try:
+        print("Generating synthetic data in %s" % data_dir)
+        files = synthetic.generate(data_dir, args.scale, args.cases)
+
+        results = Results('conversion', {'scale': args.scale, 'repeat': args.repeat,
+                                         'hdf_opts': hdf_opts})
+        for name, fits_file in sorted(files.items()):
+            run_case(results, name, fits_file, work_dir, args.repeat, hdf_opts)
+        results.save(args.output)
+    finally:
+        shutil.rmtree(work_dir)
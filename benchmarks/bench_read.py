@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""
+bench_read.py
+=============
+
+Benchmark read access patterns on HDFITS files with different chunk shapes
+and compressors, against the same data read from FITS with astropy (memmap).
+
+Image cube patterns:
+    full      whole cube
+    planes    plane by plane iteration, data[z]
+    cutouts   small 2D cutouts, data[z, y:y+n, x:x+n], at random positions
+    points    single pixels at random positions
+
+Table patterns:
+    full      all columns, all rows
+    columns   one column (column projection)
+    rows      contiguous row slices at random positions
+    points    single values of one column at random rows
+
+Each pattern is run through read_hdf (lazy, or with the rows / section /
+columns selections), pyhdfits.open, raw h5py and astropy with memmap=True.
+Every timed run opens the file, so open overhead is included. Throughput is
+relative to the number of bytes the pattern returns.
+
+Chunk count (kind "chunks"):
+    full reads of a gzip compressed column split into many small chunks,
+    through h5py and hdfcompress.read_parallel, so that the cost per chunk
+    of parallel reads can be compared with h5py's.
+
+Usage:
+
+    python bench_read.py [--scale small] [--output results.json]
+"""
+
+import os
+import shutil
+import argparse
+import tempfile
+import itertools
+
+import numpy as np
+import h5py
+from astropy.io import fits as pf
+
+from fits2hdf import pyhdfits
+from fits2hdf.io import hdfcompress as bs
+from fits2hdf.io.fitsio import read_fits
+from fits2hdf.io.hdfio import read_hdf, export_hdf
+
+import synthetic
+from common import measure, Results
+
+COMPRESSORS = [('none', {}),
+               ('gzip+shuf', {'compression': 'gzip', 'shuffle': True}),
+               ('lzf', {'compression': 'lzf'})]
+
+N_CUTOUTS = 20
+CUTOUT_SIZE = 64
+N_POINTS = 200
+N_ROW_SLICES = 20
+ROW_SLICE_SIZE = 1000
+CHUNK_COUNTS = (1000, 10000, 40000)
+READ_WORKERS = (2, 4)
+
+
+def image_layouts(shape):
+    """ Chunk shapes to test for an image cube: name, chunks (None for h5py default) """
+    nz, ny, nx = shape
+    return [('auto', None),
+            ('planes', (1, ny, nx)),
+            ('tiles', (1, min(128, ny), min(128, nx))),
+            ('blocks', (min(8, nz), min(64, ny), min(64, nx)))]
+
+
+def table_layouts(n_rows):
+    """ Chunk shapes to test for table columns: name, chunks (None for h5py default) """
+    return [('auto', None),
+            ('4096', (min(4096, n_rows), )),
+            ('65536', (min(65536, n_rows), ))]
+
+
+def write_inputs(work_dir, scale):
+    """ Write the FITS image cube and table that all layouts are created from """
+    n = synthetic.SCALES[scale]
+    cube_file = os.path.join(work_dir, 'cube.fits')
+    pf.HDUList([pf.PrimaryHDU(synthetic.make_image((32 * n, 256, 256), 'float32'))]
+               ).writeto(cube_file)
+
+    # Scalar columns only, so a single chunk shape applies to all columns
+    cols = [c for c in synthetic.make_table_columns(200000 * n, 4) if c.name != 'VECTOR']
+    table_file = os.path.join(work_dir, 'table.fits')
+    pf.HDUList([pf.PrimaryHDU(), pf.BinTableHDU.from_columns(cols, name='TABLE')]
+               ).writeto(table_file)
+    return cube_file, table_file
+
+
+def image_patterns(shape, seed=0):
+    """ Return dictionary of pattern name: list of index tuples """
+    rng = np.random.RandomState(seed)
+    nz, ny, nx = shape
+    cutouts = []
+    for ii in range(N_CUTOUTS):
+        z = rng.randint(nz)
+        y = rng.randint(max(1, ny - CUTOUT_SIZE))
+        x = rng.randint(max(1, nx - CUTOUT_SIZE))
+        cutouts.append((z, slice(y, y + CUTOUT_SIZE), slice(x, x + CUTOUT_SIZE)))
+    points = [tuple(int(rng.randint(n)) for n in shape) for ii in range(N_POINTS)]
+    return {'full': [(Ellipsis, )],
+            'planes': [(z, ) for z in range(nz)],
+            'cutouts': cutouts,
+            'points': points}
+
+
+def table_patterns(n_rows, column, seed=0):
+    """ Return dictionary of pattern name: (columns, list of row selections) """
+    rng = np.random.RandomState(seed)
+    starts = rng.randint(max(1, n_rows - ROW_SLICE_SIZE), size=N_ROW_SLICES)
+    return {'full': (None, [slice(None)]),
+            'columns': ([column], [slice(None)]),
+            'rows': (None, [slice(s, s + ROW_SLICE_SIZE) for s in starts]),
+            'points': ([column], [int(r) for r in rng.randint(n_rows, size=N_POINTS)])}
+
+
+def image_readers(fits_file, hdf_file, pattern, indexes):
+    """ Return dictionary of reader name: function reading every index """
+    def read_hdf_case():
+        if pattern == 'full':
+            return [read_hdf(hdf_file, mode='r')['PRIMARY'].data]
+        if pattern == 'cutouts':
+            return [read_hdf(hdf_file, mode='r', section=idx)['PRIMARY'].data for idx in indexes]
+        hdul = read_hdf(hdf_file, mode='r', lazy=True)
+        try:
+            data = hdul['PRIMARY'].data
+            return [data[idx] for idx in indexes]
+        finally:
+            hdul.close()
+
+    def pyhdfits_case():
+        data = pyhdfits.open(hdf_file)[0].data
+        return [data[idx] for idx in indexes]
+
+    def h5py_case():
+        with h5py.File(hdf_file, 'r') as h:
+            dset = h['PRIMARY/DATA']
+            return [dset[idx] for idx in indexes]
+
+    def astropy_case():
+        with pf.open(fits_file, memmap=True) as hdul:
+            data = hdul[0].data
+            return [np.array(data[idx]) for idx in indexes]
+
+    return {'read_hdf': read_hdf_case, 'pyhdfits.open': pyhdfits_case,
+            'h5py': h5py_case, 'astropy_memmap': astropy_case}
+
+
+def table_readers(fits_file, hdf_file, pattern, columns, rows_list):
+    """ Return dictionary of reader name: function reading every row selection """
+    def read_hdf_case():
+        if pattern in ('full', 'columns'):
+            return [read_hdf(hdf_file, mode='r', columns=columns)['TABLE']]
+        if pattern == 'rows':
+            return [read_hdf(hdf_file, mode='r', rows=rows)['TABLE'] for rows in rows_list]
+        hdul = read_hdf(hdf_file, mode='r', lazy=True, columns=columns)
+        try:
+            col = hdul['TABLE'][columns[0]]
+            return [col[rows] for rows in rows_list]
+        finally:
+            hdul.close()
+
+    def pyhdfits_case():
+        data = pyhdfits.open(hdf_file, columns=columns)[1].data
+        return [data[rows] for rows in rows_list]
+
+    def h5py_case():
+        with h5py.File(hdf_file, 'r') as h:
+            group = h['TABLE/DATA']
+            names = columns or list(group.keys())
+            return [[group[name][rows] for name in names] for rows in rows_list]
+
+    def astropy_case():
+        with pf.open(fits_file, memmap=True) as hdul:
+            data = hdul[1].data
+            names = columns or data.names
+            return [[np.array(data[name][rows]) for name in names] for rows in rows_list]
+
+    return {'read_hdf': read_hdf_case, 'pyhdfits.open': pyhdfits_case,
+            'h5py': h5py_case, 'astropy_memmap': astropy_case}
+
+
+def selected_bytes(fits_file, ext, columns, selections):
+    """ Number of bytes returned by a list of selections, for computing MB/s """
+    with pf.open(fits_file, memmap=True) as hdul:
+        data = hdul[ext].data
+        if columns is None and ext == 0:
+            return sum(data[idx].nbytes for idx in selections)
+        names = columns or data.names
+        return sum(np.asarray(data[name][rows]).nbytes for rows in selections for name in names)
+
+
+def run_layouts(results, kind, fits_file, work_dir, repeat=3):
+    """ Export fits_file with each layout, and benchmark every pattern and reader """
+    hdul_fits = read_fits(fits_file)
+    with pf.open(fits_file, memmap=True) as hdul:
+        if kind == 'image':
+            shape = hdul[0].data.shape
+            layouts = image_layouts(shape)
+            patterns = image_patterns(shape)
+        else:
+            n_rows = len(hdul[1].data)
+            layouts = table_layouts(n_rows)
+            patterns = table_patterns(n_rows, hdul[1].data.names[0])
+
+    # The astropy reader doesn't depend on the HDF5 layout, so only run it once
+    astropy_done = set()
+    for (layout, chunks), (comp, comp_opts) in itertools.product(layouts, COMPRESSORS):
+        hdf_opts = dict(comp_opts)
+        if chunks is not None:
+            hdf_opts['chunks'] = chunks
+        hdf_file = os.path.join(work_dir, '%s_%s_%s.h5' % (kind, layout, comp))
+        export_hdf(hdul_fits, hdf_file, **hdf_opts)
+        size = os.path.getsize(hdf_file)
+
+        for pattern, selection in sorted(patterns.items()):
+            if kind == 'image':
+                readers = image_readers(fits_file, hdf_file, pattern, selection)
+                nbytes = selected_bytes(fits_file, 0, None, selection)
+            else:
+                readers = table_readers(fits_file, hdf_file, pattern, *selection)
+                nbytes = selected_bytes(fits_file, 1, *selection)
+
+            for reader, func in sorted(readers.items()):
+                if reader == 'astropy_memmap':
+                    if pattern in astropy_done:
+                        continue
+                    astropy_done.add(pattern)
+                    case = '%s/fits' % kind
+                else:
+                    case = '%s/%s/%s' % (kind, layout, comp)
+                operation = '%s %s' % (reader, pattern)
+                try:
+                    time_taken, peak_mem = measure(func, repeat, memory=False)
+                except Exception as e:
+                    results.add(case, operation, error="%s: %s" % (e.__class__.__name__, e))
+                    continue
+                results.add(case, operation, time_taken, nbytes, None, kind=kind, layout=layout,
+                            compression=comp, reader=reader, pattern=pattern, file_size=size)
+        os.remove(hdf_file)
+
+
+def run_chunk_counts(results, work_dir, scale, repeat=3):
+    """ Benchmark full reads of a column with many chunks, through h5py and read_parallel """
+    n = synthetic.SCALES[scale]
+    data = np.arange(400000 * n, dtype='int32')
+    for n_chunks in CHUNK_COUNTS:
+        hdf_file = os.path.join(work_dir, 'chunks_%i.h5' % n_chunks)
+        chunk_rows = -(-len(data) // n_chunks)
+        with h5py.File(hdf_file, 'w') as h:
+            h.create_dataset('DATA', data=data, chunks=(chunk_rows, ), compression='gzip',
+                             shuffle=True)
+
+        def h5py_case():
+            with h5py.File(hdf_file, 'r') as h:
+                return h['DATA'][:]
+
+        readers = [('h5py', h5py_case)]
+        for workers in READ_WORKERS:
+            def parallel_case(workers=workers):
+                with h5py.File(hdf_file, 'r') as h:
+                    return bs.read_parallel(h['DATA'], workers)
+            readers.append(('read_parallel %i' % workers, parallel_case))
+
+        case = 'chunks/%i' % n_chunks
+        for reader, func in readers:
+            time_taken, peak_mem = measure(func, repeat, memory=False)
+            results.add(case, '%s full' % reader, time_taken, data.nbytes, None, kind='chunks',
+                        n_chunks=n_chunks, reader=reader, pattern='full')
+        os.remove(hdf_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark read access patterns on HDFITS and FITS files.')
+    parser.add_argument('-s', '--scale', dest='scale', default='small', choices=sorted(synthetic.SCALES),
+                        help='Size of synthetic data. Defaults to small')
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=3,
+                        help='Number of timed runs per operation (fastest is reported). Defaults to 3')
+    parser.add_argument('-k', '--kind', dest='kinds', action='append',
+                        choices=['image', 'table', 'chunks'], default=None,
+                        help='Only run image, table or chunk count benchmarks')
+    parser.add_argument('-o', '--output', dest='output', default='bench_read.json',
+                        help='JSON results file. Defaults to bench_read.json')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        cube_file, table_file = write_inputs(work_dir, args.scale)
+        results = Results('read', {'scale': args.scale, 'repeat': args.repeat})
+        for kind, fits_file in (('image', cube_file), ('table', table_file)):
+            if args.kinds is None or kind in args.kinds:
+                run_layouts(results, kind, fits_file, work_dir, args.repeat)
+        if args.kinds is None or 'chunks' in args.kinds:
+            run_chunk_counts(results, work_dir, args.scale, args.repeat)
+        results.save(args.output)
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+common.py
+=========
+
+Timing, memory measurement and result storage shared by the benchmarks.
+
+Results are stored as JSON, with metadata about the environment (git commit,
+library versions), so runs from different commits can be compared:
+
+    python common.py old.json new.json [--threshold 0.1]
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import h5py
+import astropy
+
+
+def measure(func, repeat=3, memory=True):
+    """ Time a function, and measure its peak memory allocation
+
+    Parameters
+    ----------
+    func: function
+        Function to run, with no arguments
+    repeat: int
+        Number of timed runs; the fastest is reported
+    memory: bool
+        Make an extra run with tracemalloc to find the peak allocation
+
+    Returns
+    -------
+    time: float
+        Best run time in seconds
+    peak_mem: int or None
+        Peak memory allocated during the run, in bytes. This covers Python and
+        numpy allocations, but not memory allocated inside HDF5 or cfitsio.
+    """
+    times = []
+    for ii in range(repeat):
+        gc.collect()
+        t1 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t1)
+
+    peak_mem = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func()
+            peak_mem = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return min(times), peak_mem
+
+
+def git_commit():
+    """ Return the git commit of the fits2hdf source tree, or None """
+    try:
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=src_dir,
+                                      stderr=subprocess.STDOUT)
+        return out.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """ Describe the environment the benchmarks were run in """
+    return {'date': datetime.now().isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'h5py': h5py.__version__,
+            'hdf5': h5py.version.hdf5_version,
+            'astropy': astropy.__version__}
+
+
+class Results(object):
+    """ Collection of benchmark results, printed as they are added and saved as JSON
+
+    Parameters
+    ----------
+    benchmark: str
+        Name of benchmark
+    settings: dict
+        Settings the benchmark was run with (e.g. scale, repeat)
+    """
+    def __init__(self, benchmark, settings=None):
+        self.benchmark = benchmark
+        self.settings = settings or {}
+        self.results = []
+
+    def add(self, case, operation, time_taken=None, nbytes=None, peak_mem=None, error=None, **extra):
+        """ Add a result, and print it
+
+        Parameters
+        ----------
+        case: str
+            Name of data / test case
+        operation: str
+            Operation timed, e.g. read_fits
+        time_taken: float
+            Time in seconds
+        nbytes: int
+            Number of bytes processed, used to compute MB/s
+        peak_mem: int
+            Peak memory in bytes
+        error: str
+            Error message, if the operation failed
+        extra:
+            Other values to store, e.g. compression ratio
+        """
+        result = {'case': case, 'operation': operation, 'time': time_taken, 'nbytes': nbytes,
+                  'mb_per_s': None, 'peak_mem': peak_mem, 'error': error}
+        if time_taken and nbytes:
+            result['mb_per_s'] = nbytes / 1e6 / time_taken
+        result.update(extra)
+        self.results.append(result)
+        print(format_result(result))
+        return result
+
+    def save(self, filename):
+        with open(filename, 'w') as fh:
+            json.dump({'benchmark': self.benchmark, 'environment': environment(),
+                       'settings': self.settings, 'results': self.results}, fh, indent=1)
+        print("\nResults written to %s" % filename)
+
+
+def format_result(result):
+    """ Format a single result as a line of text """
+    if result['error'] is not None:
+        return "%-28s %-22s ERROR: %s" % (result['case'], result['operation'], result['error'])
+    line = "%-28s %-22s %9.4fs" % (result['case'], result['operation'], result['time'])
+    if result['mb_per_s'] is not None:
+        line += " %9.1f MB/s" % result['mb_per_s']
+    if result['peak_mem'] is not None:
+        line += " %9.1f MB peak" % (result['peak_mem'] / 1e6)
+    if result.get('ratio') is not None:
+        line += " %7.2fx" % result['ratio']
+    return line
+
+
+def load_results(filename):
+    with open(filename) as fh:
+        return json.load(fh)
+
+
+def compare(old, new, threshold=0.1):
+    """ Compare two sets of results, printing the change in time for each
+
+    Parameters
+    ----------
+    old, new: dict
+        Results, as loaded by load_results
+    threshold: float
+        Fractional slowdown above which a result is flagged as a regression
+
+    Returns
+    -------
+    regressions: list of (case, operation, ratio)
+        Results that are slower than threshold allows
+    """
+    old_times = dict(((r['case'], r['operation']), r['time']) for r in old['results'] if r['time'])
+    regressions = []
+    print("%-28s %-22s %10s %10s %8s" % ('case', 'operation', 'old (s)', 'new (s)', 'ratio'))
+    for r in new['results']:
+        key = (r['case'], r['operation'])
+        if key not in old_times or not r['time']:
+            continue
+        ratio = r['time'] / old_times[key]
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  SLOWER'
+            regressions.append((r['case'], r['operation'], ratio))
+        print("%-28s %-22s %10.4f %10.4f %8.2f%s" % (key + (old_times[key], r['time'], ratio, flag)))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files.')
+    parser.add_argument('old', help='results of baseline run (JSON)')
+    parser.add_argument('new', help='results of new run (JSON)')
+    parser.add_argument('-t', '--threshold', dest='threshold', type=float, default=0.1,
+                        help='Fractional slowdown counted as a regression. Defaults to 0.1')
+    args = parser.parse_args()
+
+    old, new = load_results(args.old), load_results(args.new)
+    print("Old: %s (%s)" % (old['environment']['commit'], old['environment']['date']))
+    print("New: %s (%s)\n" % (new['environment']['commit'], new['environment']['date']))
+    regressions = compare(old, new, args.threshold)
+    if regressions:
+        print("\n%i regressions" % len(regressions))
+        sys.exit(1)
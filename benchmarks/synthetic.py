@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+synthetic.py
+============
+
+Generate synthetic FITS files for benchmarking, without network access or
+external tools. Data are generated from a fixed random seed, so files are
+the same from run to run.
+
+The suite covers images of several dtypes and shapes (smooth and noisy),
+wide and tall binary tables with numeric, string, bool and vector columns,
+a random groups file, and a multi-extension file with many HDUs.
+
+Usage:
+
+    python synthetic.py output_dir [--scale small|medium|large]
+"""
+
+import os
+import argparse
+
+import numpy as np
+from astropy.io import fits as pf
+
+# Multipliers for data sizes
+SCALES = {'small': 1, 'medium': 8, 'large': 64}
+
+
+def make_image(shape, dtype, noise=True, seed=0):
+    """ Create image data: a smooth gradient plus (optionally) random noise
+
+    Parameters
+    ----------
+    shape: tuple
+        Shape of image
+    dtype: str or numpy dtype
+        Data type. Integer images are scaled to use the lower half of their range.
+    noise: bool
+        Add random noise, to make the data less compressible
+    seed: int
+        Random seed
+    """
+    rng = np.random.RandomState(seed)
+    grids = np.meshgrid(*[np.linspace(0, 1, n) for n in shape], indexing='ij', sparse=True)
+    data = sum(grids) / len(shape)
+    if noise:
+        data = data + 0.1 * rng.standard_normal(shape)
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu':
+        data = data * (np.iinfo(dtype).max // 2)
+        data = np.clip(data, np.iinfo(dtype).min, np.iinfo(dtype).max)
+    return data.astype(dtype)
+
+
+def make_table_columns(n_rows, n_numeric=4, vector_len=3, str_len=16, seed=0):
+    """ Create binary table columns of many types
+
+    Parameters
+    ----------
+    n_rows: int
+        Number of rows
+    n_numeric: int
+        Number of numeric columns (cycling through int16, int32, int64, float32, float64)
+    vector_len: int
+        Length of the vector (array) columns
+    str_len: int
+        Width of string column
+
+    Returns
+    -------
+    cols: list of astropy.io.fits.Column
+    """
+    rng = np.random.RandomState(seed)
+    formats = [('I', 'i2'), ('J', 'i4'), ('K', 'i8'), ('E', 'f4'), ('D', 'f8')]
+    cols = []
+    for ii in range(n_numeric):
+        fmt, dtype = formats[ii % len(formats)]
+        if dtype[0] == 'f':
+            data = np.cumsum(rng.standard_normal(n_rows)).astype(dtype)
+        else:
+            data = (np.arange(n_rows) + rng.randint(0, 100, n_rows)).astype(dtype)
+        cols.append(pf.Column(name='COL%i' % ii, format=fmt, unit='m' if ii % 2 else None,
+                              array=data))
+
+    words = np.array(['ALPHA', 'BETA', 'GAMMA', 'DELTA', 'EPSILON', 'OBJECT_%i'])
+    names = np.char.add(words[rng.randint(0, len(words), n_rows)], np.arange(n_rows).astype('U8'))
+    cols.append(pf.Column(name='NAME', format='%iA' % str_len, array=names))
+    cols.append(pf.Column(name='FLAG', format='L', array=rng.randint(0, 2, n_rows).astype(bool)))
+    cols.append(pf.Column(name='VECTOR', format='%iE' % vector_len,
+                          array=rng.standard_normal((n_rows, vector_len)).astype('f4')))
+    return cols
+
+
+def make_groups(n_groups, shape=(1, 1, 1, 4, 3), seed=0):
+    """ Create a random groups HDU, as used for radio interferometer visibilities """
+    rng = np.random.RandomState(seed)
+    data = rng.standard_normal((n_groups, ) + shape).astype('f4')
+    parnames = ['UU', 'VV', 'WW', 'DATE', 'BASELINE']
+    pardata = [rng.standard_normal(n_groups).astype('f4') for name in parnames]
+    groups = pf.GroupData(data, parnames=parnames, pardata=pardata, bitpix=-32)
+    return pf.GroupsHDU(groups)
+
+
+def synthetic_cases(scale='small'):
+    """ Return a dictionary of name: function that creates an astropy HDUList
+
+    Parameters
+    ----------
+    scale: str
+        One of SCALES: 'small' (a few MB in total), 'medium' or 'large'
+    """
+    n = SCALES[scale]
+    side = int(512 * np.sqrt(n))
+
+    def image(shape, dtype, noise=True):
+        return lambda: pf.HDUList([pf.PrimaryHDU(make_image(shape, dtype, noise))])
+
+    def table(n_rows, n_numeric):
+        def create():
+            tbl = pf.BinTableHDU.from_columns(make_table_columns(n_rows, n_numeric), name='TABLE')
+            return pf.HDUList([pf.PrimaryHDU(), tbl])
+        return create
+
+    def groups():
+        return pf.HDUList([make_groups(20000 * n)])
+
+    def mef(n_ext):
+        def create():
+            hdus = [pf.PrimaryHDU()]
+            for ii in range(n_ext):
+                if ii % 2:
+                    hdus.append(pf.ImageHDU(make_image((64, 64), 'f4', seed=ii), name='IMG%i' % ii))
+                else:
+                    cols = make_table_columns(100, seed=ii)
+                    hdus.append(pf.BinTableHDU.from_columns(cols, name='TBL%i' % ii))
+            return pf.HDUList(hdus)
+        return create
+
+    return {
+        'image_int16_2d': image((side, side), 'int16'),
+        'image_int32_2d_smooth': image((side, side), 'int32', noise=False),
+        'image_float32_2d': image((side, side), 'float32'),
+        'image_float64_2d': image((side // 2, side // 2), 'float64'),
+        'image_uint8_3d': image((16 * n, 256, 256), 'uint8'),
+        'image_float32_3d_cube': image((32 * n, 128, 128), 'float32'),
+        'table_tall': table(200000 * n, 4),
+        'table_wide': table(5000 * n, 100),
+        'random_groups': groups,
+        'mef_many_extensions': mef(50 * n),
+    }
+
+
+def generate(out_dir, scale='small', cases=None, overwrite=False):
+    """ Write synthetic FITS files to a directory
+
+    Parameters
+    ----------
+    out_dir: str
+        Output directory, created if needed
+    scale: str
+        Size of data, see SCALES
+    cases: list of str
+        Names of cases to write (default all, see synthetic_cases)
+    overwrite: bool
+        Overwrite existing files. If False, existing files are reused.
+
+    Returns
+    -------
+    files: dict
+        Case name: FITS file path
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    files = {}
+    for name, create in synthetic_cases(scale).items():
+        if cases is not None and name not in cases:
+            continue
+        filename = os.path.join(out_dir, '%s_%s.fits' % (name, scale))
+        if overwrite or not os.path.exists(filename):
+            create().writeto(filename, overwrite=True)
+        files[name] = filename
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic FITS files for benchmarking.')
+    parser.add_argument('out_dir', help='output directory')
+    parser.add_argument('-s', '--scale', dest='scale', default='small', choices=sorted(SCALES),
+                        help='Size of data. Defaults to small')
+    args = parser.parse_args()
+
+    for name, filename in sorted(generate(args.out_dir, args.scale, overwrite=True).items()):
+        print("%-24s %8.2f MB  %s" % (name, os.path.getsize(filename) / 1e6, filename))
@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+"""
+batch.py
+========
+
+Batch conversion of many files, optionally in parallel using a process pool.
+Used by the command line utilities in file_conversion.py.
+"""
+
+import os
+import sys
+import json
+import fnmatch
+import itertools
+import time
+import hashlib
+import cProfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from . import tracing
+
+try:
+    import resource
+    HAS_RESOURCE = True
+except ImportError:
+    HAS_RESOURCE = False
+
+
+def find_files(dir_in, include=('*', ), exclude=(), recursive=False, skip_dirs=()):
+    """ Find files in a directory, yielding paths relative to dir_in as they are found
+
+    This is a generator based on os.scandir, so files can be processed while
+    large directory trees are still being traversed.
+
+    Parameters
+    ----------
+    dir_in: str
+        Directory to search
+    include: list of str
+        Glob patterns; files are included if their name matches any of these
+    exclude: list of str
+        Glob patterns; files and directories are excluded if their name or
+        path relative to dir_in matches any of these
+    recursive: bool
+        Search subdirectories as well
+    skip_dirs: list of str
+        Directories not to descend into, e.g. the output directory
+
+    Symbolic links to directories are followed, but each directory is only
+    searched once, so links back to a parent directory do not loop.
+    """
+    skip_dirs = set(os.path.realpath(d) for d in skip_dirs)
+    visited = set()
+
+    def excluded(name, rel_path):
+        return any(fnmatch.fnmatch(name, pat) or fnmatch.fnmatch(rel_path, pat) for pat in exclude)
+
+    dirs = ['']
+    while dirs:
+        rel_dir = dirs.pop()
+        real_dir = os.path.realpath(os.path.join(dir_in, rel_dir))
+        if real_dir in visited:
+            continue
+        visited.add(real_dir)
+        try:
+            entries = os.scandir(os.path.join(dir_in, rel_dir))
+        except OSError:
+            continue
+        subdirs = []
+        with entries:
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name)
+                if excluded(entry.name, rel_path):
+                    continue
+                if entry.is_dir():
+                    if recursive and os.path.realpath(entry.path) not in skip_dirs:
+                        subdirs.append(rel_path)
+                elif any(fnmatch.fnmatch(entry.name, pat) for pat in include):
+                    yield rel_path
+        # Depth first, in name order
+        dirs.extend(sorted(subdirs, reverse=True))
+
+
+def sort_largest_first(tasks, window=None):
+    """ Sort (file_in, file_out) pairs by input file size, largest first
+
+    Starting the largest files first avoids a long tail where one big file
+    is still converting after everything else has finished.
+
+    If window is given, tasks are taken window at a time and each window is
+    sorted, so tasks can be a generator and work can start straight away.
+    """
+    def file_size(task):
+        try:
+            return os.path.getsize(task[0])
+        except OSError:
+            return 0
+
+    if window is None:
+        return sorted(tasks, key=file_size, reverse=True)
+    return _sort_windows(iter(tasks), window, file_size)
+
+
+def _sort_windows(tasks, window, key):
+    while True:
+        chunk = list(itertools.islice(tasks, window))
+        if not chunk:
+            return
+        for task in sorted(chunk, key=key, reverse=True):
+            yield task
+
+
+# Suffix for partially written output files, renamed once conversion succeeds
+PARTIAL_SUFFIX = '.part'
+
+MANIFEST_NAME = '.fits2hdf_manifest.jsonl'
+
+# Suffix of cProfile output files, written next to each output file
+PSTATS_SUFFIX = '.pstats'
+
+
+def peak_rss():
+    """ Return the peak resident set size of this process in bytes, or None if unknown """
+    if not HAS_RESOURCE:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+
+def metrics_record(result):
+    """ Form a metrics record for a converted file, to be written as a JSON line
+
+    Parameters
+    ----------
+    result: dict
+        Result of converting a file, see convert_file
+
+    Returns
+    -------
+    record: dict
+        file_in, file_out, error, size_in, size_out, compression ratio,
+        total time (s), peak_rss (bytes, peak for the worker process so far),
+        and any metrics returned by the conversion function (e.g. read_time,
+        write_time and per-HDU / per-column timings and sizes)
+    """
+    record = {'file_in': result['file_in'], 'file_out': result['file_out'],
+              'error': result['error'], 'size_in': result['size_in'],
+              'size_out': result['size_out'], 'compression': None,
+              'time': result['time'], 'peak_rss': result.get('peak_rss')}
+    if result['size_in'] and result['size_out']:
+        record['compression'] = float(result['size_in']) / result['size_out']
+    if result.get('metrics'):
+        record.update(result['metrics'])
+    return record
+
+
+def file_hash(filename, blocksize=2**20):
+    """ Return the SHA-1 hex digest of a file's contents """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class Manifest(object):
+    """ Record of converted files, used to skip inputs that are up to date
+
+    The manifest is a JSON lines file, with one record appended for each
+    file as soon as it has been converted: input path, size, mtime and
+    content hash, the conversion options, and the output path and size.
+    As records are only appended once the output has been renamed into place,
+    an interrupted run can simply be restarted. The last record for a path wins.
+
+    Parameters
+    ----------
+    filename: str
+        Path of manifest file. Created if it doesn't exist.
+    options: dict
+        Conversion options. Files converted with different options are
+        not up to date.
+    """
+    def __init__(self, filename, options=None):
+        self.filename = filename
+        self.options = json.loads(json.dumps(options or {}, sort_keys=True))
+        self.records = {}
+        self.n_skipped = 0
+
+        n_lines = 0
+        line = '\n'
+        if os.path.exists(filename):
+            with open(filename) as fh:
+                for line in fh:
+                    n_lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Truncated record from an interrupted run
+                        continue
+                    self.records[record['path']] = record
+
+        if n_lines > 2 * len(self.records) + 100:
+            self._compact()
+        self._fh = open(filename, 'a')
+        if not line.endswith('\n'):
+            # Don't append to a truncated record
+            self._fh.write('\n')
+
+    def _compact(self):
+        """ Rewrite the manifest with only the latest record for each path """
+        tmp_name = self.filename + PARTIAL_SUFFIX
+        with open(tmp_name, 'w') as fh:
+            for record in self.records.values():
+                fh.write(json.dumps(record) + '\n')
+        os.replace(tmp_name, self.filename)
+
+    def is_up_to_date(self, file_in, file_out):
+        """ Check if file_out was converted from the current file_in with the same options """
+        record = self.records.get(os.path.abspath(file_in))
+        if record is None or record['options'] != self.options:
+            return False
+        if record['output'] != os.path.abspath(file_out):
+            return False
+        try:
+            if os.path.getsize(file_out) != record['output_size']:
+                return False
+            stat = os.stat(file_in)
+        except OSError:
+            return False
+        if stat.st_size != record['size']:
+            return False
+        if stat.st_mtime == record['mtime']:
+            return True
+        # Modified time has changed, but the contents may not have
+        if file_hash(file_in) != record['hash']:
+            return False
+        self._write(dict(record, mtime=stat.st_mtime))
+        return True
+
+    def filter(self, tasks):
+        """ Yield the (file_in, file_out) pairs that are not up to date """
+        for file_in, file_out in tasks:
+            if self.is_up_to_date(file_in, file_out):
+                self.n_skipped += 1
+            else:
+                yield file_in, file_out
+
+    def record(self, result):
+        """ Add a record for a file converted successfully, see convert_file """
+        record = {'path': os.path.abspath(result['file_in']),
+                  'size': result['size_in'],
+                  'mtime': result['mtime'],
+                  'hash': result['hash'],
+                  'options': self.options,
+                  'output': os.path.abspath(result['file_out']),
+                  'output_size': result['size_out']}
+        self._write(record)
+
+    def _write(self, record):
+        self.records[record['path']] = record
+        self._fh.write(json.dumps(record) + '\n')
+        self._fh.flush()
+
+    def close(self):
+        self._fh.close()
+
+
+def convert_file(func, file_in, file_out, kwargs, hash_input=False, trace=False, profile=False):
+    """ Convert a single file, catching any errors
+
+    The output is written to file_out + PARTIAL_SUFFIX, and renamed to
+    file_out once complete, so file_out is never left half written.
+
+    Parameters
+    ----------
+    func: function
+        Conversion function, called as func(file_in, file_out, **kwargs)
+    file_in: str
+        Input file path
+    file_out: str
+        Output file path
+    kwargs: dict
+        Keyword arguments for func
+    hash_input: bool
+        Compute the content hash of file_in, for the Manifest
+    trace: bool
+        Record tracing spans, returned as a list of Chrome trace events
+    profile: bool
+        Run func under cProfile, writing stats to file_out + PSTATS_SUFFIX
+
+    Returns
+    -------
+    result: dict
+        file_in, file_out, size_in and size_out (bytes), mtime of file_in,
+        hash of file_in (or None), time (s), peak_rss (bytes), metrics
+        (the return value of func), trace (list of events, if trace is True),
+        and error (None, or a string describing the error)
+    """
+    result = {'file_in': file_in, 'file_out': file_out, 'size_in': None, 'size_out': None,
+              'mtime': None, 'hash': None, 'time': 0.0, 'error': None}
+    file_tmp = file_out + PARTIAL_SUFFIX
+    if trace:
+        tracing.enable()
+    t1 = time.time()
+    try:
+        # Stat before reading, so changes made during conversion are picked up next time
+        stat = os.stat(file_in)
+        result['size_in'] = stat.st_size
+        result['mtime'] = stat.st_mtime
+        if hash_input:
+            result['hash'] = file_hash(file_in)
+
+        out_dir = os.path.dirname(file_out)
+        if out_dir and not os.path.isdir(out_dir):
+            os.makedirs(out_dir, exist_ok=True)
+
+        with tracing.span("convert_file", file=file_in):
+            if profile:
+                prof = cProfile.Profile()
+                try:
+                    result['metrics'] = prof.runcall(func, file_in, file_tmp, **kwargs)
+                finally:
+                    prof.dump_stats(file_out + PSTATS_SUFFIX)
+            else:
+                result['metrics'] = func(file_in, file_tmp, **kwargs)
+        os.replace(file_tmp, file_out)
+        result['size_out'] = os.path.getsize(file_out)
+    except Exception as e:
+        result['error'] = "%s: %s" % (e.__class__.__name__, e)
+        result['traceback'] = traceback.format_exc()
+        if os.path.exists(file_tmp):
+            os.remove(file_tmp)
+    result['time'] = time.time() - t1
+    result['peak_rss'] = peak_rss()
+    if trace:
+        result['trace'] = tracing.disable()
+    return result
+
+
+def run_batch(func, tasks, jobs=1, manifest=None, trace=False, profile=False, **kwargs):
+    """ Convert files, yielding a result dictionary for each as it finishes
+
+    With jobs > 1, files are converted concurrently in a process pool, and
+    results are yielded in order of completion. Errors in one file do not
+    stop the others from being converted. If a worker process crashes, the
+    files that were queued in the pool are retried one at a time, so only
+    the file that crashes again is reported as failed.
+
+    Parameters
+    ----------
+    func: function
+        Conversion function, called as func(file_in, file_out, **kwargs). This
+        must be a module-level function, so it can be sent to worker processes.
+    tasks: iterable of (str, str)
+        Pairs of (input file, output file). Sort with sort_largest_first for
+        better load balancing.
+    jobs: int
+        Number of worker processes. If 1, files are converted in this process.
+    manifest: Manifest or None
+        If given, files that are up to date are skipped, and a record is
+        added for each file that is converted successfully.
+    trace: bool
+        Record tracing spans for each file, see convert_file
+    profile: bool
+        Profile each file with cProfile, see convert_file
+
+    Returns
+    -------
+    results: generator of dict, see convert_file
+    """
+    file_options = {'trace': trace, 'profile': profile}
+    if manifest is None:
+        for result in _run_batch(func, tasks, jobs, kwargs, file_options):
+            yield result
+        return
+
+    file_options['hash_input'] = True
+    for result in _run_batch(func, manifest.filter(tasks), jobs, kwargs, file_options):
+        if result['error'] is None:
+            manifest.record(result)
+        yield result
+
+
+def _worker_died(task, e):
+    """ Return the result of a file whose worker process died """
+    return {'file_in': task[0], 'file_out': task[1], 'size_in': None, 'size_out': None,
+            'mtime': None, 'hash': None, 'time': 0.0, 'error': "Worker process died: %s" % e}
+
+
+def _convert_isolated(func, task, kwargs, file_options):
+    """ Convert one file in a worker process of its own, see _run_batch """
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(convert_file, func, task[0], task[1], kwargs, **file_options)
+        try:
+            return future.result()
+        except BrokenProcessPool as e:
+            return _worker_died(task, e)
+
+
+def _run_batch(func, tasks, jobs, kwargs, file_options):
+    """ Convert files, see run_batch """
+    if jobs <= 1:
+        for file_in, file_out in tasks:
+            yield convert_file(func, file_in, file_out, kwargs, **file_options)
+        return
+
+    pool = ProcessPoolExecutor(max_workers=jobs)
+    pending = {}
+
+    def restart():
+        # Wait for the workers of a broken pool to exit, so they let go of the
+        # files they had open (HDF5 locks them), then start a new pool
+        nonlocal pool
+        pool.shutdown(wait=True)
+        pool = ProcessPoolExecutor(max_workers=jobs)
+
+    def collect(futures):
+        # When a worker dies, every file still queued in the pool fails with it,
+        # and there is no telling which file was to blame. So each of these is
+        # retried on its own, and only files that crash again are reported.
+        crashed = []
+        for future in futures:
+            task = pending.pop(future)
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                crashed.append(task)
+        if crashed:
+            restart()
+        for task in crashed:
+            yield _convert_isolated(func, task, kwargs, file_options)
+
+    try:
+        for task in tasks:
+            try:
+                future = pool.submit(convert_file, func, task[0], task[1], kwargs, **file_options)
+            except BrokenProcessPool:
+                # A worker died and took the pool down: start a new one
+                for result in collect(list(pending)):
+                    yield result
+                restart()
+                future = pool.submit(convert_file, func, task[0], task[1], kwargs, **file_options)
+            pending[future] = task
+
+            # Keep a bounded number of files queued, so tasks can be a generator
+            if len(pending) >= 2 * jobs:
+                done, not_done = wait(list(pending), return_when=FIRST_COMPLETED)
+                for result in collect(done):
+                    yield result
+
+        while pending:
+            done, not_done = wait(list(pending), return_when=FIRST_COMPLETED)
+            for result in collect(done):
+                yield result
+    finally:
+        pool.shutdown(wait=True)
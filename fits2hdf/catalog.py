@@ -0,0 +1,515 @@
+# -*- coding: utf-8 -*-
+"""
+catalog.py
+==========
+
+Header-only scanning of FITS and HDFITS files into a queryable SQLite catalog.
+
+Only headers are read: FITS headers are parsed with fitsio.parse_fits_header,
+and HDFITS headers are read from the HDU group attributes, with the HDU list
+taken from the HDU index and shapes and dtypes from the dataset metadata, so
+no datasets are read. For each HDU the catalog stores its name, position,
+class, shape and dtype, and every header keyword.
+
+Example
+-------
+
+    fits2hdf-catalog scan data/ -d catalog.db -r -j 8
+    fits2hdf-catalog query catalog.db "OBJECT=M31" "EXPTIME>300"
+"""
+
+import os
+import json
+import sqlite3
+import argparse
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+from astropy.io import fits as pf
+
+from .io.fitsio import parse_fits_header, restricted_header_keywords
+from .io.hdfio import read_hdu_index, restricted_hdf_keywords
+from .check_file_type import check_file_type
+from . import batch
+from .printlog import PrintLog
+
+DEFAULT_INCLUDE = ('*.fits', '*.fit', '*.fts', '*.h5', '*.hdf', '*.hdf5', '*.hdfits')
+
+# Storage dtypes of FITS images, by BITPIX
+BITPIX_DTYPES = {8: '|u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    format TEXT,
+    size INTEGER,
+    mtime REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS hdus (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER REFERENCES files(id) ON DELETE CASCADE,
+    position INTEGER,
+    name TEXT,
+    class TEXT,
+    shape TEXT,
+    dtype TEXT
+);
+CREATE TABLE IF NOT EXISTS keywords (
+    hdu_id INTEGER REFERENCES hdus(id) ON DELETE CASCADE,
+    keyword TEXT,
+    value TEXT,
+    number REAL,
+    comment TEXT
+);
+CREATE INDEX IF NOT EXISTS hdus_file ON hdus (file_id);
+CREATE INDEX IF NOT EXISTS keywords_hdu ON keywords (hdu_id);
+CREATE INDEX IF NOT EXISTS keywords_value ON keywords (keyword, value);
+CREATE INDEX IF NOT EXISTS keywords_number ON keywords (keyword, number);
+"""
+
+
+def _header_value(value):
+    """ Convert a header value (astropy or HDF5 attribute) to a plain Python value """
+    if isinstance(value, np.ndarray):
+        if value.size != 1:
+            return str(value.tolist())
+        value = value.reshape(-1)[0]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    if not isinstance(value, (bool, int, float, str)):
+        value = str(value)
+    return value
+
+
+def _keywords(header):
+    """ Return list of (keyword, value, comment) from a header dictionary, as made by
+    parse_fits_header or read from HDF5 attributes """
+    keywords = []
+    for key, value in header.items():
+        if key.endswith('_COMMENT'):
+            continue
+        comment = header.get(key + '_COMMENT', '')
+        keywords.append((key, _header_value(value), _header_value(comment)))
+    return keywords
+
+
+def _dtype_str(dtype, byteorder=None):
+    """ String form of a column dtype, with the shape of vector columns, e.g. (3,)>i4 """
+    base = dtype.base
+    if byteorder is not None and base.kind in 'biufc':
+        base = base.newbyteorder(byteorder)
+    if dtype.shape:
+        return "%s%s" % (dtype.shape, base.str)
+    return base.str
+
+
+def scan_fits(filename):
+    """ Read the headers of a FITS file, without reading any data
+
+    Parameters
+    ----------
+    filename: str
+        Path to FITS file
+
+    Returns
+    -------
+    hdus: list of dict
+        name, position, class, shape, dtype and keywords (list of
+        (keyword, value, comment)) of each HDU
+    """
+    hdus = []
+    with pf.open(filename) as ff:
+        for ii, hdu in enumerate(ff):
+            header, comment, history = parse_fits_header(hdu)
+            name = hdu.name if hdu.name not in ('', None, ' ') else "HDU%i" % ii
+            entry = {'name': name, 'position': ii + 1, 'keywords': _keywords(header)}
+            if isinstance(hdu, (pf.BinTableHDU, pf.TableHDU)) and not isinstance(hdu, pf.CompImageHDU):
+                entry['class'] = 'TABLE'
+                entry['shape'] = [hdu.header.get('NAXIS2', 0)]
+                # FITS tables are stored big-endian
+                entry['dtype'] = [[name, _dtype_str(hdu.columns.dtype[name], '>')]
+                                  for name in hdu.columns.names]
+            elif isinstance(hdu, pf.GroupsHDU):
+                entry['class'] = 'TABLE'
+                entry['shape'] = [hdu.header.get('GCOUNT', 0)]
+                entry['dtype'] = BITPIX_DTYPES.get(hdu.header.get('BITPIX'))
+            elif hdu.header.get('NAXIS', 0) == 0 and not isinstance(hdu, pf.CompImageHDU):
+                entry['class'] = 'PRIMARY'
+                entry['shape'] = None
+                entry['dtype'] = None
+            else:
+                entry['class'] = 'IMAGE'
+                entry['shape'] = list(hdu.shape)
+                bitpix = hdu.header.get('ZBITPIX', hdu.header.get('BITPIX'))
+                entry['dtype'] = BITPIX_DTYPES.get(bitpix)
+            hdus.append(entry)
+    return hdus
+
+
+def _hdf_dtype(dtype):
+    """ Return the dtype of HDF5 data as read_hdf returns it: fixed-width UTF-8
+    strings are decoded to unicode """
+    string_info = h5py.check_string_dtype(dtype.base)
+    if string_info is not None and string_info.encoding == 'utf-8' and string_info.length:
+        return np.dtype(('U%i' % dtype.base.itemsize, dtype.shape))
+    return dtype
+
+
+def _hdf_table(tbl_data, index_columns=None):
+    """ Return the number of rows, and [name, dtype] of each column, of an HDFITS
+    table from the dataset shapes and dtypes, without reading any data
+
+    Parameters
+    ----------
+    tbl_data: h5py Dataset or Group
+        TABLE compound dataset, or DATA_GROUP group
+    index_columns: list of dict or None
+        Columns of the HDU index entry (see hdfio.read_hdu_index), used for the
+        column order if they are the columns in the file. Otherwise the
+        COLUMN_ID attributes are read.
+    """
+    if isinstance(tbl_data, h5py.Dataset):
+        return tbl_data.shape[0], [[col_name, _dtype_str(_hdf_dtype(tbl_data.dtype[col_name]))]
+                                   for col_name in tbl_data.dtype.names]
+
+    col_dsets = dict(tbl_data.items())
+    if index_columns is not None and set(col["name"] for col in index_columns) == set(col_dsets):
+        col_ids = dict((col["name"], col["id"]) for col in index_columns)
+    else:
+        col_ids = dict((col_name, col_dset.attrs["COLUMN_ID"][0])
+                       for col_name, col_dset in col_dsets.items())
+
+    n_rows, dtypes = 0, []
+    for col_name in sorted(col_dsets, key=col_ids.get):
+        col_dset = col_dsets[col_name]
+        if isinstance(col_dset, h5py.Group):
+            # Variable-length array column: OFFSETS has one more entry than there are rows
+            n_rows = col_dset["OFFSETS"].shape[0] - 1
+            dtype = col_dset["VALUES"].dtype
+        else:
+            n_rows = col_dset.shape[0]
+            dtype = np.dtype((col_dset.dtype, col_dset.shape[1:]))
+        dtypes.append([col_name, _dtype_str(_hdf_dtype(dtype))])
+    return n_rows, dtypes
+
+
+def scan_hdf(filename):
+    """ Read the headers of an HDFITS file, without reading any data
+
+    HDUs are listed from the HDU index if there is one (see
+    hdfio.read_hdu_index), otherwise by scanning the groups. Shapes and
+    dtypes come from the dataset metadata.
+
+    Parameters
+    ----------
+    filename: str
+        Path to HDFITS file
+
+    Returns
+    -------
+    hdus: list of dict, see scan_fits
+    """
+    hdus = []
+    with h5py.File(filename, 'r') as h:
+        hdu_index = read_hdu_index(h)
+        if hdu_index is None:
+            hdu_index = [{"name": gname, "position": h[gname].attrs["POSITION"][0]}
+                         for gname in h.keys()]
+        hdu_index = sorted(hdu_index, key=lambda entry: entry["position"])
+
+        for ii, index_entry in enumerate(hdu_index):
+            name = index_entry["name"]
+            group = h[name]
+            header = dict((key, val) for key, val in group.attrs.items()
+                          if key not in restricted_hdf_keywords and key not in restricted_header_keywords)
+            entry = {'name': name, 'position': ii + 1, 'keywords': _keywords(header)}
+
+            hdu_class = index_entry.get("class")
+            if hdu_class is None:
+                if "DATA" not in group:
+                    hdu_class = "PRIMARY"
+                else:
+                    hdu_class = _header_value(np.atleast_1d(group["DATA"].attrs["CLASS"])[0])
+
+            if hdu_class in ("TABLE", "DATA_GROUP"):
+                entry['class'] = 'TABLE'
+                n_rows, entry['dtype'] = _hdf_table(group["DATA"], index_entry.get("columns"))
+                entry['shape'] = [n_rows]
+            elif hdu_class == "IMAGE":
+                entry['class'] = 'IMAGE'
+                entry['shape'] = list(group["DATA"].shape)
+                entry['dtype'] = _hdf_dtype(group["DATA"].dtype).str
+            else:
+                entry['class'] = 'PRIMARY'
+                entry['shape'] = None
+                entry['dtype'] = None
+            hdus.append(entry)
+    return hdus
+
+
+def scan_file(filename):
+    """ Scan the headers of a FITS or HDFITS file
+
+    Errors are caught, so this can be mapped over many files in a process pool.
+
+    Returns
+    -------
+    result: dict
+        path, format ('fits' or 'hdf'), size, mtime, error (None if the file
+        was read) and hdus (see scan_fits)
+    """
+    result = {'path': os.path.abspath(filename), 'format': None, 'size': None,
+              'mtime': None, 'error': None, 'hdus': []}
+    try:
+        stat = os.stat(filename)
+        result['size'], result['mtime'] = stat.st_size, stat.st_mtime
+        result['format'] = check_file_type(filename)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            if result['format'] == 'fits':
+                result['hdus'] = scan_fits(filename)
+            elif result['format'] == 'hdf':
+                result['hdus'] = scan_hdf(filename)
+            else:
+                raise RuntimeError("Unknown file type")
+    except Exception as e:
+        result['error'] = "%s: %s" % (e.__class__.__name__, e)
+    return result
+
+
+class Catalog(object):
+    """ SQLite catalog of file headers
+
+    Parameters
+    ----------
+    filename: str
+        SQLite database file, created if it doesn't exist
+    """
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def is_up_to_date(self, path):
+        """ Check if a file is in the catalog, with the same size and mtime as on disk """
+        row = self.db.execute("SELECT size, mtime FROM files WHERE path = ? AND error IS NULL",
+                              (os.path.abspath(path), )).fetchone()
+        if row is None:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return row[0] == stat.st_size and row[1] == stat.st_mtime
+
+    def add(self, result):
+        """ Add (or replace) the entries for a file, from the output of scan_file """
+        self.db.execute("DELETE FROM files WHERE path = ?", (result['path'], ))
+        cur = self.db.execute("INSERT INTO files (path, format, size, mtime, error) VALUES (?, ?, ?, ?, ?)",
+                              (result['path'], result['format'], result['size'], result['mtime'],
+                               result['error']))
+        file_id = cur.lastrowid
+        for hdu in result['hdus']:
+            cur = self.db.execute("INSERT INTO hdus (file_id, position, name, class, shape, dtype) "
+                                  "VALUES (?, ?, ?, ?, ?, ?)",
+                                  (file_id, hdu['position'], hdu['name'], hdu['class'],
+                                   json.dumps(hdu['shape']), json.dumps(hdu['dtype'])))
+            hdu_id = cur.lastrowid
+            # EXTNAME isn't kept in the parsed headers, so add the HDU name for queries
+            rows = [(hdu_id, 'EXTNAME', hdu['name'], None, '')]
+            for key, value, comment in hdu['keywords']:
+                number = None
+                if isinstance(value, bool):
+                    number, value = float(value), 'T' if value else 'F'
+                elif isinstance(value, (int, float)):
+                    number = float(value)
+                rows.append((hdu_id, key, str(value), number, comment))
+            self.db.executemany("INSERT INTO keywords (hdu_id, keyword, value, number, comment) "
+                                "VALUES (?, ?, ?, ?, ?)", rows)
+
+    def query(self, conditions, same_hdu=False):
+        """ Find files (or HDUs) whose headers match all conditions
+
+        Parameters
+        ----------
+        conditions: list of str
+            Conditions of the form KEYWORD<op>VALUE, where op is one of =, !=,
+            <, <=, >, >=. Numeric values are compared as numbers; strings are
+            compared exactly, or with = and != as a glob pattern if they contain
+            * or ?. Booleans are T or F. EXTNAME matches the HDU name.
+        same_hdu: bool
+            If True, all conditions must match in the same HDU. Otherwise each
+            condition can match in any HDU of the file.
+
+        Returns
+        -------
+        matches: list of (path, hdu name)
+            hdu name is None unless same_hdu is True
+        """
+        clauses, params = [], []
+        for condition in conditions:
+            clause, args = _parse_condition(condition)
+            clauses.append(clause)
+            params.extend(args)
+
+        if same_hdu:
+            sql = ("SELECT files.path, hdus.name FROM hdus JOIN files ON files.id = hdus.file_id "
+                   "WHERE files.error IS NULL")
+            for clause in clauses:
+                sql += " AND hdus.id IN (SELECT hdu_id FROM keywords WHERE %s)" % clause
+            sql += " ORDER BY files.path, hdus.position"
+        else:
+            sql = "SELECT path, NULL FROM files WHERE error IS NULL"
+            for clause in clauses:
+                sql += (" AND id IN (SELECT hdus.file_id FROM keywords JOIN hdus ON hdus.id = keywords.hdu_id "
+                        "WHERE %s)" % clause)
+            sql += " ORDER BY path"
+        return self.db.execute(sql, params).fetchall()
+
+
+OPERATORS = ('>=', '<=', '!=', '=', '>', '<')
+
+
+def _parse_condition(condition):
+    """ Convert a KEYWORD<op>VALUE condition to an SQL clause on the keywords table """
+    for op in OPERATORS:
+        if op in condition:
+            keyword, value = condition.split(op, 1)
+            break
+    else:
+        raise ValueError("Cannot parse condition %s, expected KEYWORD<op>VALUE with op one of %s"
+                         % (condition, ', '.join(OPERATORS)))
+    keyword, value = keyword.strip().upper(), value.strip().strip("'\"")
+
+    try:
+        return "keyword = ? AND number %s ?" % op, [keyword, float(value)]
+    except ValueError:
+        pass
+    if op in ('=', '!=') and ('*' in value or '?' in value):
+        return "keyword = ? AND value %s ?" % ('GLOB' if op == '=' else 'NOT GLOB'), [keyword, value]
+    return "keyword = ? AND value %s ?" % op, [keyword, value]
+
+
+def build_catalog(catalog, files, jobs=1, incremental=True):
+    """ Scan files and add them to a catalog, yielding the result for each file
+
+    Parameters
+    ----------
+    catalog: Catalog
+        Catalog to add to
+    files: iterable of str
+        Files to scan
+    jobs: int
+        Number of worker processes
+    incremental: bool
+        Skip files that are already in the catalog and unchanged on disk
+    """
+    if incremental:
+        files = (f for f in files if not catalog.is_up_to_date(f))
+
+    if jobs > 1:
+        pool = ProcessPoolExecutor(max_workers=jobs)
+        results = pool.map(scan_file, files, chunksize=16)
+    else:
+        pool = None
+        results = map(scan_file, files)
+
+    try:
+        for ii, result in enumerate(results):
+            catalog.add(result)
+            if ii % 1000 == 999:
+                catalog.db.commit()
+            yield result
+    finally:
+        catalog.db.commit()
+        if pool is not None:
+            pool.shutdown()
+
+
+def catalog_cli(args=None):
+    """ Build and query a catalog of FITS / HDFITS headers """
+    parser = argparse.ArgumentParser(description='Catalog the headers of FITS and HDFITS files, and query them.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    scan = subparsers.add_parser('scan', help='Scan the headers of files in a directory into a catalog')
+    scan.add_argument('dir_in', help='input directory')
+    scan.add_argument('-d', '--database', dest='database', default='fits2hdf_catalog.db',
+                      help='SQLite catalog file. Defaults to fits2hdf_catalog.db')
+    scan.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                      help='Number of files to scan in parallel. Defaults to 1')
+    scan.add_argument('-f', '--full', dest='incremental', action='store_false', default=True,
+                      help='Rescan all files, not only new or changed ones')
+    scan.add_argument('-v', '--verbosity', dest='verbosity', type=int, default=4,
+                      help='verbosity level (default 4, up to 5)')
+    batch_args = scan.add_argument_group('file discovery')
+    batch_args.add_argument('-r', '--recursive', dest='recursive', action='store_true', default=False,
+                            help='Search subdirectories of the input directory')
+    batch_args.add_argument('--include', dest='include', action='append', default=None,
+                            help='Only scan files with names matching this glob (can be repeated). '
+                                 'Defaults to FITS and HDF5 extensions')
+    batch_args.add_argument('--exclude', dest='exclude', action='append', default=[],
+                            help='Skip files and directories matching this glob (can be repeated)')
+
+    query = subparsers.add_parser('query', help='Find files whose headers match conditions')
+    query.add_argument('database', help='SQLite catalog file')
+    query.add_argument('conditions', nargs='+',
+                       help='Conditions such as OBJECT=M31, EXPTIME>300 or OBJECT=NGC*')
+    query.add_argument('-s', '--same-hdu', dest='same_hdu', action='store_true', default=False,
+                       help='Require all conditions to match in the same HDU, and list the HDUs')
+
+    args = parser.parse_args(args)
+
+    if args.command == 'scan':
+        pp = PrintLog(verbosity=args.verbosity)
+        pp.h1("FITS2HDF CATALOG")
+        pp.pa("Input directory: %s" % args.dir_in)
+        pp.pa("Catalog:         %s" % args.database)
+        include = args.include or DEFAULT_INCLUDE
+        files = (os.path.join(args.dir_in, rel_path)
+                 for rel_path in batch.find_files(args.dir_in, include, args.exclude, args.recursive))
+
+        catalog = Catalog(args.database)
+        n_files, n_errors = 0, 0
+        try:
+            for result in build_catalog(catalog, files, args.jobs, args.incremental):
+                n_files += 1
+                if result['error'] is not None:
+                    n_errors += 1
+                    pp.err("Cannot read %s (%s)" % (result['path'], result['error']))
+                else:
+                    pp.pp("Scanned %s: %i HDUs" % (result['path'], len(result['hdus'])))
+        finally:
+            catalog.close()
+
+        pp.h1("\nSUMMARY")
+        pp.pa("Files scanned: %i" % n_files)
+        pp.pa("Errors:        %i" % n_errors)
+
+    elif args.command == 'query':
+        if not os.path.exists(args.database):
+            parser.error("Catalog %s does not exist" % args.database)
+        catalog = Catalog(args.database)
+        try:
+            matches = catalog.query(args.conditions, args.same_hdu)
+        except ValueError as e:
+            parser.error(str(e))
+        finally:
+            catalog.close()
+        for path, hdu_name in matches:
+            if hdu_name is None:
+                print(path)
+            else:
+                print("%s[%s]" % (path, hdu_name))
+
+    else:
+        parser.print_help()
@@ -9,6 +9,7 @@ an in-memory data structure, then converts this to a HDF5 file.
 """
 
 import os
+import json
 import time
 import warnings
 
@@ -17,9 +18,200 @@ from fits2hdf.io.fitsio import *
 from fits2hdf.io.hdfio import *
 
 from fits2hdf.printlog import PrintLog
+from fits2hdf import batch
+from fits2hdf import tracing
 
 import argparse
 
+# Number of files found at a time, which are then converted largest first
+SCHEDULE_WINDOW = 1000
+
+
+def fits_to_hdf(file_in, file_out, max_memory=None, memmap=None, metrics=False, **kwargs):
+    """ Convert a single FITS file to HDF5, streaming one HDU at a time
+
+    memmap is passed to fitsio.iter_fits. If True, the FITS file is memory
+    mapped, unscaled images are written straight from the mapping whatever
+    their size, and scaled images are scaled block by block.
+
+    If metrics is True, returns a dictionary with read_time (reading FITS
+    and converting to IDI), write_time (compressing and writing HDF5), and
+    per-HDU timings and sizes under "hdus" (see hdfio.export_hdu). Images
+    larger than max_memory are read while they are written, so their read
+    time is counted in write_time.
+    """
+    hdus = iter_fits(file_in, max_memory=max_memory, memmap=memmap)
+    if not metrics:
+        export_hdf_stream(hdus, file_out, max_memory=max_memory, **kwargs)
+        return None
+
+    read_times = []
+    def timed(hdus):
+        while True:
+            t1 = time.time()
+            try:
+                hdu = next(hdus)
+            except StopIteration:
+                return
+            read_times.append(time.time() - t1)
+            yield hdu
+
+    hdu_metrics = []
+    export_hdf_stream(timed(hdus), file_out, max_memory=max_memory, metrics=hdu_metrics, **kwargs)
+    for hdu_metric, read_time in zip(hdu_metrics, read_times):
+        hdu_metric['read_time'] = read_time
+    return {'read_time': sum(read_times),
+            'write_time': sum(m['write_time'] for m in hdu_metrics),
+            'hdus': hdu_metrics}
+
+
+def _read_and_export_fits(read_func, file_in, file_out, metrics=False, **kwargs):
+    t1 = time.time()
+    hdul = read_func(file_in)
+    t2 = time.time()
+    export_fits(hdul, file_out, **kwargs)
+    if metrics:
+        return {'read_time': t2 - t1, 'write_time': time.time() - t2}
+
+
+def hdf_to_fits(file_in, file_out, **kwargs):
+    """ Convert a single HDFITS file to FITS. Returns read/write times if metrics=True """
+    return _read_and_export_fits(read_hdf, file_in, file_out, **kwargs)
+
+
+def fits_to_fits(file_in, file_out, **kwargs):
+    """ Read a FITS file into IDI format, then write it back out to FITS. Returns
+    read/write times if metrics=True """
+    return _read_and_export_fits(read_fits, file_in, file_out, **kwargs)
+
+
+def add_diagnostic_arguments(parser):
+    """ Add the command line options for metrics, tracing and profiling to an ArgumentParser """
+    parser.add_argument('--metrics', dest='metrics', type=str, default=None,
+                        help='Write a JSON line of timings, sizes and peak memory for each file to this file')
+    parser.add_argument('--trace', dest='trace', type=str, default=None,
+                        help='Write timing spans for each stage and HDU to this Chrome trace (JSON) file')
+    parser.add_argument('--profile', dest='profile', action='store_true', default=False,
+                        help='Profile each file with cProfile, writing stats to OUTPUT%s' % batch.PSTATS_SUFFIX)
+
+
+def run_cli_batch(pp, func, tasks, args, time_label, manifest=None, **kwargs):
+    """ Convert files for the CLIs, printing results and writing metrics and traces
+
+    Parameters
+    ----------
+    pp: PrintLog
+        Logger for results
+    func: function
+        Conversion function, see batch.run_batch
+    tasks: iterable of (str, str)
+        (input file, output file) pairs, e.g. from iter_tasks
+    args: argparse.Namespace
+        Parsed command line options (jobs, metrics, trace, profile)
+    time_label: str or None
+        Label for conversion time in results, see print_result
+    manifest: batch.Manifest or None
+        Manifest for incremental conversion
+
+    Returns
+    -------
+    file_count: int
+        Number of files converted successfully
+    """
+    metrics_file = None
+    if args.metrics is not None:
+        metrics_file = open(args.metrics, 'a')
+    trace_writer = None
+    if args.trace is not None:
+        trace_writer = tracing.ChromeTraceWriter(args.trace)
+
+    file_count = 0
+    tasks = batch.sort_largest_first(tasks, window=SCHEDULE_WINDOW)
+    try:
+        for result in batch.run_batch(func, tasks, jobs=args.jobs, manifest=manifest,
+                                      trace=trace_writer is not None, profile=args.profile,
+                                      metrics=metrics_file is not None, **kwargs):
+            print_result(pp, result, time_label)
+            if metrics_file is not None:
+                metrics_file.write(json.dumps(batch.metrics_record(result)) + '\n')
+                metrics_file.flush()
+            if trace_writer is not None:
+                trace_writer.write(result.get('trace'))
+            if result['error'] is None:
+                file_count += 1
+    finally:
+        if metrics_file is not None:
+            metrics_file.close()
+        if trace_writer is not None:
+            trace_writer.close()
+    return file_count
+
+
+def print_result(pp, result, time_label="Comp/write time"):
+    """ Print the outcome of converting a file, see batch.convert_file """
+    pp.pp("\nReading  %s" % result['file_in'])
+    if result['error'] is not None:
+        pp.err("Cannot convert %s (%s)" % (result['file_in'], result['error']))
+        pp.debug(result.get('traceback', ''))
+        return
+    pp.pp("Creating %s" % result['file_out'])
+    pp.pp("Input  filesize: %sB" % result['size_in'])
+    pp.pp("Output filesize: %sB" % result['size_out'])
+    compfact = float(result['size_in']) / float(result['size_out'])
+    pp.pp("Compression:     %2.2fx" % compfact)
+    if time_label is not None:
+        pp.pp("%s: %2.2fs" % (time_label, result['time']))
+
+
+def add_discovery_arguments(parser):
+    """ Add the command line options for finding input files to an ArgumentParser """
+    parser.add_argument('-r', '--recursive', dest='recursive', action='store_true', default=False,
+                        help='Search subdirectories of the input directory, mirroring them in the output')
+    parser.add_argument('--include', dest='include', action='append', default=None,
+                        help='Only convert files with names matching this glob (can be repeated). '
+                             'Defaults to *EXT')
+    parser.add_argument('--exclude', dest='exclude', action='append', default=[],
+                        help='Skip files and directories matching this glob (can be repeated)')
+
+
+def iter_tasks(args, dir_in, dir_out, out_ext=None):
+    """ Yield (input file, output file) pairs for the conversion CLIs, as files are found
+
+    Output files mirror the directory structure under dir_in. If out_ext is
+    given, the input extension (args.ext) is replaced with it.
+    """
+    include = args.include or ['*' + args.ext]
+    for rel_path in batch.find_files(dir_in, include, args.exclude, args.recursive,
+                                     skip_dirs=[dir_out]):
+        rel_out = rel_path
+        if out_ext is not None:
+            # Only strip a trailing extension: directory names may contain it too
+            if rel_out.endswith('.' + args.ext):
+                rel_out = rel_out[:-len('.' + args.ext)]
+            rel_out += out_ext
+        yield os.path.join(dir_in, rel_path), os.path.join(dir_out, rel_out)
+
+
+def add_incremental_arguments(parser):
+    """ Add the command line options for incremental conversion to an ArgumentParser """
+    parser.add_argument('-i', '--incremental', dest='incremental', action='store_true', default=False,
+                        help='Only convert files that have changed since they were last converted')
+    parser.add_argument('--manifest', dest='manifest', type=str, default=None,
+                        help='Manifest file used by --incremental. Defaults to %s in the '
+                             'output directory' % batch.MANIFEST_NAME)
+
+
+def open_manifest(args, dir_out, converter, options):
+    """ Open the manifest for incremental conversion, or return None if not enabled """
+    if not args.incremental:
+        return None
+    filename = args.manifest
+    if filename is None:
+        filename = os.path.join(dir_out, batch.MANIFEST_NAME)
+    options = dict(options, converter=converter)
+    return batch.Manifest(filename, options)
+
+
 def convert_fits_to_hdf(args=None):
     """ Convert a FITS file to HDF5 in HDFITS format
 
@@ -43,6 +235,22 @@ def convert_fits_to_hdf(args=None):
                         help='Set output tables to be PyTables TABLE class, instead of HDFITES DATA_GROUP')
     parser.add_argument('-C', '--checksum', dest='checksum', action='store_true', default=None,
                         help='Compute fletcher32 checksum on datasets.')
+    parser.add_argument('-m', '--max-memory', dest='max_memory', type=int, default=256,
+                        help='Memory budget in MB. Larger images are converted block by block. Defaults to 256')
+    parser.add_argument('-B', '--byteorder', dest='byteorder', default='source',
+                        choices=['source', 'native', 'little', 'big'],
+                        help='Byte order of numeric datasets. Defaults to source (big-endian for FITS, '
+                             'with no byteswap)')
+    parser.add_argument('-M', '--memmap', dest='memmap', action='store_true', default=False,
+                        help='Memory map FITS files, and write images straight from the mapping '
+                             'whatever --max-memory; scaled images are scaled block by block')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+                        help='Number of threads used for gzip compression. Defaults to 1')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Number of files to convert in parallel. Defaults to 1')
+    add_discovery_arguments(parser)
+    add_diagnostic_arguments(parser)
+    add_incremental_arguments(parser)
     parser.add_argument('dir_in', help='input directory')
     parser.add_argument('dir_out', help='output_directory')
 
@@ -69,6 +277,13 @@ def convert_fits_to_hdf(args=None):
        kwargs['table_type'] = 'TABLE'
     else:
         kwargs['table_type'] = 'DATA_GROUP'
+    kwargs['max_memory'] = args.max_memory * 2**20
+    if args.workers > 1:
+        kwargs['workers'] = args.workers
+    if args.byteorder != 'source':
+        kwargs['byteorder'] = {'native': '=', 'little': '<', 'big': '>'}[args.byteorder]
+    if args.memmap:
+        kwargs['memmap'] = True
 
     pp = PrintLog(verbosity=args.verbosity)
     if args.verbosity == 0:
@@ -81,37 +296,24 @@ def convert_fits_to_hdf(args=None):
     for key, val in kwargs.items():
         pp.pa("%16s: %s" % (key, val))
 
-    # Create list of files to process
-    filelist = os.listdir(dir_in)
-    filelist = [fn for fn in filelist if fn.endswith(args.ext)]
+    # Files are converted as they are found
+    tasks = iter_tasks(args, dir_in, dir_out, '.h5')
 
-    t_start = time.time()
-    file_count = 0
-    for filename in filelist:
-        file_in = os.path.join(dir_in, filename)
-        file_out = os.path.join(dir_out, filename.split('.' + args.ext)[0] + '.h5')
-
-        a = IdiHdulist()
-        try:
-            pp.pp("\nReading  %s" % file_in)
-            a = read_fits(file_in)
-            pp.pp("Creating %s" % file_out)
-            t1 = time.time()
-            export_hdf(a, file_out, **kwargs)
-            t2 = time.time()
-            pp.pp("Input  filesize: %sB" % os.path.getsize(file_in))
-            pp.pp("Output filesize: %sB" % os.path.getsize(file_out))
-            compfact = float(os.path.getsize(file_in)) / float(os.path.getsize(file_out))
-            pp.pp("Compression:     %2.2fx" % compfact)
-            pp.pp("Comp/write time: %2.2fs" % (t2 - t1))
+    # Options that don't change the output don't invalidate the manifest
+    options = dict((key, val) for key, val in kwargs.items()
+                   if key not in ('max_memory', 'workers', 'memmap'))
+    manifest = open_manifest(args, dir_out, 'fits2hdf', options)
 
-            file_count += 1
-
-        except IOError:
-            pp.err("ERROR: Cannot load %s" % file_in)
+    t_start = time.time()
+    # Stream HDUs from FITS to HDF5 one at a time, to bound memory use
+    file_count = run_cli_batch(pp, fits_to_hdf, tasks, args, "Read/comp/write time",
+                               manifest=manifest, **kwargs)
 
     pp.h1("\nSUMMARY")
     pp.pa("Files created: %i" % file_count)
+    if manifest is not None:
+        pp.pa("Files skipped: %i (up to date)" % manifest.n_skipped)
+        manifest.close()
     pp.pa("Time taken:    %2.2fs" % (time.time() - t_start))
 
 
@@ -128,6 +330,11 @@ def convert_hdf_to_fits(args=None):
                         help='File extension of HDFITS files. Defaults to .h5')
     parser.add_argument('-v', '--verbosity', dest='verbosity', type=int, default=4,
                         help='verbosity level (default 0, up to 5)')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Number of files to convert in parallel. Defaults to 1')
+    add_discovery_arguments(parser)
+    add_diagnostic_arguments(parser)
+    add_incremental_arguments(parser)
     parser.add_argument('dir_in', help='input directory')
     parser.add_argument('dir_out', help='output_directory')
     args = parser.parse_args()
@@ -153,37 +360,20 @@ def convert_hdf_to_fits(args=None):
     for key, val in kwargs.items():
         pp.pa("%16s: %s" % (key, val))
 
-    # Create list of files to process
-    filelist = os.listdir(dir_in)
-    filelist = [fn for fn in filelist if fn.endswith(args.ext)]
-
-    t_start = time.time()
-    file_count = 0
-    for filename in filelist:
-        file_in = os.path.join(dir_in, filename)
-        file_out = os.path.join(dir_out, filename.split('.' + args.ext)[0] + '.fits')
-
-        a = IdiHdulist()
-        try:
-            pp.pp("\nReading  %s" % file_in)
-            a = read_hdf(file_in)
-            pp.pp("Creating %s" % file_out)
-            t1 = time.time()
-            export_fits(a, file_out, **kwargs)
-            t2 = time.time()
-            pp.pp("Input  filesize: %sB" % os.path.getsize(file_in))
-            pp.pp("Output filesize: %sB" % os.path.getsize(file_out))
-            compfact = float(os.path.getsize(file_in)) / float(os.path.getsize(file_out))
-            pp.pp("Compression:     %2.2fx" % compfact)
-            pp.pp("Comp/write time: %2.2fs" % (t2 - t1))
+    # Files are converted as they are found
+    tasks = iter_tasks(args, dir_in, dir_out, '.fits')
 
-            file_count += 1
+    manifest = open_manifest(args, dir_out, 'hdf2fits', kwargs)
 
-        except IOError:
-            pp.err("ERROR: Cannot load %s" % file_in)
+    t_start = time.time()
+    file_count = run_cli_batch(pp, hdf_to_fits, tasks, args, "Read/comp/write time",
+                               manifest=manifest, **kwargs)
 
     pp.h1("\nSUMMARY")
     pp.pa("Files created: %i" % file_count)
+    if manifest is not None:
+        pp.pa("Files skipped: %i (up to date)" % manifest.n_skipped)
+        manifest.close()
     pp.pa("Time taken:    %2.2fs" % (time.time() - t_start))
 
 
@@ -204,6 +394,10 @@ def convert_fits_to_fits(args=None):
                       help='Turn off warnings created by FITS parsing')
     parser.add_argument('-o', '--overwrite', dest='overwrite', action='store_true', default=False,
                       help='Automatically overwrite output files if already exist')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                      help='Number of files to convert in parallel. Defaults to 1')
+    add_discovery_arguments(parser)
+    add_diagnostic_arguments(parser)
     parser.add_argument('dir_in', help='input directory')
     parser.add_argument('dir_out', help='output_directory')
 
@@ -223,40 +417,19 @@ def convert_fits_to_fits(args=None):
     if dir_in == dir_out:
         raise ValueError("Input directory cannot be same as output directory.")
 
-    # Create list of files to process
-    filelist = os.listdir(dir_in)
-    filelist = [fn for fn in filelist if fn.endswith(args.ext)]
-
+    # Ask about existing output files before they are queued, as workers can't prompt
+    def confirmed_tasks():
+        for file_in, file_out in iter_tasks(args, dir_in, dir_out):
+            if os.path.exists(file_out) and not args.overwrite:
+                qn = input("%s exists. Overwrite (y/n)?" % file_out)
+                if qn not in ["y", "Y", "yes"]:
+                    continue
+            yield file_in, file_out
+    tasks = confirmed_tasks()
+
+    pp = PrintLog(verbosity=4)
     t1 = time.time()
-    file_count = 0
-    for filename in filelist:
-
-
-        file_in = os.path.join(dir_in, filename)
-        file_out = os.path.join(dir_out, filename)
-
-        a = IdiHdulist()
-        try:
-            a = read_fits(file_in)
-            if os.path.exists(file_out):
-                if args.overwrite:
-                    os.remove(file_out)
-                else:
-                    qn = raw_input("%s exists. Overwrite (y/n)?" % file_out)
-                    if qn in ["y", "Y", "yes"]:
-                        os.remove(file_out)
-
-            print("\nCreating %s" % file_out)
-            export_fits(a, file_out)
-            print("Input  filesize: %sB" % os.path.getsize(file_in))
-            print("Output filesize: %sB" % os.path.getsize(file_out))
-            compfact = float(os.path.getsize(file_in)) / float(os.path.getsize(file_out))
-            print("Compression:     %2.2fx" % compfact)
-
-            file_count += 1
-
-        except IOError:
-            print("ERROR: Cannot read/write %s" % file_in)
+    file_count = run_cli_batch(pp, fits_to_fits, tasks, args, None)
 
     print("\nSUMMARY")
     print("-------")
@@ -14,6 +14,8 @@ import numpy as np
 import six
 from astropy.table import Table, Column, MaskedColumn
 from astropy.nddata import NDData
+from astropy.units import Unit
+from astropy.utils.data_info import ParentDtypeInfo
 from collections import OrderedDict
 
 
@@ -275,17 +277,366 @@ class IdiColumn(Column):
 
     def __new__(cls, name, data=None,
                 dtype=None, shape=(), length=0,
-                description=None, unit=None, format=None, meta=None, copy=False):
+                description=None, unit=None, format=None, meta=None, copy=False,
+                **kwargs):
 
         if isinstance(data, MaskedColumn) and np.any(data.mask):
             raise TypeError("Cannot convert a MaskedColumn with masked value to a Column")
 
+        # Table passes extra keywords (e.g. copy_indices) when adding columns
         self = super(IdiColumn, cls).__new__(cls, data=data, name=name, dtype=dtype,
                                              shape=shape, length=length, description=description,
-                                             unit=unit, format=format, meta=meta)
+                                             unit=unit, format=format, meta=meta, copy=copy,
+                                             **kwargs)
         return self
 
 
+def _is_utf8(dtype):
+    """ Check for a fixed-width UTF-8 string dtype, as read by h5py """
+    return dtype.kind == 'S' and (dtype.metadata or {}).get('h5py_encoding') == 'utf-8'
+
+
+def _decoded_dtype(dtype):
+    """ Return dtype with fixed-width UTF-8 strings (and fields) replaced by unicode """
+    if dtype.names is not None:
+        return np.dtype([(name, _decoded_dtype(dtype.fields[name][0])) for name in dtype.names])
+    if dtype.subdtype is not None:
+        return np.dtype((_decoded_dtype(dtype.base), dtype.shape))
+    if _is_utf8(dtype):
+        return np.dtype('U%i' % dtype.itemsize)
+    return dtype
+
+
+def decode_utf8(data):
+    """ Decode fixed-width UTF-8 strings, including fields of structured arrays,
+    into unicode. Other data are returned as-is. """
+    dtype = _decoded_dtype(data.dtype)
+    if dtype == data.dtype:
+        return data
+    if data.dtype.names is None:
+        codes = np.ascontiguousarray(data).reshape(-1).view(np.uint8)
+        if not np.any(codes >= 0x80):
+            # ASCII: each byte is one character, so no need to decode string by string
+            return codes.astype('=u4').view(dtype).reshape(data.shape)
+        return np.char.decode(data, 'utf-8').astype(dtype)
+    decoded = np.empty(data.shape, dtype=dtype)
+    for name in data.dtype.names:
+        decoded[name] = decode_utf8(data[name])
+    return decoded
+
+
+class IdiLazyArray(object):
+    """ Read-on-demand view of an array stored on disk
+
+    This wraps an h5py-like dataset (anything with shape, dtype and
+    __getitem__), and only reads the slices that are actually indexed.
+    Converting to a numpy array (np.asarray) reads the whole dataset.
+
+    Parameters
+    ----------
+    dataset: h5py.Dataset or equivalent
+        Dataset to read from. This must stay open for the lifetime of the view.
+    field: str, list of str, or None
+        For compound (row-store) datasets, the name of the field to read.
+        If a list of names is given, a compound array of those fields is read.
+    """
+    def __init__(self, dataset, field=None):
+        self._dataset = dataset
+        self._field = field
+
+    @property
+    def _multi_field(self):
+        return isinstance(self._field, (list, tuple))
+
+    @property
+    def shape(self):
+        if self._field is None or self._multi_field:
+            return self._dataset.shape
+        return self._dataset.shape + self._dataset.dtype.fields[self._field][0].shape
+
+    @property
+    def _raw_dtype(self):
+        """ dtype of the data as stored """
+        if self._field is None:
+            return self._dataset.dtype
+        if self._multi_field:
+            return np.dtype([(name, self._dataset.dtype.fields[name][0]) for name in self._field])
+        return self._dataset.dtype.fields[self._field][0].base
+
+    @property
+    def dtype(self):
+        # Fixed-width UTF-8 strings are decoded into unicode as they are read
+        return _decoded_dtype(self._raw_dtype)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return "<%s shape=%s dtype=%s>" % (self.__class__.__name__, self.shape, self.dtype)
+
+    def __getitem__(self, item):
+        return self._read(item)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.read()
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+    def _select(self, sel):
+        """ Read a selection that h5py can handle directly """
+        data = self._select_raw(sel)
+        raw_dtype = self._raw_dtype
+        if _decoded_dtype(raw_dtype) == raw_dtype:
+            return data
+        if isinstance(data, np.ndarray):
+            return decode_utf8(data)
+        # Scalars don't keep the UTF-8 flag of the dataset dtype
+        return decode_utf8(np.asarray(data, dtype=raw_dtype))[()]
+
+    def _select_raw(self, sel):
+        if self._field is None:
+            return self._dataset[sel]
+        if self._multi_field:
+            data = self._dataset[sel + tuple(self._field)]
+            if data.dtype.fields is None:
+                # h5py returns a plain array when a single field is selected
+                field_data = data
+                n_rows_dim = field_data.ndim - len(self._raw_dtype[0].shape)
+                data = np.empty(field_data.shape[:n_rows_dim], dtype=self._raw_dtype)
+                data[self._field[0]] = field_data
+            return data
+
+        # h5py cannot index into the sub-array of a compound field, so split
+        # the selection into dataset axes and field axes
+        ds_ndim = len(self._dataset.shape)
+        ds_sel, sub_sel = sel[:ds_ndim], sel[ds_ndim:]
+        data = self._dataset[ds_sel + (self._field, )]
+        if sub_sel:
+            n_kept = len([s for s in ds_sel if not isinstance(s, (six.integer_types, np.integer))])
+            n_kept += ds_ndim - len(ds_sel)
+            data = data[(slice(None), ) * n_kept + sub_sel]
+        return data
+
+    def _read(self, item):
+        """ Read a selection, working around h5py fancy-indexing restrictions
+
+        h5py only accepts increasing, unique index lists, so boolean masks and
+        arbitrary index arrays along the first axis are sorted, read once and
+        then reordered in memory.
+        """
+        if not isinstance(item, tuple):
+            item = (item, )
+        first, rest = item[0], item[1:]
+
+        if isinstance(first, (slice, type(Ellipsis), six.integer_types, np.integer)):
+            return self._select(item)
+
+        idx = np.asarray(first)
+        if idx.dtype == np.bool_:
+            idx = np.flatnonzero(idx)
+        elif idx.ndim == 0:
+            return self._select((int(idx), ) + rest)
+        idx = np.where(idx < 0, idx + len(self), idx)
+
+        if idx.size == 0:
+            empty = np.empty((0, ) + self.shape[1:], dtype=self.dtype)
+            return empty[(slice(None), ) + rest]
+
+        uniq, inverse = np.unique(idx, return_inverse=True)
+        data = self._select((uniq, ) + rest)
+        if uniq.size == idx.size and np.all(uniq == idx):
+            return data
+        return data[inverse.ravel()]
+
+    def read(self):
+        """ Read the whole dataset into memory """
+        return self._select(())
+
+
+class IdiLazyColumn(IdiLazyArray):
+    """ Read-on-demand table column
+
+    An IdiLazyArray that can be added to an IdiTableHdu as a mixin column.
+    Indexing with a slice or mask returns an in-memory IdiColumn; the
+    data attribute reads the whole column.
+
+    Parameters
+    ----------
+    name: str
+        Name of column
+    dataset: h5py.Dataset or equivalent
+        Dataset to read column data from
+    unit: str or None
+        Physical unit
+    field: str or None
+        For compound (row-store) datasets, the name of the field to read.
+    """
+    info = ParentDtypeInfo()
+
+    def __init__(self, name, dataset, unit=None, field=None):
+        super(IdiLazyColumn, self).__init__(dataset, field=field)
+        self.info.name = name
+        if unit is not None:
+            unit = Unit(unit, parse_strict='silent')
+        self.unit = unit
+
+    @property
+    def name(self):
+        return self.info.name
+
+    @property
+    def data(self):
+        return self.read()
+
+    def __getitem__(self, item):
+        # Table takes a full slice of mixin columns to get a new instance
+        # without copying, so keep that lazy
+        if isinstance(item, slice) and item == slice(None):
+            return self.copy()
+        data = self._read(item)
+        if isinstance(item, (six.integer_types, np.integer)):
+            return data
+        return IdiColumn(self.name, data, unit=self.unit)
+
+    def copy(self):
+        """ Return a new view of the same dataset (the data are read-only) """
+        return self.__class__(self.name, self._dataset, unit=self.unit, field=self._field)
+
+
+class IdiVarColumn(object):
+    """ Variable-length array column, e.g. a FITS P / Q (heap) column
+
+    The rows are stored as a single flat array of values, plus an array of
+    n_rows + 1 offsets into it: row i is values[offsets[i]:offsets[i+1]].
+    This can be added to an IdiTableHdu as a mixin column. Indexing with an
+    integer returns the row as a numpy array; indexing with a slice, mask or
+    index array returns a new IdiVarColumn.
+
+    Parameters
+    ----------
+    name: str
+        Name of column
+    values: numpy array or array-like (e.g. IdiLazyArray)
+        Flat array of the values of all rows, in row order
+    offsets: numpy array of int
+        Start of each row in values, plus the end of the last row
+    unit: str or None
+        Physical unit
+    """
+    info = ParentDtypeInfo()
+
+    def __init__(self, name, values, offsets, unit=None):
+        self.info.name = name
+        self.values = values
+        self.offsets = np.asarray(offsets, dtype='int64')
+        if unit is not None and not isinstance(unit, Unit):
+            unit = Unit(unit, parse_strict='silent')
+        self.unit = unit
+
+    @classmethod
+    def from_rows(cls, name, rows, unit=None, dtype=None):
+        """ Create from a sequence of 1D arrays, one per row """
+        rows = [np.asarray(row, dtype=dtype).ravel() for row in rows]
+        offsets = np.zeros(len(rows) + 1, dtype='int64')
+        np.cumsum([len(row) for row in rows], out=offsets[1:])
+        if rows:
+            values = np.concatenate(rows)
+        else:
+            values = np.array([], dtype=dtype)
+        return cls(name, values, offsets, unit=unit)
+
+    @property
+    def name(self):
+        return self.info.name
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def shape(self):
+        return (len(self), )
+
+    @property
+    def ndim(self):
+        return 1
+
+    @property
+    def lengths(self):
+        """ Number of values in each row """
+        return np.diff(self.offsets)
+
+    @property
+    def data(self):
+        return self
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __repr__(self):
+        return "<%s name=%s length=%i dtype=%s>" % (self.__class__.__name__, self.name,
+                                                   len(self), self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.empty(len(self), dtype=object)
+        for ii in range(len(self)):
+            data[ii] = self[ii]
+        return data
+
+    def __getitem__(self, item):
+        if isinstance(item, (six.integer_types, np.integer)):
+            if item < 0:
+                item += len(self)
+            return np.asarray(self.values[self.offsets[item]:self.offsets[item + 1]])
+
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if item == slice(None):
+                # Table takes a full slice of mixin columns, so keep that a view
+                return self.__class__(self.name, self.values, self.offsets, unit=self.unit)
+            if step == 1:
+                offsets = self.offsets[start:max(start, stop) + 1]
+                values = np.asarray(self.values[offsets[0]:offsets[-1]])
+                return self.__class__(self.name, values, offsets - offsets[0], unit=self.unit)
+            item = np.arange(start, stop, step)
+
+        idx = np.asarray(item)
+        if idx.dtype == np.bool_:
+            idx = np.flatnonzero(idx)
+        idx = np.where(idx < 0, idx + len(self), idx)
+
+        # Index of every value of the selected rows, without a loop over rows
+        starts, lengths = self.offsets[idx], self.lengths[idx]
+        offsets = np.zeros(len(idx) + 1, dtype='int64')
+        np.cumsum(lengths, out=offsets[1:])
+        value_idx = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)
+        if isinstance(self.values, np.ndarray):
+            values = self.values[value_idx]
+        else:
+            values = IdiLazyArray(self.values)[value_idx]
+        return self.__class__(self.name, values, offsets, unit=self.unit)
+
+    def copy(self):
+        """ Return a copy. Values that are not in memory (e.g. IdiLazyArray) are not read. """
+        values = self.values
+        if isinstance(values, np.ndarray):
+            values = values.copy()
+        return self.__class__(self.name, values, self.offsets.copy(), unit=self.unit)
+
+
 class IdiHdulist(OrderedDict):
     """OrderedDict subclass for a dictionary of Header-data units (HDU).
 
@@ -332,7 +683,15 @@ class IdiHdulist(OrderedDict):
     def values(self):
         return list(OrderedDict.values(self))
 
-    def add_table_hdu(self, name, header=None, data=None, history=None, comment=None):
+    def close(self):
+        """ Close any files left open by the reader (e.g. by read_hdf with lazy=True) """
+        for attr in ('hdf', 'fits'):
+            fh = getattr(self, attr, None)
+            if fh is not None:
+                fh.close()
+
+    def add_table_hdu(self, name, header=None, data=None, history=None, comment=None,
+                      copy=True):
         """
         Add a Table HDU to HDU list
 
@@ -348,9 +707,11 @@ class IdiHdulist(OrderedDict):
             list of history data
         comment=None: list
             list of comments
+        copy=True: bool
+            Copy the column data. If False, the new HDU shares data with data.
         """
         self[name] = IdiTableHdu(name, header=header, data=data,
-                              history=history, comment=comment)
+                              history=history, comment=comment, copy=copy)
 
     def add_image_hdu(self, name, header=None, data=None, history=None, comment=None):
         """
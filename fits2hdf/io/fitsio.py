@@ -12,10 +12,13 @@ from astropy.units import Unit, UnrecognizedUnit
 import numpy as np
 from datetime import datetime
 import warnings
+import re
+import io
 
 from ..idi import *
 from .. import idi
 from .. import unit_conversion
+from .. import tracing
 from ..printlog import PrintLog
 
 # A list of keywords that are mandatory to FITS, but should always be calculated
@@ -25,12 +28,51 @@ restricted_header_keywords = {"XTENSION", "BITPIX", "SIMPLE", "PCOUNT", "GCOUNT"
 restricted_table_keywords = {"TDISP", "TUNIT", "TTYPE", "TFORM", "TBCOL",
                              "TNULL", "TSCAL", "TZERO", "NAXIS"}
 
+# Heap dtypes of the values of variable-length array (P / Q) columns, by format
+# code. Logicals are written as 'T' / 'F' characters.
+var_format_dtypes = {"L": "u1", "A": "S1", "B": "u1", "I": ">i2", "J": ">i4",
+                     "K": ">i8", "E": ">f4", "D": ">f8", "C": ">c8", "M": ">c16"}
+
 
 class DeprecatedGroupsHDUWarning(VerifyWarning):
     """
     Warning message when a deprecated 'group HDU' is found
     """
 
+
+class FitsImageSection(object):
+    """
+    Array-like view of a FITS image that only reads the parts that are indexed
+
+    This wraps the astropy HDU.section interface, so that the image data
+    are never loaded in full. Scaling (BSCALE/BZERO) is applied to each
+    section as it is read. Wrap in an IdiLazyArray to use as IdiImageHdu data.
+
+    Parameters
+    ----------
+    hdu: astropy ImageHDU or PrimaryHDU
+        Image HDU to read from
+    """
+    def __init__(self, hdu):
+        self.hdu = hdu
+        self.shape = tuple(hdu.shape)
+        self.dtype = hdu.section[(slice(0, 1), ) * len(self.shape)].dtype
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item, )
+        if item == ():
+            item = (slice(None), )
+
+        first = item[0]
+        if isinstance(first, (list, np.ndarray)):
+            # Section only supports slices, so read the span and index in memory
+            first = np.asarray(first)
+            data = self.hdu.section[(slice(first.min(), first.max() + 1), ) + item[1:]]
+            return np.asarray(data[first - first.min()], dtype=self.dtype)
+
+        return np.asarray(self.hdu.section[item], dtype=self.dtype)
+
 def fits_format_code_lookup(numpy_dtype, numpy_shape):
     """ Return a FITS format code from a given numpy dtype
 
@@ -216,6 +258,102 @@ def write_headers(hduobj, idiobj):
         hduobj.verify('fix')
     return hduobj
 
+# Regular expressions for the fast header parser. These accept only the
+# strict FITS fixed format; any card that doesn't match is parsed by astropy.
+_KEYWORD_RE = re.compile(r'[A-Z0-9_-]{1,8}$')
+_VALUE_RE = re.compile(r" *(?:'(?P<str>(?:[ -&(-~]|'')*)'|(?P<bool>[TF])|"
+                       r"(?P<num>[+-]?(?:\.[0-9]+|[0-9]+(?:\.[0-9]*)?)(?:[DE][+-]?[0-9]+)?))"
+                       r" *(?:/ *(?P<comment>[ -~]*?))? *$")
+# String values that astropy parses as record-valued keyword cards
+_RVKC_RE = re.compile(r"[a-zA-Z_]\w*(\.\w+)*: *[+-]?[0-9]")
+
+
+def _parse_card_fast(value_str):
+    """ Parse the value / comment part of a fixed format card (after the '= ')
+
+    Returns (value, comment), or None if astropy should parse the card instead.
+    """
+    m = _VALUE_RE.match(value_str)
+    if m is None:
+        return None
+    comment = m.group('comment') or ''
+    if m.group('str') is not None:
+        value = m.group('str').rstrip(' ').replace("''", "'")
+        if _RVKC_RE.match(value):
+            return None
+    elif m.group('bool') is not None:
+        value = m.group('bool') == 'T'
+    else:
+        num = m.group('num').replace('D', 'E')
+        try:
+            value = int(num)
+        except ValueError:
+            value = float(num)
+    return value, comment
+
+
+def _parse_card_astropy(image):
+    """ Parse a card image (possibly with CONTINUE cards) with astropy, fixing it if needed """
+    card = pf.Card.fromstring(image)
+    card.verify('fix')
+    return card.keyword, card.value, card.comment
+
+
+def _card_image(card):
+    """ Return the image of a card as read from file, or formatted if it has been modified
+
+    Card.image verifies the card first, which would cost as much as parsing
+    it, so the unverified image read from file is used where there is one.
+    """
+    image = getattr(card, '_image', None)
+    if image and not getattr(card, '_modified', True):
+        return image
+    return card.image
+
+
+def _iter_header_cards(header):
+    """ Yield (keyword, value, comment) for each card of an astropy Header
+
+    The header's card images are split into 80 character records, and the
+    keywords, value indicators and commentary values are sliced out of all
+    records at once with numpy. Cards with a strict fixed format value are
+    then parsed with a single regular expression; only cards that don't
+    match (e.g. HIERARCH, CONTINUE, complex or undefined values, invalid
+    keywords) are passed to astropy, and fixed.
+    """
+    header_str = ''.join(_card_image(card) for card in header.cards)
+    if not header_str:
+        return
+    raw = np.frombuffer(header_str.encode('ascii'), dtype=np.uint8).reshape(-1, 80)
+    keywords = np.char.rstrip(raw[:, :8].copy().view('S8').ravel()).astype('U8').tolist()
+    tails = np.char.rstrip(raw[:, 8:].copy().view('S72').ravel()).astype('U72').tolist()
+    has_value = ((raw[:, 8] == ord('=')) & (raw[:, 9] == ord(' '))).tolist()
+
+    n_records = len(keywords)
+    ii = 0
+    while ii < n_records:
+        keyword = keywords[ii]
+        # Long string values continue on the following records
+        n_continue = 0
+        while ii + n_continue + 1 < n_records and keywords[ii + n_continue + 1] == 'CONTINUE':
+            n_continue += 1
+
+        parsed = None
+        if n_continue == 0:
+            if keyword in ('', 'COMMENT', 'HISTORY'):
+                parsed = (tails[ii], '')
+            elif has_value[ii] and _KEYWORD_RE.match(keyword):
+                parsed = _parse_card_fast(tails[ii][2:])
+
+        if parsed is None:
+            image = header_str[ii * 80:(ii + n_continue + 1) * 80]
+            yield _parse_card_astropy(image)
+        else:
+            yield (keyword, ) + parsed
+        ii += n_continue + 1
+
+
+@tracing.traced()
 def parse_fits_header(hdul):
     """ Parse a FITS header into something less stupid.
 
@@ -232,15 +370,23 @@ def parse_fits_header(hdul):
     comment (list): Comment cards are parsed and then put into list
                     (order is important)
     history (list): History cards also parsed into a list
+
+    Cards are parsed in bulk by a fast parser (see _iter_header_cards), and
+    only cards that it can't parse are verified and fixed by astropy. If the
+    header isn't plain ASCII, the whole HDU is verified and fixed instead.
     """
 
     history  = []
     comment = []
     header   = {}
 
-    hdul.verify('fix')
+    try:
+        cards = list(_iter_header_cards(hdul.header))
+    except UnicodeEncodeError:
+        hdul.verify('fix')
+        cards = hdul.header.cards
 
-    for card in hdul.header.cards:
+    for card in cards:
 
         card_id, card_val, card_comment = card
         card_id = card_id.strip()
@@ -263,6 +409,7 @@ def parse_fits_header(hdul):
     return header, comment, history
 
 
+@tracing.traced()
 def create_column(col):
     """
     Create a astropy.io.fits column object from IdiColumn
@@ -288,8 +435,12 @@ def create_column(col):
     name = col.name
     fits_fmt, fits_dim = fits_format_code_lookup(col.dtype, col.shape)
     fits_unit = unit_conversion.units_to_fits(col.unit)
-    local_type = numpy_dtype_lookup(col.data.dtype)
-    data = col.data.astype(local_type)
+    data = col.data
+    if data.dtype.kind not in 'biufc':
+        data = data.astype(numpy_dtype_lookup(data.dtype))
+    # Numeric data are passed in their own byte order: astropy copies them into
+    # the (big-endian) table, so big-endian data, e.g. as written by export_hdf,
+    # are not byteswapped
 
     fits_col = pf.Column(name=name, format=fits_fmt, unit=fits_unit,
                          array=data, dim=fits_dim)
@@ -297,8 +448,302 @@ def create_column(col):
     return fits_col
 
 
+def create_var_column(col, heap_offset=0):
+    """
+    Create the descriptor column and heap for an IdiVarColumn
+
+    The descriptors are returned as a 2J (or 2K, for P or Q) integer column,
+    to be converted into a P / Q column by _add_heap. This avoids creating
+    an array for each row, as astropy does for P / Q columns.
+
+    Parameters
+    ----------
+    col: IdiVarColumn
+        Variable-length array column
+    heap_offset: int
+        Position in the heap that this column's values start at
+
+    Returns
+    -------
+    fits_col: pf.Column
+        Column of (count, offset) descriptors
+    var_fmt: str
+        FITS format code of the column, e.g. PE(10)
+    heap: np.array
+        Values, in FITS heap format
+    """
+    values = np.asarray(col.values)[col.offsets[0]:col.offsets[-1]]
+    lengths = col.lengths
+    fits_fmt, fits_dim = fits_format_code_lookup(values.dtype, values.shape)
+    fits_fmt = fits_fmt.lstrip('0123456789')
+
+    if fits_fmt == 'L':
+        heap = np.where(values, ord('T'), ord('F')).astype('u1')
+    else:
+        heap = values.astype(var_format_dtypes[fits_fmt], copy=False)
+
+    byte_starts = heap_offset + (col.offsets[:-1] - col.offsets[0]) * heap.dtype.itemsize
+    if heap_offset + heap.nbytes < 2**31:
+        desc_fmt, var_fmt = '2J', 'P'
+    else:
+        desc_fmt, var_fmt = '2K', 'Q'
+    descriptors = np.empty((len(lengths), 2), dtype='int64')
+    descriptors[:, 0] = lengths
+    descriptors[:, 1] = byte_starts
+    var_fmt = '%s%s(%i)' % (var_fmt, fits_fmt, lengths.max() if len(lengths) else 0)
+
+    fits_col = pf.Column(name=col.name, format=desc_fmt, array=descriptors,
+                         unit=unit_conversion.units_to_fits(col.unit))
+    return fits_col, var_fmt, heap
+
+
+def _add_heap(new_hdu, var_formats, heaps):
+    """
+    Convert the descriptor columns of a table HDU into P / Q columns, and add the heap
+
+    The table is serialized, the TFORM and PCOUNT keywords are updated and
+    the heap appended, then the HDU is recreated from the bytes. The rows of
+    P / Q columns are not read until the data are accessed, and the HDU is
+    written out as-is.
+
+    Parameters
+    ----------
+    new_hdu: pf.BinTableHDU
+        Table with 2J / 2K descriptor columns, see create_var_column
+    var_formats: dict
+        Column index: P / Q format code
+    heaps: list of np.array
+        Heap data of each column, in order
+    """
+    buf = io.BytesIO()
+    new_hdu.writeto(buf)
+    raw = buf.getvalue()
+    # astropy closes the file object, so open a new one
+    with pf.open(io.BytesIO(raw)) as ff:
+        header = ff[1].header.copy()
+        dat_loc = ff[1].fileinfo()['datLoc']
+
+    table_size = header['NAXIS1'] * header['NAXIS2']
+    heap_size = sum(heap.nbytes for heap in heaps)
+    for col_num, var_fmt in var_formats.items():
+        header['TFORM%i' % (col_num + 1)] = var_fmt
+    header['PCOUNT'] = heap_size
+
+    header_str = header.tostring().encode('ascii')
+    data_size = table_size + heap_size
+    hdu_bytes = bytearray(len(header_str) + data_size + (-data_size % 2880))
+    hdu_bytes[:len(header_str)] = header_str
+    pos = len(header_str)
+    hdu_bytes[pos:pos + table_size] = memoryview(raw)[dat_loc:dat_loc + table_size]
+    pos += table_size
+    hdu_array = np.frombuffer(hdu_bytes, dtype='u1')
+    for heap in heaps:
+        hdu_array[pos:pos + heap.nbytes] = np.ascontiguousarray(heap).reshape(-1).view('u1')
+        pos += heap.nbytes
+    # Read from a file object: with fromstring the data would be read-only, so
+    # could not be written out once accessed
+    return pf.BinTableHDU.readfrom(io.BytesIO(hdu_bytes))
+
+
+def _table_from_hdu(hdul_fits):
+    """
+    Create an IdiTableHdu from an open FITS table HDU, without rereading the file
+
+    Columns are views of the HDU's record array where possible. Columns that
+    need converting (scaled columns, logicals) are converted by astropy as they
+    are accessed. Integer columns with TNULL set are returned as MaskedColumns,
+    and units are parsed as by astropy.table.Table.read.
+
+    The file should be opened with character_as_bytes=True, so string columns
+    are not decoded into copies.
+
+    Parameters
+    ----------
+    hdul_fits: astropy BinTableHDU or TableHDU
+        Table HDU to read
 
-def read_fits(infile, verbosity=0):
+    Returns
+    -------
+    idi_tbl: IdiTableHdu
+    """
+    data = hdul_fits.data
+    columns = []
+    for col_num, col in enumerate(data.columns):
+        if getattr(col.format, 'p_format', None) is not None:
+            columns.append(_var_column_from_hdu(data, col_num, col))
+            continue
+
+        # Index by name, not col.array, so scaling is applied
+        col_data = data[col.name]
+        if col.null is not None:
+            column = MaskedColumn(data=col_data, name=col.name, mask=col_data == col.null,
+                                  copy=False, fill_value=col.null)
+        else:
+            column = Column(data=col_data, name=col.name, copy=False)
+        if col.unit is not None:
+            column.unit = Unit(col.unit, format='fits', parse_strict='warn')
+        columns.append(column)
+
+    return IdiTableHdu(hdul_fits.name, columns, copy=False)
+
+
+def _var_column_from_hdu(data, col_num, col):
+    """
+    Create an IdiVarColumn from a variable-length array (P / Q) column
+
+    The values are read straight from the heap, using the (count, offset)
+    descriptors in the table, so astropy does not create an array per row.
+    If the rows are stored in order in the heap, which is usual, the values
+    are a view of the heap.
+
+    Parameters
+    ----------
+    data: astropy FITS_rec
+        Data of the table HDU
+    col_num: int
+        Index of the column
+    col: astropy Column
+        Column definition
+
+    Returns
+    -------
+    idi_col: IdiVarColumn
+    """
+    value_fmt = col.format.p_format
+    unit = None
+    if col.unit is not None:
+        unit = Unit(col.unit, format='fits', parse_strict='warn')
+
+    if value_fmt not in var_format_dtypes or data._get_raw_data() is None:
+        # Bit arrays, or data that are not from a file: let astropy convert the rows
+        return IdiVarColumn.from_rows(col.name, data[col.name], unit=unit)
+
+    dtype = np.dtype(var_format_dtypes[value_fmt])
+    # The raw field holds the descriptors; FITS_rec.field would convert the rows
+    descriptors = np.rec.recarray.field(data, col_num)
+    counts = descriptors[:, 0].astype('int64')
+    byte_starts = descriptors[:, 1].astype('int64')
+    heap = data._get_heap_data()
+
+    offsets = np.zeros(len(counts) + 1, dtype='int64')
+    np.cumsum(counts, out=offsets[1:])
+    n_bytes = counts * dtype.itemsize
+    if len(counts) == 0:
+        values = np.array([], dtype=dtype)
+    elif np.all(byte_starts[1:] == byte_starts[:-1] + n_bytes[:-1]):
+        values = heap[byte_starts[0]:byte_starts[0] + n_bytes.sum()].view(dtype)
+    else:
+        byte_offsets = offsets * dtype.itemsize
+        byte_idx = np.arange(byte_offsets[-1]) + np.repeat(byte_starts - byte_offsets[:-1], n_bytes)
+        values = heap[byte_idx].view(dtype)
+
+    if value_fmt == 'L':
+        # astropy writes 1 / 0 rather than 'T' / 'F'
+        values = (values == ord('T')) | (values == 1)
+    return IdiVarColumn(col.name, values, offsets, unit=unit)
+
+
+def _is_scaled(hdul_fits):
+    """ Check if astropy will convert image data on access, due to BSCALE / BZERO or
+    BLANK in an integer image. Call before accessing the data, as astropy then
+    removes these keywords from the header. """
+    header = hdul_fits.header
+    return (header.get('BSCALE', 1) != 1 or header.get('BZERO', 0) != 0 or
+            ('BLANK' in header and header.get('BITPIX', 0) > 0))
+
+
+def _astropy_memmap(memmap):
+    """ Return the memmap option to open a FITS file with, for our memmap option
+
+    astropy memory maps files by default (memmap=None). Its memmap=True
+    refuses to load scaled images, which we read in sections instead, so
+    only False is passed on.
+    """
+    return False if memmap is False else None
+
+def _read_fits_hdu(hdul_idi, hdul_fits, pp, max_memory=None, memmap=None):
+    """
+    Read a single FITS HDU and add it to an IDI HDU list
+
+    Parameters
+    ----------
+    hdul_idi: IdiHdulist
+        HDU list to add the HDU to
+    hdul_fits: astropy FITS HDU
+        HDU to read
+    pp: PrintLog
+        Logger
+    max_memory: int or None
+        Images larger than this (in bytes) are not loaded, but added as an
+        IdiLazyArray over a FitsImageSection, to be copied block by block.
+        If None, images are always loaded.
+    memmap: bool or None
+        The memmap option the file was opened with. If True, unscaled images
+        are added as views of the mapped file, whatever their size, and
+        scaled images as an IdiLazyArray over a FitsImageSection, so that
+        scaling is applied section by section rather than to a full size
+        copy in memory.
+    """
+    header, history, comment = parse_fits_header(hdul_fits)
+
+    ImageHDU   = pf.hdu.ImageHDU
+    PrimaryHDU = pf.hdu.PrimaryHDU
+    compHDU    = pf.hdu.CompImageHDU
+    groupsHDU  = pf.hdu.groups.GroupsHDU
+
+    if isinstance(hdul_fits, ImageHDU) or isinstance(hdul_fits, PrimaryHDU):
+        pp.debug("Adding Image HDU %s" % hdul_fits)
+        try:
+            if isinstance(hdul_fits, groupsHDU):
+                # We have a random group table, yuck
+                hdul_idi.add_table_hdu(hdul_fits.name, data=hdul_fits.data[:],
+                                       header=header, history=history, comment=comment,
+                                       copy=not memmap)
+            elif hdul_fits.size == 0:
+                hdul_idi.add_primary_hdu(hdul_fits.name,
+                                          header=header, history=history, comment=comment)
+            elif hdul_fits.is_image:
+                data = None
+                if memmap:
+                    if _is_scaled(hdul_fits):
+                        pp.debug("Image %s is scaled, reading in sections" % hdul_fits.name)
+                        data = IdiLazyArray(FitsImageSection(hdul_fits))
+                elif max_memory is not None:
+                    data = IdiLazyArray(FitsImageSection(hdul_fits))
+                    if data.nbytes <= max_memory:
+                        data = None
+                    else:
+                        pp.debug("Image %s is larger than memory budget, reading in sections" % hdul_fits.name)
+                if data is None:
+                    # The HDU's data (memory mapped unless memmap is False), in FITS byte order
+                    data = hdul_fits.data
+                hdul_idi.add_image_hdu(hdul_fits.name, data=data,
+                                       header=header, history=history, comment=comment)
+            else:
+                # We have a random group table, yuck
+                hdul_idi.add_table_hdu(hdul_fits.name, data=hdul_fits.data[:],
+                                       header=header, history=history, comment=comment,
+                                       copy=not memmap)
+        except TypeError:
+            # Primary groups HDUs can raise this error with no data
+            hdul_idi.add_primary_hdu(hdul_fits.name,
+                                     header=header, history=history, comment=comment)
+
+    elif isinstance(hdul_fits, compHDU):
+        pp.debug("Adding Compressed Image HDU %s" % hdul_fits)
+        hdul_idi.add_image_hdu(hdul_fits.name, data=hdul_fits.data[:],
+                               header=header, history=history, comment=comment)
+    else:
+        pp.debug("Adding Tablular HDU %s" % hdul_fits)
+        # Data is tabular
+        idi_tbl = _table_from_hdu(hdul_fits)
+        hdul_idi.add_table_hdu(hdul_fits.name,
+                               header=header, data=idi_tbl, history=history, comment=comment,
+                               copy=False)
+
+
+@tracing.traced()
+def read_fits(infile, verbosity=0, memmap=None):
     """
     Read and load contents of a FITS file
 
@@ -308,10 +753,21 @@ def read_fits(infile, verbosity=0):
         File path of input file
     verbosity: int
         Verbosity level of output, 0 (none) to 5 (all)
+    memmap: bool or None
+        Whether to memory map the file. Image data and table columns are
+        views of the HDU data, in the FITS (big-endian) byte order, and the
+        file must stay open (see IdiHdulist.close) while they are in use.
+        With None (the default), astropy memory maps uncompressed files, so
+        they are read through the page cache. True also memory maps them,
+        and in addition scaled images (BSCALE / BZERO) are returned as
+        IdiLazyArray views that apply the scaling as they are read, rather
+        than scaled in memory. With False, data are read into memory instead
+        of being mapped. Scaled and logical table columns are always
+        converted in memory.
     """
 
     pp = PrintLog(verbosity=verbosity)
-    ff = pf.open(infile)
+    ff = pf.open(infile, character_as_bytes=True, memmap=_astropy_memmap(memmap))
 
 
     hdul_idi = idi.IdiHdulist()
@@ -324,49 +780,63 @@ def read_fits(infile, verbosity=0):
             hdul_fits.name = "HDU%i" % ii
             ii += 1
 
-        header, history, comment = parse_fits_header(hdul_fits)
-
-        ImageHDU   = pf.hdu.ImageHDU
-        PrimaryHDU = pf.hdu.PrimaryHDU
-        compHDU    = pf.hdu.CompImageHDU
-        groupsHDU  = pf.hdu.groups.GroupsHDU
-
-        if isinstance(hdul_fits, ImageHDU) or isinstance(hdul_fits, PrimaryHDU):
-            pp.debug("Adding Image HDU %s" % hdul_fits)
-            try:
-                if isinstance(hdul_fits, groupsHDU):
-                    # We have a random group table, yuck
-                    hdul_idi.add_table_hdu(hdul_fits.name, data=hdul_fits.data[:],
-                                           header=header, history=history, comment=comment)
-                elif hdul_fits.size == 0:
-                    hdul_idi.add_primary_hdu(hdul_fits.name,
-                                              header=header, history=history, comment=comment)
-                elif hdul_fits.is_image:
-                    hdul_idi.add_image_hdu(hdul_fits.name, data=hdul_fits.data[:],
-                                           header=header, history=history, comment=comment)
-                else:
-                    # We have a random group table, yuck
-                    hdul_idi.add_table_hdu(hdul_fits.name, data=hdul_fits.data[:],
-                                           header=header, history=history, comment=comment)
-            except TypeError:
-                # Primary groups HDUs can raise this error with no data
-                hdul_idi.add_primary_hdu(hdul_fits.name,
-                                         header=header, history=history, comment=comment)
-
-        elif isinstance(hdul_fits, compHDU):
-            pp.debug("Adding Compressed Image HDU %s" % hdul_fits)
-            hdul_idi.add_image_hdu(hdul_fits.name, data=hdul_fits.data[:],
-                                   header=header, history=history, comment=comment)
-        else:
-            pp.debug("Adding Tablular HDU %s" % hdul_fits)
-            # Data is tabular
-            tbl_data = Table.read(infile, hdu=hdul_fits.name)
-            idi_tbl = IdiTableHdu(hdul_fits.name, tbl_data)
-            hdul_idi.add_table_hdu(hdul_fits.name,
-                                   header=header, data=idi_tbl, history=history, comment=comment)
+        with tracing.span("read_fits_hdu", hdu=hdul_fits.name):
+            _read_fits_hdu(hdul_idi, hdul_fits, pp, memmap=memmap)
 
     return hdul_idi
 
+def iter_fits(infile, verbosity=0, max_memory=None, memmap=None):
+    """
+    Read a FITS file one HDU at a time
+
+    This is a generator that yields (name, HDU) pairs, where the HDU is an
+    IdiImageHdu, IdiTableHdu or IdiPrimaryHdu. The data of each FITS HDU are
+    released before the next HDU is read, so only one HDU is held in memory
+    at a time (as long as the caller drops its reference too). The output
+    can be passed straight to hdfio.export_hdf_stream.
+
+    Parameters
+    ----------
+    infile: str
+        File path of input file
+    verbosity: int
+        Verbosity level of output, 0 (none) to 5 (all)
+    max_memory: int or None
+        Images larger than this many bytes are yielded as IdiLazyArray views
+        of the FITS file rather than loaded, so that export_hdf_stream can
+        convert them block by block. The file must not be closed until they
+        have been written. If None, all data are loaded.
+    memmap: bool or None
+        Whether to memory map the file, see read_fits. If True, max_memory is
+        ignored, as unscaled images are views of the mapped file and scaled
+        images are scaled section by section.
+    """
+
+    pp = PrintLog(verbosity=verbosity)
+    ff = pf.open(infile, character_as_bytes=True, memmap=_astropy_memmap(memmap))
+
+    try:
+        ii = 0
+        for hdul_fits in ff:
+            if hdul_fits.name in ('', None, ' '):
+                hdul_fits.name = "HDU%i" % ii
+                ii += 1
+
+            hdul_idi = idi.IdiHdulist()
+            with tracing.span("read_fits_hdu", hdu=hdul_fits.name):
+                _read_fits_hdu(hdul_idi, hdul_fits, pp, max_memory=max_memory, memmap=memmap)
+            name, idi_hdu = hdul_idi.popitem()
+            del hdul_idi
+
+            yield name, idi_hdu
+
+            # Release the data before reading the next HDU
+            del idi_hdu
+            del hdul_fits.data
+    finally:
+        ff.close()
+
+@tracing.traced()
 def create_fits(hdul, verbosity=0):
     """
     Export HDU to FITS file in memory.
@@ -424,18 +894,27 @@ def create_fits(hdul, verbosity=0):
 
             pp.pp("Creating Table HDU %s" % idiobj)
             fits_cols = []
-            for cn in idiobj.colnames:
+            var_formats = {}
+            heaps = []
+            heap_size = 0
+            for col_num, cn in enumerate(idiobj.colnames):
                 col = idiobj[cn]
-                fits_col = create_column(col)
+                if isinstance(col, IdiVarColumn):
+                    fits_col, var_formats[col_num], heap = create_var_column(col, heap_size)
+                    heaps.append(heap)
+                    heap_size += heap.nbytes
+                else:
+                    fits_col = create_column(col)
                 pp.debug(col.data.shape)
 
                 fits_cols.append(fits_col)
 
             table_def = pf.ColDefs(fits_cols)
             pp.pp(table_def)
-            print(table_def)
 
             new_hdu = pf.BinTableHDU.from_columns(table_def, name=idiobj.name)
+            if var_formats:
+                new_hdu = _add_heap(new_hdu, var_formats, heaps)
             new_hdu = write_headers(new_hdu, idiobj)
             new_hdu.name = name
             new_hdu.verify()
@@ -450,6 +929,7 @@ def create_fits(hdul, verbosity=0):
 
 
 
+@tracing.traced()
 def export_fits(hdul, outfile, verbosity=0):
     """
     Export HDU list to file
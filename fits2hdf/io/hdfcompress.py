@@ -7,11 +7,16 @@ hdfcompress.py
 Helper functions for writing bitshuffled compressed datatsets
 """
 
+import itertools
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import h5py
 from h5py import h5f, h5d, h5z, h5t, h5s, filters
-from ..idi import IdiTableHdu
+from ..idi import IdiTableHdu, decode_utf8
 from .. import printlog
+from .. import tracing
 
 try:
     from bitshuffle import h5
@@ -19,6 +24,18 @@ try:
 except ImportError:
     USE_BITSHUFFLE = False
 
+# Default memory budget (bytes) for writing data that is not already in memory
+DEFAULT_MAX_MEMORY = 256 * 2**20
+
+# Default size (bytes) of the chunks of row-store (TABLE) datasets. This is
+# below the default HDF5 chunk cache size (1 MiB), so a chunk stays cached
+# while its rows are read.
+DEFAULT_ROW_CHUNK_BYTES = 512 * 2**10
+
+# Uncompressed size (bytes) of the batches of chunks decompressed by each
+# read_parallel task
+READ_BATCH_BYTES = 2**20
+
 def guess_chunk(shape):
     """ Guess the optimal chunk size for a given shape
     :param shape: shape of dataset
@@ -52,6 +69,332 @@ def guess_chunk(shape):
         raise RuntimeError("Couldn't handle shape %s" % str(shape))
     return chunks
 
+def guess_row_chunk(n_rows, row_size, chunk_bytes=DEFAULT_ROW_CHUNK_BYTES):
+    """ Guess the chunk shape for a row-store table (compound dataset)
+
+    Chunks hold whole rows, so reading a range of rows only decompresses
+    the chunks that hold them.
+
+    :param n_rows: number of rows in table
+    :param row_size: size of each row, in bytes
+    :param chunk_bytes: target size of each chunk, in bytes
+    :return: chunk shape (tuple)
+    """
+    return (max(1, min(n_rows, chunk_bytes // max(row_size, 1))), )
+
+def guess_block(shape, itemsize, chunks, max_memory=DEFAULT_MAX_MEMORY):
+    """ Guess the shape of blocks to read and write, within a memory budget
+
+    Blocks are aligned to the chunk shape, so each chunk is written once.
+    Axes are split from the first (slowest varying) axis onwards. If a single
+    chunk is larger than max_memory, the block is one chunk.
+
+    :param shape: shape of dataset
+    :param itemsize: size of each element, in bytes
+    :param chunks: chunk shape of dataset
+    :param max_memory: memory budget for each block, in bytes
+    :return: block shape (tuple)
+    """
+    block = list(shape)
+    outer = 1
+    for ax in range(len(shape)):
+        inner = int(np.prod(shape[ax + 1:])) * itemsize
+        n_fit = int(max_memory // max(outer * inner, 1))
+        if n_fit >= shape[ax]:
+            break
+        step = chunks[ax]
+        block[ax] = min(shape[ax], max(step, n_fit // step * step))
+        if n_fit >= step:
+            break
+        outer *= block[ax]
+    return tuple(block)
+
+def iter_blocks(shape, block):
+    """ Iterate over a dataset in blocks, yielding a tuple of slices for each block
+
+    :param shape: shape of dataset
+    :param block: shape of blocks, e.g. from guess_block
+    """
+    starts = [range(0, max(n, 1), b) for n, b in zip(shape, block)]
+    for start in itertools.product(*starts):
+        yield tuple(slice(i0, i0 + b) for i0, b in zip(start, block))
+
+def _update_minmax(minmax, data):
+    """ Update a [min, max] list in place with the range of a block of data """
+    if data.size == 0:
+        return
+    vmin, vmax = np.min(data), np.max(data)
+    if minmax:
+        vmin, vmax = min(minmax[0], vmin), max(minmax[1], vmax)
+    minmax[:] = [vmin, vmax]
+
+def write_blocked(dset, data, max_memory=DEFAULT_MAX_MEMORY, minmax=None):
+    """ Copy data into a dataset block by block, within a memory budget
+
+    This is used for data that is not in memory (e.g. an IdiLazyArray of a
+    FITS image section, or of another HDF5 dataset), so that arrays larger
+    than RAM can be converted.
+
+    :param dset: h5py dataset to write to
+    :param data: array-like with shape, dtype and __getitem__, to read from
+    :param max_memory: memory budget in bytes
+    :param minmax: optional list, updated in place with the [min, max] of the
+                   data as they are written, so they need not be read again
+    """
+    chunks = dset.chunks or guess_chunk(dset.shape)
+    block = guess_block(dset.shape, dset.dtype.itemsize, chunks, max_memory)
+    for sel in iter_blocks(dset.shape, block):
+        block_data = np.asarray(data[sel])
+        if minmax is not None:
+            _update_minmax(minmax, block_data)
+        dset[sel] = block_data
+    return dset
+
+def blocked_minmax(data, max_memory=DEFAULT_MAX_MEMORY):
+    """ Return the minimum and maximum of data, reading block by block
+
+    For data being written to HDF5, pass minmax to write_blocked or
+    write_parallel instead, so the data are only read once.
+
+    :param data: array-like with shape, dtype and __getitem__
+    :param max_memory: memory budget in bytes
+    """
+    if isinstance(data, np.ndarray):
+        return np.min(data), np.max(data)
+
+    vmin, vmax = None, None
+    block = guess_block(data.shape, data.dtype.itemsize, guess_chunk(data.shape), max_memory)
+    for sel in iter_blocks(data.shape, block):
+        d = np.asarray(data[sel])
+        vmin = np.min(d) if vmin is None else min(vmin, np.min(d))
+        vmax = np.max(d) if vmax is None else max(vmax, np.max(d))
+    return vmin, vmax
+
+def _deflate_filters(dset):
+    """ Return (shuffle, level) if a dataset uses only deflate (+shuffle), else None
+
+    These are the filter pipelines that write_parallel can reproduce.
+    """
+    if dset.chunks is None or dset.dtype.kind not in 'biufcSV':
+        return None
+
+    plist = dset.id.get_create_plist()
+    pipeline = [plist.get_filter(ii)[:3] for ii in range(plist.get_nfilters())]
+    codes = [code for code, flags, opts in pipeline]
+    if codes == [h5z.FILTER_DEFLATE]:
+        return False, pipeline[0][2][0]
+    if codes == [h5z.FILTER_SHUFFLE, h5z.FILTER_DEFLATE]:
+        return True, pipeline[1][2][0]
+    return None
+
+def _compress_chunk(chunk, chunks, fillvalue, shuffle, level):
+    """ Shuffle and deflate a single chunk, as the HDF5 filter pipeline would """
+    if chunk.shape != chunks:
+        # Edge chunks are stored full size, padded with the fill value
+        padded = np.full(chunks, fillvalue, dtype=chunk.dtype)
+        padded[tuple(slice(0, n) for n in chunk.shape)] = chunk
+        chunk = padded
+    buf = np.ascontiguousarray(chunk).reshape(-1).view(np.uint8)
+    if shuffle and chunk.dtype.itemsize > 1:
+        buf = np.ascontiguousarray(buf.reshape(-1, chunk.dtype.itemsize).T)
+    return zlib.compress(buf, level)
+
+def write_parallel(dset, data, workers, max_memory=DEFAULT_MAX_MEMORY, minmax=None):
+    """ Compress chunks in a thread pool and write them with direct chunk writes
+
+    Only datasets with a deflate (gzip) filter, optionally preceded by
+    shuffle, are supported; the chunks written are identical to those the
+    HDF5 filter pipeline would produce, so the file is read as normal.
+    zlib releases the GIL, so threads scale with the number of cores.
+    Data are processed in chunk-aligned blocks of up to max_memory bytes.
+
+    :param dset: h5py dataset to write to
+    :param data: numpy array or array-like (e.g. IdiLazyArray) to read from
+    :param workers: number of compression threads
+    :param max_memory: memory budget in bytes
+    :param minmax: optional list, updated in place with the [min, max] of the
+                   data written, see write_blocked
+    :return: True if the data were written, False if the dataset's filters
+             are not supported (nothing is written)
+    """
+    filter_opts = _deflate_filters(dset)
+    if filter_opts is None:
+        return False
+    shuffle, level = filter_opts
+
+    chunks = dset.chunks
+    dtype = dset.dtype
+    fillvalue = dset.fillvalue
+    block = guess_block(dset.shape, dtype.itemsize, chunks, max_memory)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for block_sel in iter_blocks(dset.shape, block):
+            block_data = np.asarray(data[block_sel], dtype=dtype)
+            if minmax is not None:
+                _update_minmax(minmax, block_data)
+            offsets = [tuple(s.start for s in sel)
+                       for sel in iter_blocks(block_data.shape, chunks)]
+
+            def compress(offset):
+                sel = tuple(slice(i0, i0 + c) for i0, c in zip(offset, chunks))
+                return _compress_chunk(block_data[sel], chunks, fillvalue, shuffle, level)
+
+            block_start = tuple(s.start for s in block_sel)
+            for offset, chunk_bytes in zip(offsets, pool.map(compress, offsets)):
+                chunk_offset = tuple(b + i0 for b, i0 in zip(block_start, offset))
+                dset.id.write_direct_chunk(chunk_offset, chunk_bytes)
+    return True
+
+def _decompress_chunk(chunk_bytes, filter_mask, chunks, dtype, shuffle):
+    """ Inflate and unshuffle a single chunk, skipping filters set in filter_mask """
+    deflate_bit = 2 if shuffle else 1
+    if not filter_mask & deflate_bit:
+        chunk_bytes = zlib.decompress(chunk_bytes)
+    buf = np.frombuffer(chunk_bytes, dtype=np.uint8)
+    if shuffle and not filter_mask & 1 and dtype.itemsize > 1:
+        buf = np.ascontiguousarray(buf.reshape(dtype.itemsize, -1).T)
+    return buf.view(dtype).reshape(chunks)
+
+def _stored_chunk_offsets(dset):
+    """ Return the offsets of all chunks written to a dataset, in one pass
+
+    :param dset: h5py dataset
+    :return: list of chunk offsets, or None if h5py / HDF5 is too old for chunk_iter
+    """
+    if not hasattr(dset.id, 'chunk_iter'):
+        return None
+    offsets = []
+    dset.id.chunk_iter(lambda info: offsets.append(info.chunk_offset))
+    return offsets
+
+def read_parallel(dset, workers):
+    """ Read a whole dataset, decompressing chunks in a thread pool
+
+    Raw chunks are fetched with direct chunk reads, then inflated (and
+    unshuffled) by worker threads straight into a preallocated array.
+    As with write_parallel, only deflate (gzip) with optional shuffle is
+    supported.
+
+    :param dset: h5py dataset to read
+    :param workers: number of decompression threads
+    :return: numpy array, or None if the dataset's filters are not supported
+    """
+    filter_opts = _deflate_filters(dset)
+    if filter_opts is None:
+        return None
+    shuffle = filter_opts[0]
+
+    chunks = dset.chunks
+    dtype = dset.dtype
+    n_chunks_total = int(np.prod([-(-n // c) for n, c in zip(dset.shape, chunks)]))
+    # Looking chunks up by index (get_chunk_info) is O(n) per chunk, so list them in one go
+    offsets = _stored_chunk_offsets(dset)
+    if offsets is None:
+        # Walk the chunk grid instead; unwritten chunks are skipped below
+        offsets = [tuple(s.start for s in sel) for sel in iter_blocks(dset.shape, chunks)]
+        out = np.full(dset.shape, dset.fillvalue, dtype=dtype)
+    elif len(offsets) < n_chunks_total:
+        # Unwritten chunks read as the fill value
+        out = np.full(dset.shape, dset.fillvalue, dtype=dtype)
+    else:
+        out = np.empty(dset.shape, dtype=dtype)
+
+    def decompress(batch):
+        for offset, filter_mask, chunk_bytes in batch:
+            chunk = _decompress_chunk(chunk_bytes, filter_mask, chunks, dtype, shuffle)
+            sel = tuple(slice(i0, min(i0 + c, n)) for i0, c, n in zip(offset, chunks, dset.shape))
+            out[sel] = chunk[tuple(slice(0, s.stop - s.start) for s in sel)]
+
+    # Small chunks are handed to workers in batches, to keep task overhead down
+    batch_size = max(1, READ_BATCH_BYTES // (int(np.prod(chunks)) * dtype.itemsize))
+
+    # Reads go through HDF5 one at a time, so read in this thread while
+    # workers decompress, keeping a bounded number of batches in flight
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        batch = []
+        for offset in offsets:
+            try:
+                filter_mask, chunk_bytes = dset.id.read_direct_chunk(offset)
+            except (RuntimeError, OSError):
+                if dset.id.get_chunk_info_by_coord(offset).byte_offset is not None:
+                    raise
+                continue
+            batch.append((offset, filter_mask, chunk_bytes))
+            if len(batch) >= batch_size:
+                pending.append(pool.submit(decompress, batch))
+                batch = []
+            if len(pending) >= 4 * workers:
+                pending.pop(0).result()
+        pending.append(pool.submit(decompress, batch))
+        for future in pending:
+            future.result()
+    return out
+
+def read_dataset(dset, workers=1):
+    """ Read a whole dataset into memory, in parallel if possible
+
+    :param dset: h5py dataset to read
+    :param workers: number of decompression threads, see read_parallel
+    """
+    if workers > 1 and dset.size > 0:
+        data = read_parallel(dset, workers)
+        if data is not None:
+            return decode_utf8(data)
+    return decode_utf8(dset[:])
+
+def encode_utf8(data):
+    """ Encode unicode data (and unicode fields of structured data) as fixed-width UTF-8
+
+    HDF5 has no equivalent of numpy's UCS-4 unicode dtype, so strings are
+    stored as fixed-width UTF-8, with the HDF5 UTF-8 character set. ASCII
+    data keep the width of the unicode dtype; otherwise the width is that of
+    the longest encoded string. They are decoded on read, see idi.decode_utf8.
+
+    :param data: numpy array
+    :return: numpy array, with an h5py UTF-8 string dtype in place of unicode
+    """
+    if data.dtype.kind == 'U':
+        n_chars = data.dtype.itemsize // 4
+        codes = np.ascontiguousarray(data).reshape(-1).view(data.dtype.byteorder + 'u4')
+        if n_chars > 0 and not np.any(codes >= 0x80):
+            # ASCII: each character is one byte, so no need to encode string by string
+            encoded = codes.astype(np.uint8).view('S%i' % n_chars).reshape(data.shape)
+        else:
+            encoded = np.char.encode(data, 'utf-8')
+        return encoded.astype(h5py.string_dtype('utf-8', max(encoded.dtype.itemsize, 1)))
+    if data.dtype.names is None or not any(data.dtype[name].base.kind == 'U'
+                                           for name in data.dtype.names):
+        return data
+    fields = [(name, encode_utf8(np.asarray(data[name]))) for name in data.dtype.names]
+    encoded = np.empty(data.shape, dtype=[(name, field.dtype.base, field.shape[data.ndim:])
+                                          for name, field in fields])
+    for name, field in fields:
+        encoded[name] = field
+    return encoded
+
+def stored_dtype(dtype, byteorder=None):
+    """ Return the dtype numeric data are stored as, given a byteorder option
+
+    The byte order applies to each numeric field of a compound (TABLE) dtype.
+
+    :param dtype: numpy dtype of data
+    :param byteorder: '<', '>', '=' (native) or None (keep the data's byte order)
+    """
+    if byteorder is None:
+        return dtype
+    if dtype.names is not None:
+        return np.dtype({'names': list(dtype.names),
+                         'formats': [stored_dtype(dtype.fields[name][0], byteorder)
+                                     for name in dtype.names],
+                         'offsets': [dtype.fields[name][1] for name in dtype.names],
+                         'itemsize': dtype.itemsize})
+    if dtype.subdtype is not None:
+        return np.dtype((stored_dtype(dtype.base, byteorder), dtype.shape))
+    if dtype.kind in 'iufc':
+        return dtype.newbyteorder(byteorder)
+    return dtype
+
 def create_compressed(hgroup, name, data, **kwargs):
     """
     Add a compressed dataset to a given group.
@@ -60,9 +403,26 @@ def create_compressed(hgroup, name, data, **kwargs):
 
     hgroup: h5py group in which to add dataset
     name:   name of dataset
-    data:   data to write
+    data:   data to write. If this is not a numpy array (e.g. an IdiLazyArray),
+            it is written block by block, see write_blocked.
     chunks: chunk size
+    max_memory: memory budget for blocked writes, in bytes
+    workers: number of threads to compress with. If more than one, gzip
+             compressed datasets are written with write_parallel.
+    byteorder: byte order to store numeric data in ('<', '>' or '=' for
+               native). HDF5 converts the data as they are written. Defaults
+               to None, which stores data in their own byte order, with no
+               byteswap (so FITS data stay big-endian).
+    minmax: optional list, updated in place with the [min, max] of data that
+            are written block by block or in parallel (left empty for numpy
+            arrays written in one go)
     """
+    max_memory = kwargs.pop('max_memory', DEFAULT_MAX_MEMORY)
+    minmax = kwargs.pop('minmax', None)
+    workers = kwargs.pop('workers', 1)
+    byteorder = kwargs.pop('byteorder', None)
+
+    dtype = stored_dtype(data.dtype, byteorder)
 
     # Check explicitly for bitshuffle, as it is not part of h5py
     compression = ''
@@ -72,21 +432,29 @@ def create_compressed(hgroup, name, data, **kwargs):
     #print name, shape, dtype, chunks
     if compression == 'bitshuffle' and USE_BITSHUFFLE:
 
-        if 'chunks' not in kwargs:
+        if kwargs.get('chunks') is None:
             kwargs['chunks'] = guess_chunk(data.shape)
-            chunks = kwargs['chunks']
+        chunks = kwargs['chunks']
 
         #print "Creating bitshuffled dataset %s" % hgroup
-        h5.create_dataset(hgroup, name, data.shape, data.dtype, chunks,
+        # The low-level h5py API bitshuffle uses wants the name as bytes
+        h5.create_dataset(hgroup, name.encode('utf-8'), data.shape, dtype, chunks,
+                          maxshape=kwargs.get('maxshape'),
                           filter_pipeline=(32008,),
                           filter_flags=(h5z.FLAG_MANDATORY,),
                           filter_opts=((0, h5.H5_COMPRESS_LZ4),),
                           )
     else:
         #print "Creating dataset %s" % hgroup
-        hgroup.create_dataset(name, data.shape, data.dtype, **kwargs)
+        hgroup.create_dataset(name, data.shape, dtype, **kwargs)
 
-    hgroup[name][:] = data
+    if workers > 1 and data.size > 0 and write_parallel(hgroup[name], data, workers, max_memory,
+                                                        minmax):
+        pass
+    elif isinstance(data, np.ndarray):
+        hgroup[name][:] = data
+    else:
+        write_blocked(hgroup[name], data, max_memory, minmax)
 
     return hgroup[name]
 
@@ -106,6 +474,8 @@ def create_dataset(hgroup, name, data, **kwargs):
     pp = printlog.PrintLog(verbosity)
 
     np_types = [
+            np.bool_,
+            np.bytes_,
             np.uint8,
             np.uint16,
             np.uint32,
@@ -125,15 +495,23 @@ def create_dataset(hgroup, name, data, **kwargs):
 
     #print name, str(data.dtype)
     #print data.dtype.type, data.dtype.type in np_types
-    if data.dtype.type in np_types and not isinstance(data, IdiTableHdu):
-        pp.debug("Creating compressed %s" % name)
-        dset = create_compressed(hgroup, name, data, **kwargs)
-    else:
-        try:
-            pp.debug("Creating non-compressed %s" % name)
-            dset = hgroup.create_dataset(name, data=data)
-        except TypeError:
-            #print name, data.dtype
-            raise
+    with tracing.span("create_dataset", dataset=name):
+        if isinstance(data, np.ndarray) or data.dtype.kind == 'U':
+            data = encode_utf8(np.asanyarray(data))
+        if data.dtype.type in np_types and not isinstance(data, IdiTableHdu):
+            pp.debug("Creating compressed %s" % name)
+            if data.dtype.kind not in 'iuf':
+                # Scale-offset only applies to integer and float data
+                kwargs.pop('scaleoffset', None)
+            dset = create_compressed(hgroup, name, data, **kwargs)
+        else:
+            try:
+                pp.debug("Creating non-compressed %s" % name)
+                if not isinstance(data, (np.ndarray, IdiTableHdu)):
+                    data = np.asarray(data)
+                dset = hgroup.create_dataset(name, data=data)
+            except TypeError:
+                #print name, data.dtype
+                raise
 
     return dset
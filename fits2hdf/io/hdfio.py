@@ -6,6 +6,9 @@ hdfio.py
 HDF I/O for reading and writing to HDF5 files.
 """
 
+import json
+import time
+
 from astropy.io import fits as pf
 import numpy as np
 import h5py
@@ -15,11 +18,23 @@ from .. import idi
 from . import hdfcompress as bs
 from .fitsio import restricted_table_keywords, restricted_header_keywords
 
+from .. import tracing
 from ..printlog import PrintLog
 
 # List of keywords not to copy over to FITS files
 restricted_hdf_keywords = {'CLASS', 'SUBCLASS', 'POSITION'}
 
+# Root-level attribute holding the HDU index (see read_hdu_index)
+HDU_INDEX_KEY = 'HDU_INDEX'
+HDU_INDEX_VERSION = 1
+
+
+def _dataset_metrics(name, dset, write_time):
+    """ Size and timing of a newly written dataset, for export_hdu metrics """
+    bytes_in = int(dset.size * dset.dtype.itemsize)
+    bytes_out = int(dset.id.get_storage_size())
+    return {"name": name, "write_time": write_time, "bytes_in": bytes_in, "bytes_out": bytes_out,
+            "compression": float(bytes_in) / bytes_out if bytes_out else None}
 
 
 def write_headers(hduobj, idiobj, verbosity=0):
@@ -60,7 +75,198 @@ def write_headers(hduobj, idiobj, verbosity=0):
             hduobj.attrs[key+"_COMMENT"] = comment
     return hduobj
 
-def read_hdf(infile, mode='r+', verbosity=0):
+def _hdu_option(option, gname):
+    """ Return the value of a read option for HDU gname
+
+    Parameters
+    ----------
+    option: object, dict or None
+        Value to apply to every HDU, or dictionary of HDU name: value.
+    gname: str
+        Name of HDU
+
+    Returns
+    -------
+    value: object or None
+        Value for this HDU, or None if the option does not apply to it.
+    """
+    if isinstance(option, dict):
+        for hdu_name, value in option.items():
+            if hdu_name.upper() == gname.upper():
+                return value
+        return None
+    return option
+
+def _column_selection(columns, gname):
+    """ Return the set of column names to read from HDU gname, or None for all """
+    col_names = _hdu_option(columns, gname)
+    if col_names is None:
+        return None
+    return set(col_names)
+
+def _check_columns(col_selection, tbl_cols, gname, filename):
+    """ Raise KeyError if any selected column is not among the (name, units) in tbl_cols """
+    if col_selection is None:
+        return
+    missing = col_selection - set(col_name for col_name, col_units in tbl_cols)
+    if missing:
+        raise KeyError("Column(s) %s not found in HDU %s of %s" %
+                       (", ".join(sorted(missing)), gname, filename))
+
+def _table_columns(dset, entry=None):
+    """ Return list of (name, units) for the fields of a TABLE dataset, in order
+
+    Parameters
+    ----------
+    dset: h5py dataset
+        Compound TABLE dataset
+    entry: dict or None
+        HDU index entry (see read_hdu_index). If None, the FIELD_N attributes are read.
+    """
+    if entry is not None:
+        return [(col["name"], col["unit"]) for col in entry["columns"]]
+
+    tbl_cols = []
+    for col_num in range(len(dset.dtype.fields)):
+        col_name = dset.attrs["FIELD_%i_NAME" % col_num][0]
+        if isinstance(col_name, bytes):
+            col_name = col_name.decode('utf-8')
+        try:
+            col_units = dset.attrs["FIELD_%i_UNITS" % col_num][0]
+        except KeyError:
+            col_units = None
+        tbl_cols.append((col_name, col_units))
+    return tbl_cols
+
+def _data_group_columns(tbl_group, entry=None, col_selection=None):
+    """ Return list of (name, units) for the columns of a DATA_GROUP, in order
+
+    Parameters
+    ----------
+    tbl_group: h5py group
+        DATA_GROUP group
+    entry: dict or None
+        HDU index entry (see read_hdu_index). If None, the COLUMN_ID and UNITS
+        attributes of each column dataset are read.
+    col_selection: set or None
+        Only return these columns. Other column datasets are not touched.
+    """
+    if entry is not None:
+        cols = sorted(entry["columns"], key=lambda col: col["id"])
+        return [(col["name"], col["unit"]) for col in cols
+                if col_selection is None or col["name"] in col_selection]
+
+    col_names = tbl_group.keys()
+    if col_selection is not None:
+        col_names = [col_name for col_name in col_names if col_name in col_selection]
+
+    # First, need to figure out column order
+    col_order = {}
+    for col_name in col_names:
+        col_dset = tbl_group[col_name]
+        try:
+            col_units = col_dset.attrs["UNITS"][0]
+        except KeyError:
+            col_units = None
+        col_order[col_dset.attrs["COLUMN_ID"][0]] = (col_name, col_units)
+    return [col_order[pos] for pos in sorted(col_order)]
+
+def read_hdu_index(h):
+    """ Read the root-level HDU index written by export_hdf
+
+    The index is a JSON string stored in the HDU_INDEX attribute of the root
+    group. It lists, for each HDU, its name, position, class, shape and dtype,
+    whether it has COMMENT / HISTORY, and for tables the name, id, unit,
+    shape and dtype of each column.
+
+    Parameters
+    ----------
+    h: h5py File or Group
+        HDFITS root group
+
+    Returns
+    -------
+    hdu_index: list of dict, or None
+        List of HDU entries, or None if there is no (valid) index, in which
+        case the HDU groups must be scanned.
+    """
+    try:
+        index_str = h.attrs[HDU_INDEX_KEY]
+    except KeyError:
+        return None
+    if isinstance(index_str, bytes):
+        index_str = index_str.decode('utf-8')
+    hdu_index = json.loads(index_str)
+
+    # Fall back to scanning if the file has been modified since the index was written
+    if hdu_index.get("version") != HDU_INDEX_VERSION:
+        return None
+    if set(entry["name"] for entry in hdu_index["hdus"]) != set(h.keys()):
+        return None
+    return hdu_index["hdus"]
+
+def _index_columns_match(group, entry):
+    """ Check that the columns of a table HDU index entry are those in the file
+
+    Columns can be added to or deleted from a DATA_GROUP (or a TABLE
+    rewritten) without updating the index, so this is checked per HDU,
+    when its group is read.
+    """
+    if "columns" not in entry:
+        return True
+    try:
+        tbl_data = group["DATA"]
+    except KeyError:
+        return False
+    if isinstance(tbl_data, h5py.Group):
+        col_names = tbl_data.keys()
+    else:
+        col_names = tbl_data.dtype.names or ()
+    return set(col["name"] for col in entry["columns"]) == set(col_names)
+
+def _hdu_index_entry(name, position, idiobj, table_type, byteorder=None):
+    """ Create the HDU index entry for an HDU (see read_hdu_index)
+
+    Parameters
+    ----------
+    name: str
+        Name of HDU
+    position: int
+        Position of HDU in file
+    idiobj: IdiImageHdu, IdiTableHdu, IdiPrimaryHdu
+        HDU being written
+    table_type: str
+        DATA_GROUP or TABLE
+    byteorder: str or None
+        Byte order option the data are written with (see export_hdf)
+    """
+    entry = {"name": name, "position": position,
+             "comment": bool(idiobj.comment), "history": bool(idiobj.history)}
+
+    if isinstance(idiobj, IdiTableHdu):
+        entry["class"] = table_type
+        entry["shape"] = [len(idiobj)]
+        entry["columns"] = []
+        for col_num, col_name in enumerate(idiobj.colnames):
+            column = idiobj[col_name]
+            entry["columns"].append({
+                "name": col_name,
+                "id": col_num,
+                "unit": str(column.unit) if column.unit else None,
+                "shape": list(column.shape),
+                "dtype": bs.stored_dtype(column.dtype, byteorder).str,
+            })
+    elif isinstance(idiobj, IdiImageHdu):
+        entry["class"] = "IMAGE"
+        entry["shape"] = list(idiobj.data.shape)
+        entry["dtype"] = bs.stored_dtype(idiobj.data.dtype, byteorder).str
+    else:
+        entry["class"] = "PRIMARY"
+    return entry
+
+@tracing.traced()
+def read_hdf(infile, mode='r+', verbosity=0, lazy=False, hdus=None, columns=None,
+             rows=None, section=None, workers=1):
     """ Read and load contents of an HDF file
 
     Parameters
@@ -71,6 +277,33 @@ def read_hdf(infile, mode='r+', verbosity=0):
         file read mode. Defaults to 'r+'
     verbosity: int
         Level of verbosity, none (0) to all (5)
+    lazy: bool
+        If True, table columns and image data are returned as IdiLazyColumn /
+        IdiLazyArray views that only read the slices that are indexed. The file
+        is left open; call close() on the returned IdiHdulist when done.
+    hdus: list of str
+        Names of HDUs to read. Defaults to None (read all HDUs). Other HDU
+        groups in the file are not touched.
+    columns: list of str, or dict
+        Names of columns to read from table HDUs. Either a list that is applied
+        to every table HDU, or a dictionary of HDU name: list of column names.
+        Defaults to None (read all columns). A KeyError is raised if a table
+        HDU does not have a column that is asked for.
+    rows: slice, array of int or bool, or dict
+        Rows to read from table HDUs: a slice, an array of row indexes or a
+        boolean row mask. Either applied to every table HDU, or a dictionary
+        of HDU name: rows. Only the selected rows are read from disk.
+    section: tuple of slices, or dict
+        Hyperslab to read from image HDUs, e.g. (slice(0, 1024), slice(0, 1024)).
+        Either applied to every image HDU, or a dictionary of HDU name: section.
+        Only the selected part of the image is read from disk.
+    workers: int
+        Number of threads used to decompress gzip compressed images, TABLE
+        datasets and DATA_GROUP columns that are read in full. Defaults to 1.
+
+    Notes
+    -----
+    Selections given by rows and section are read into memory, even if lazy is True.
     """
 
     hdulist = idi.IdiHdulist()
@@ -80,8 +313,8 @@ def read_hdf(infile, mode='r+', verbosity=0):
     else:
         h = h5py.File(infile, mode=mode)
         is_file = True
-
-    hdulist.hdf = h
+        # Only files opened here are closed by IdiHdulist.close
+        hdulist.hdf = h
 
     pp = PrintLog(verbosity=verbosity)
     pp.debug(h.items())
@@ -96,15 +329,41 @@ def read_hdf(infile, mode='r+', verbosity=0):
     if b"HDFITS" not in cls:
         pp.warn("CLASS %s: Not an HDFITS file." % cls[0])
 
+    # Use the root-level HDU index if there is one, otherwise scan the groups
+    hdu_index = read_hdu_index(h)
+    if hdu_index is None:
+        gnames = list(h.keys())
+    else:
+        gnames = [entry["name"] for entry in hdu_index]
+
+    # Only touch the groups of HDUs that have been asked for
+    if hdus is not None:
+        gnames_upper = dict((gname.upper(), gname) for gname in gnames)
+        try:
+            gnames = [gnames_upper[hdu_name.upper()] for hdu_name in hdus]
+        except KeyError as e:
+            raise KeyError("HDU %s not found in %s" % (e, h.file.filename))
+
     # Read the order of HDUs from file
     hdu_order = {}
-    for gname in h.keys():
-        pos = h[gname].attrs["POSITION"][0]
-        hdu_order[pos] = gname
+    hdu_entries = {}
+    if hdu_index is None:
+        for gname in gnames:
+            pos = h[gname].attrs["POSITION"][0]
+            hdu_order[pos] = gname
+    else:
+        for entry in hdu_index:
+            if entry["name"] in gnames:
+                hdu_order[entry["position"]] = entry["name"]
+                hdu_entries[entry["name"]] = entry
 
-    for pos, gname in hdu_order.items():
+    for pos, gname in sorted(hdu_order.items()):
         group = h[gname]
+        entry = hdu_entries.get(gname)
         pp.h2("Reading %s" % gname)
+        if entry is not None and not _index_columns_match(group, entry):
+            pp.debug("HDU index out of date for %s, scanning its columns" % gname)
+            entry = None
 
         # Form header dict from
         h_vals = {}
@@ -117,84 +376,119 @@ def read_hdf(infile, mode='r+', verbosity=0):
         #hv = group.attrs.values()
         #h_vals = dict(zip(hk, hv))
 
-        try:
-            h_comment = group["COMMENT"]
-        except KeyError:
-            h_comment = None
-        try:
-            h_history = group["HISTORY"]
-        except KeyError:
-            h_history = None
+        h_comment = None
+        h_history = None
+        if entry is None or entry["comment"]:
+            try:
+                h_comment = group["COMMENT"]
+            except KeyError:
+                pass
+        if entry is None or entry["history"]:
+            try:
+                h_history = group["HISTORY"]
+            except KeyError:
+                pass
         #header = IdiHeader(values=h_vals, comment=h_comment, history=h_history)
         #print header.vals.keys()
 
-        pp.pp(group.keys())
-        if b"DATA" not in group:
+        if entry is not None:
+            hdu_class = entry["class"]
+        elif b"DATA" not in group:
+            hdu_class = "PRIMARY"
+        else:
+            hdu_class = np.atleast_1d(group["DATA"].attrs["CLASS"])[0]
+            if isinstance(hdu_class, bytes):
+                hdu_class = hdu_class.decode('utf-8')
+
+        if hdu_class == "PRIMARY":
             pp.h3("Adding Primary %s" % gname)
             hdulist.add_primary_hdu(gname, header=h_vals, history=h_history, comment=h_comment)
 
-        elif group["DATA"].attrs["CLASS"] == b"TABLE":
+        elif hdu_class == "TABLE":
             pp.h3("Adding Table %s" % gname)
             #self.add_table(gname)
             data = None
 
             if group["DATA"].dtype.fields is not None:
                 data = IdiTableHdu(gname)
-                for col_num in range(len(group["DATA"].dtype.fields)):
-                    col_name = group["DATA"].attrs["FIELD_%i_NAME" % col_num][0]
-                    if isinstance(col_name, bytes):
-                        col_name = col_name.decode('utf-8')
-                    try:
-                        col_units = group["DATA"].attrs["FIELD_%i_UNITS" % col_num][0]
-                    except KeyError:
-                        col_units = None
-
+                col_selection = _column_selection(columns, gname)
+                row_selection = _hdu_option(rows, gname)
+
+                tbl_cols = []
+                for col_name, col_units in _table_columns(group["DATA"], entry):
+                    if col_selection is None or col_name in col_selection:
+                        tbl_cols.append((col_name, col_units))
+                _check_columns(col_selection, tbl_cols, gname, h.file.filename)
+
+                # Read the compound dataset in a single pass, then create columns
+                # as views of the fields, instead of re-reading it for every column
+                tbl_data = None
+                if row_selection is not None or not lazy:
+                    if row_selection is None:
+                        row_selection = slice(None)
+                    field_names = [col_name for col_name, col_units in tbl_cols]
+                    if len(field_names) == len(group["DATA"].dtype.fields):
+                        if isinstance(row_selection, slice) and row_selection == slice(None):
+                            tbl_data = bs.read_dataset(group["DATA"], workers)
+                        else:
+                            tbl_data = idi.IdiLazyArray(group["DATA"])[row_selection]
+                    else:
+                        tbl_data = idi.IdiLazyArray(group["DATA"], field=field_names)[row_selection]
+
+                for col_name, col_units in tbl_cols:
                     pp.debug("Reading col %s > %s" %(gname, col_name))
-                    dset = group["DATA"][col_name][:]
-
-                    #self[gname].data[dname] = dset[:]
-                    #self[gname].n_rows = dset.shape[0]
+                    if tbl_data is not None:
+                        idi_col = idi.IdiColumn(col_name, tbl_data[col_name], unit=col_units)
+                    else:
+                        idi_col = idi.IdiLazyColumn(col_name, group["DATA"], unit=col_units,
+                                                    field=col_name)
+                    data.add_column(idi_col, copy=False)
 
-                    idi_col = idi.IdiColumn(col_name, dset[:], unit=col_units)
-                    data.add_column(idi_col)
-                    col_num += 1
+            hdulist.add_table_hdu(gname, header=h_vals, data=data, history=h_history,
+                                  comment=h_comment, copy=False)
 
-            hdulist.add_table_hdu(gname,
-                           header=h_vals, data=data, history=h_history, comment=h_comment)
-
-        elif group["DATA"].attrs["CLASS"] == b"DATA_GROUP":
+        elif hdu_class == "DATA_GROUP":
             pp.h3("Adding data group %s" % gname)
             data = IdiTableHdu(gname)
 
-            # First, need to figure out column order
-            col_order = {}
-            #print group["DATA"].keys()
-            for col_name in group["DATA"].keys():
-                #print group["DATA"][col_name].attrs.items()
-                pos = group["DATA"][col_name].attrs["COLUMN_ID"][0]
-                col_order[pos] = col_name
+            col_selection = _column_selection(columns, gname)
+            row_selection = _hdu_option(rows, gname)
 
-            #print col_order
-            for pos, col_name in col_order.items():
+            tbl_cols = _data_group_columns(group["DATA"], entry, col_selection)
+            _check_columns(col_selection, tbl_cols, gname, h.file.filename)
+            for col_name, col_units in tbl_cols:
                 pp.debug("Reading col %s > %s" %(gname, col_name))
 
                 col_dset = group["DATA"][col_name]
-
-                try:
-                    col_units = col_dset.attrs["UNITS"][0]
-                except:
-                    col_units = None
-                col_num   = col_dset.attrs["COLUMN_ID"][0]
-                idi_col = idi.IdiColumn(col_name, col_dset[:], unit=col_units)
+                if isinstance(col_dset, h5py.Group):
+                    if row_selection is not None:
+                        idi_col = read_var_column(col_dset, col_name, col_units, True)[row_selection]
+                    else:
+                        idi_col = read_var_column(col_dset, col_name, col_units, lazy, workers)
+                elif row_selection is not None:
+                    dset = idi.IdiLazyArray(col_dset)[row_selection]
+                    idi_col = idi.IdiColumn(col_name, dset, unit=col_units)
+                elif lazy:
+                    idi_col = idi.IdiLazyColumn(col_name, col_dset, unit=col_units)
+                else:
+                    idi_col = idi.IdiColumn(col_name, bs.read_dataset(col_dset, workers),
+                                            unit=col_units)
                 data.add_column(idi_col)
 
             hdulist.add_table_hdu(gname,
                            header=h_vals, data=data, history=h_history, comment=h_comment)
 
-        elif group["DATA"].attrs["CLASS"] == b"IMAGE":
+        elif hdu_class == "IMAGE":
             pp.h3("Adding Image %s" % gname)
+            img_section = _hdu_option(section, gname)
+            if img_section is not None:
+                img_data = idi.IdiLazyArray(group["DATA"])[img_section]
+            elif lazy:
+                img_data = idi.IdiLazyArray(group["DATA"])
+            else:
+                img_data = bs.read_dataset(group["DATA"], workers)
             hdulist.add_image_hdu(gname,
-                           header=h_vals, data=group["DATA"][:], history=h_history, comment=h_comment)
+                           header=h_vals, data=img_data, history=h_history, comment=h_comment)
 
         else:
             pp.warn("Cannot understand data class of %s" % gname)
@@ -203,7 +497,7 @@ def read_hdf(infile, mode='r+', verbosity=0):
         #for hkey, hval in group["HEADER"].attrs.items():
         #    self[gname].header.vals[hkey] = hval
 
-    if is_file:
+    if is_file and not lazy:
         h.close()
 
     return hdulist
@@ -226,14 +520,51 @@ def export_hdf(idi_hdu, outfile, table_type='DATA_GROUP', **kwargs):
         compression=None, apply compression (lzf, bitshuffle, gzip)
         shuffle=False, apply shuffle precompression filter
         chunks=None, set chunk size
+    and the following, used by fits2hdf:
+        max_memory=256 MiB, memory budget (bytes) for copying data that are
+        not in memory (e.g. IdiLazyArray images) block by block
+        workers=1, number of threads used to compress gzip datasets
+        byteorder=None, byte order of numeric datasets ('<', '>' or '=').
+        By default data are stored in their own byte order, so data read
+        from FITS are stored big-endian without a byteswap, and can be
+        written back to FITS without one.
     """
 
     if not isinstance(idi_hdu, IdiHdulist):
         raise RuntimeError("This function must be run on an IdiHdulist object")
 
+    export_hdf_stream(idi_hdu.items(), outfile, table_type=table_type, **kwargs)
+
+
+@tracing.traced()
+def export_hdf_stream(hdu_iter, outfile, table_type='DATA_GROUP', **kwargs):
+    """ Export a stream of HDUs to HDF file, writing each HDU as it arrives
+
+    Each HDU is written to file before the next one is taken from hdu_iter,
+    and no reference to it is kept, so when used with fitsio.iter_fits peak
+    memory is bounded by the largest HDU rather than the whole file.
+
+    Parameters
+    ----------
+    hdu_iter: iterable of (str, HDU) pairs
+        Names and IdiImageHdu / IdiTableHdu / IdiPrimaryHdu objects to write,
+        e.g. IdiHdulist.items() or fitsio.iter_fits()
+    outfile: str
+        Name of output file
+    table_type: str
+        Write tables as DATA_GROUP (column-store) or TABLE (row-store)
+
+    Keyword arguments (kwargs)
+    --------------------------
+    These are passed to h5py, see export_hdf, apart from:
+        metrics=None, a list; if given, a dictionary of timings and sizes is
+        appended for each HDU written, see export_hdu
+    """
+
     verbosity = 0
     if 'verbosity' in kwargs:
         verbosity = kwargs['verbosity']
+    metrics = kwargs.pop('metrics', None)
 
     if not table_type in ('DATA_GROUP', 'TABLE'):
         raise RuntimeError("Table output must be DATA_GROUP or TABLE, not %s" % table_type)
@@ -242,111 +573,253 @@ def export_hdf(idi_hdu, outfile, table_type='DATA_GROUP', **kwargs):
 
     with h5py.File(outfile, mode='w') as h:
         #print outfile
-        idi_hdu.hdf = h
-
-        idi_hdu.hdf.attrs["CLASS"] = np.string_(["HDFITS"])
+        h.attrs["CLASS"] = np.string_(["HDFITS"])
 
         hdu_id = 0
-        for gkey, gdata in idi_hdu.items():
+        hdu_index = []
+        for gkey, gdata in hdu_iter:
             pp.h2("Creating %s" % gkey)
             hdu_id += 1
+            hdu_index.append(_hdu_index_entry(gkey, hdu_id, gdata, table_type,
+                                              kwargs.get('byteorder')))
+            with tracing.span("export_hdu", hdu=gkey):
+                export_hdu(h, gkey, gdata, hdu_id, table_type=table_type, metrics=metrics, **kwargs)
 
-            # Create the new group
-            gg = h.create_group(gkey)
-            gg.attrs["CLASS"] = np.string_(["HDU"])
-            gg.attrs["POSITION"] = np.array([hdu_id])
-            #hg = gg.create_group("HEADER")
-
-            # Check if the data is TABLE (i.e. row-store type table)
-            if isinstance(idi_hdu[gkey], IdiTableHdu) and table_type == 'TABLE':
-                try:
-                    dd = idi_hdu[gkey]
-
-                    if dd is not None:
-                        dset = bs.create_dataset(gg, "DATA", dd, **kwargs)
-                        dset.attrs["CLASS"] = np.string_(["TABLE"])
-
-                        col_num = 0
-                        for col_name, column in idi_hdu[gkey].columns.items():
-
-                            col_dtype = column.dtype
-
-                            if column.unit is not None:
-                                col_units = str(column.unit)
-                            else:
-                                col_units = None
-
-                            if col_dtype.type is np.string_:
-                                dset.attrs["FIELD_%i_FILL" % col_num] = np.string_([''])
-                            else:
-                                dset.attrs["FIELD_%i_FILL" % col_num] = np.array([0])
-                            dset.attrs["FIELD_%i_NAME" % col_num] = np.string_([col_name])
-
-                            if col_units:
-                                dset.attrs["FIELD_%i_UNITS" % col_num] = np.string_([col_units])
-                            col_num += 1
-
-                        dset.attrs["NROWS"]   = np.array([dd.columns[0].shape[0]])
-                        dset.attrs["VERSION"] = np.array([2.6])     #TODO: Move this version no
-                        dset.attrs["TITLE"]   = np.string_([gkey])
-
-                except:
-                    pp.err("%s" % gkey)
-                    raise
-
-            # check if the data is a data group (i.e. column-store type table)
-            if isinstance(idi_hdu[gkey], IdiTableHdu) and table_type == 'DATA_GROUP':
-                try:
-                    col_num = 0
-                    tbl_group = gg.create_group("DATA")
-                    tbl_group.attrs["CLASS"] = np.string_(["DATA_GROUP"])
-
-                    for dkey, dval in idi_hdu[gkey].columns.items():
-                        data = dval.data
-                        #print "Adding col %s > %s" % (gkey, dkey)
-                        pp.debug("Adding col %s > %s" % (gkey, dkey))
-
-                        dset = bs.create_dataset(tbl_group, dkey, data, **kwargs)
-
-                        dset.attrs["CLASS"] = np.string_(["COLUMN"])
-                        dset.attrs["COLUMN_ID"] = np.array([col_num])
-                        if dval.unit:
-                            dset.attrs["UNITS"] = np.string_([str(dval.unit)])
-                        col_num += 1
-                except:
-                    pp.err("%s > %s" % (gkey, dkey))
-                    raise
-
-            elif isinstance(idi_hdu[gkey], IdiImageHdu):
-                pp.debug("Adding %s > DATA" % gkey)
-                dset = bs.create_dataset(gg, "DATA", idi_hdu[gkey].data, **kwargs)
-
-                # Add image-specific attributes
-                dset.attrs["CLASS"] = np.string_(["IMAGE"])
-                dset.attrs["IMAGE_VERSION"] = np.string_(["1.2"])
-                if idi_hdu[gkey].data.ndim == 2:
-                    dset.attrs["IMAGE_SUBCLASS"] = np.string_(["IMAGE_GRAYSCALE"])
-                    dset.attrs["IMAGE_MINMAXRANGE"] = np.array([np.min(idi_hdu[gkey].data), np.max(idi_hdu[gkey].data)])
-
-            elif isinstance(idi_hdu[gkey], IdiPrimaryHdu):
-                pass
+            # Drop the reference so the data can be freed before the next HDU is read
+            del gdata
 
-            # Add header values
-            #print self[gkey].header
+        # Consolidated index, so readers don't need to scan every group
+        h.attrs[HDU_INDEX_KEY] = json.dumps({"version": HDU_INDEX_VERSION, "hdus": hdu_index})
 
-            write_headers(gg, idi_hdu[gkey], verbosity=verbosity)
-            #for hkey, hval in idi_hdu[gkey].header.items():
-            #
-            #    pp.debug("Adding header %s > %s" % (hkey, hval))
-            #    gg.attrs[hkey] = np.array(hval)
 
-            # Need to use special dtype for variable-length strings
-            if six.PY2:
-                unicode_dt = h5py.special_dtype(vlen=unicode)
-            else:
-                unicode_dt = h5py.special_dtype(vlen=str)
+def export_var_column(tbl_group, name, column, **kwargs):
+    """ Write a variable-length array column to a DATA_GROUP
+
+    The column is written as a group holding two datasets: VALUES, the values
+    of all rows in a flat array, which is compressed like other columns, and
+    OFFSETS, the n_rows + 1 offsets of the rows into VALUES.
 
-            if idi_hdu[gkey].comment:
-                gg.create_dataset("COMMENT", data=np.string_(idi_hdu[gkey].comment), dtype=unicode_dt)
-            if idi_hdu[gkey].history:
-                gg.create_dataset("HISTORY", data=np.string_(idi_hdu[gkey].history), dtype=unicode_dt)
+    Parameters
+    ----------
+    tbl_group: h5py group
+        DATA_GROUP to add the column to
+    name: str
+        Name of column
+    column: IdiVarColumn
+        Column to write
+
+    Keyword arguments (kwargs)
+    --------------------------
+    These are passed to h5py, see export_hdf.
+
+    Returns
+    -------
+    col_group: h5py group
+    """
+    col_group = tbl_group.create_group(name)
+    col_group.attrs["CLASS"] = np.string_(["VLA_COLUMN"])
+    offsets = column.offsets
+    values = column.values
+    if offsets[0] != 0 or offsets[-1] != len(values):
+        values = np.asarray(values)[offsets[0]:offsets[-1]]
+        offsets = offsets - offsets[0]
+    bs.create_dataset(col_group, "VALUES", values, **kwargs)
+    bs.create_dataset(col_group, "OFFSETS", offsets, **kwargs)
+    return col_group
+
+def read_var_column(col_group, name, unit=None, lazy=False, workers=1):
+    """ Read a variable-length array column written by export_var_column
+
+    Parameters
+    ----------
+    col_group: h5py group
+        Group holding the VALUES and OFFSETS datasets
+    name: str
+        Name of column
+    unit: str or None
+        Physical unit
+    lazy: bool
+        If True, values are read on demand. Offsets are always read.
+    workers: int
+        Number of threads used to decompress gzip compressed values
+
+    Returns
+    -------
+    column: IdiVarColumn
+    """
+    offsets = bs.read_dataset(col_group["OFFSETS"], workers)
+    if lazy:
+        values = idi.IdiLazyArray(col_group["VALUES"])
+    else:
+        values = bs.read_dataset(col_group["VALUES"], workers)
+    return idi.IdiVarColumn(name, values, offsets, unit=unit)
+
+def export_hdu(h, gkey, gdata, hdu_id, table_type='DATA_GROUP', metrics=None, **kwargs):
+    """ Write a single HDU to an HDFITS file
+
+    Parameters
+    ----------
+    h: h5py File
+        HDFITS file to write to
+    gkey: str
+        Name of HDU
+    gdata: IdiImageHdu, IdiTableHdu or IdiPrimaryHdu
+        HDU to write
+    hdu_id: int
+        Position of HDU in file (starting at 1)
+    table_type: str
+        Write tables as DATA_GROUP (column-store) or TABLE (row-store)
+    metrics: list or None
+        If given, a dictionary is appended with the HDU name, write_time (s),
+        bytes_in (uncompressed), bytes_out (stored), compression ratio, and
+        the same for each dataset under "columns" (DATA_GROUP tables only)
+
+    Keyword arguments (kwargs)
+    --------------------------
+    These are passed to h5py, see export_hdf.
+    """
+    verbosity = kwargs.get('verbosity', 0)
+    pp = PrintLog(verbosity=verbosity)
+    t_start = time.time()
+    dset_metrics = []
+
+    # Create the new group
+    gg = h.create_group(gkey)
+    gg.attrs["CLASS"] = np.string_(["HDU"])
+    gg.attrs["POSITION"] = np.array([hdu_id])
+    #hg = gg.create_group("HEADER")
+
+    # Check if the data is TABLE (i.e. row-store type table)
+    if isinstance(gdata, IdiTableHdu) and table_type == 'TABLE':
+        try:
+            dd = gdata
+
+            if dd is not None:
+                for col_name, column in gdata.columns.items():
+                    if isinstance(column, idi.IdiVarColumn):
+                        raise RuntimeError("Variable-length column %s > %s cannot be written as "
+                                           "TABLE, use DATA_GROUP" % (gkey, col_name))
+                t1 = time.time()
+                # Build one structured array of all columns, and write it in
+                # chunks of rows, so that compression filters can be applied.
+                # Fields keep their byte order, which the byteorder option applies to.
+                tbl_data = dd.as_array(keep_byteorder=True)
+                tbl_kwargs = dict(kwargs)
+                if tbl_kwargs.pop('scaleoffset', None) is not None:
+                    pp.warn("Scale-offset filter cannot be applied to TABLE %s" % gkey)
+                if tbl_kwargs.get('chunks') is None:
+                    tbl_kwargs['chunks'] = bs.guess_row_chunk(len(tbl_data), tbl_data.dtype.itemsize)
+                if len(tbl_data) == 0:
+                    # Chunks can only be larger than the dataset if it is resizable
+                    tbl_kwargs['maxshape'] = (None, )
+                dset = bs.create_dataset(gg, "DATA", tbl_data, **tbl_kwargs)
+                del tbl_data
+                dset_metrics.append(_dataset_metrics("DATA", dset, time.time() - t1))
+                dset.attrs["CLASS"] = np.string_(["TABLE"])
+
+                col_num = 0
+                for col_name, column in gdata.columns.items():
+
+                    col_dtype = column.dtype
+
+                    if column.unit is not None:
+                        col_units = str(column.unit)
+                    else:
+                        col_units = None
+
+                    if col_dtype.type is np.string_:
+                        dset.attrs["FIELD_%i_FILL" % col_num] = np.string_([''])
+                    else:
+                        dset.attrs["FIELD_%i_FILL" % col_num] = np.array([0])
+                    dset.attrs["FIELD_%i_NAME" % col_num] = np.string_([col_name])
+
+                    if col_units:
+                        dset.attrs["FIELD_%i_UNITS" % col_num] = np.string_([col_units])
+                    col_num += 1
+
+                dset.attrs["NROWS"]   = np.array([dd.columns[0].shape[0]])
+                dset.attrs["VERSION"] = np.array([2.6])     #TODO: Move this version no
+                dset.attrs["TITLE"]   = np.string_([gkey])
+
+        except:
+            pp.err("%s" % gkey)
+            raise
+
+    # check if the data is a data group (i.e. column-store type table)
+    if isinstance(gdata, IdiTableHdu) and table_type == 'DATA_GROUP':
+        try:
+            col_num = 0
+            tbl_group = gg.create_group("DATA")
+            tbl_group.attrs["CLASS"] = np.string_(["DATA_GROUP"])
+
+            for dkey, dval in gdata.columns.items():
+                data = dval.data
+                #print "Adding col %s > %s" % (gkey, dkey)
+                pp.debug("Adding col %s > %s" % (gkey, dkey))
+
+                t1 = time.time()
+                if isinstance(dval, idi.IdiVarColumn):
+                    dset = export_var_column(tbl_group, dkey, dval, **kwargs)
+                    dset_metrics.append(_dataset_metrics(dkey, dset["VALUES"], time.time() - t1))
+                else:
+                    dset = bs.create_dataset(tbl_group, dkey, data, **kwargs)
+                    dset_metrics.append(_dataset_metrics(dkey, dset, time.time() - t1))
+                    dset.attrs["CLASS"] = np.string_(["COLUMN"])
+                dset.attrs["COLUMN_ID"] = np.array([col_num])
+                if dval.unit:
+                    dset.attrs["UNITS"] = np.string_([str(dval.unit)])
+                col_num += 1
+        except:
+            pp.err("%s > %s" % (gkey, dkey))
+            raise
+
+    elif isinstance(gdata, IdiImageHdu):
+        pp.debug("Adding %s > DATA" % gkey)
+        t1 = time.time()
+        minmax = []
+        dset = bs.create_dataset(gg, "DATA", gdata.data, minmax=minmax, **kwargs)
+        dset_metrics.append(_dataset_metrics("DATA", dset, time.time() - t1))
+
+        # Add image-specific attributes
+        dset.attrs["CLASS"] = np.string_(["IMAGE"])
+        dset.attrs["IMAGE_VERSION"] = np.string_(["1.2"])
+        if gdata.data.ndim == 2:
+            dset.attrs["IMAGE_SUBCLASS"] = np.string_(["IMAGE_GRAYSCALE"])
+            if not minmax:
+                # Data written from memory in one go
+                max_memory = kwargs.get('max_memory', bs.DEFAULT_MAX_MEMORY)
+                minmax = bs.blocked_minmax(gdata.data, max_memory)
+            dset.attrs["IMAGE_MINMAXRANGE"] = np.array(minmax)
+
+    elif isinstance(gdata, IdiPrimaryHdu):
+        pass
+
+    # Add header values
+    #print self[gkey].header
+
+    write_headers(gg, gdata, verbosity=verbosity)
+    #for hkey, hval in gdata.header.items():
+    #
+    #    pp.debug("Adding header %s > %s" % (hkey, hval))
+    #    gg.attrs[hkey] = np.array(hval)
+
+    # Need to use special dtype for variable-length strings
+    if six.PY2:
+        unicode_dt = h5py.special_dtype(vlen=unicode)
+    else:
+        unicode_dt = h5py.special_dtype(vlen=str)
+
+    if gdata.comment:
+        gg.create_dataset("COMMENT", data=np.string_(gdata.comment), dtype=unicode_dt)
+    if gdata.history:
+        gg.create_dataset("HISTORY", data=np.string_(gdata.history), dtype=unicode_dt)
+
+    if metrics is not None:
+        bytes_in = sum(m["bytes_in"] for m in dset_metrics)
+        bytes_out = sum(m["bytes_out"] for m in dset_metrics)
+        hdu_metrics = {"name": gkey, "write_time": time.time() - t_start,
+                       "bytes_in": bytes_in, "bytes_out": bytes_out,
+                       "compression": float(bytes_in) / bytes_out if bytes_out else None}
+        if isinstance(gdata, IdiTableHdu) and table_type == 'DATA_GROUP':
+            hdu_metrics["columns"] = dset_metrics
+        metrics.append(hdu_metrics)
@@ -31,6 +31,10 @@ def open(*args, **kwargs):
     is a HDF5 file. If so, then the file is opened using fits2hdf.io.hdfio
     and then exported to a FITS file (in memory, not on disk).
 
+    The hdus and columns keyword arguments select which HDUs and table columns
+    are read from HDF5 files, and workers sets the number of decompression
+    threads (see fits2hdf.io.hdfio.read_hdf); they are ignored for FITS files.
+
     Notes
     -----
     If you're not careful, this will override the standard open() class. So,
@@ -38,6 +42,9 @@ def open(*args, **kwargs):
     #TODO: Do this slightly different, to avoid the open() issue
     """
     file_name = args[0]
+    hdus = kwargs.pop('hdus', None)
+    columns = kwargs.pop('columns', None)
+    workers = kwargs.pop('workers', 1)
     # Checking for HDF5 group
     if isinstance(file_name, h5py.Group):
         file_type = 'hdf'
@@ -47,7 +54,7 @@ def open(*args, **kwargs):
     if file_type == 'fits':
         return fits.open(*args, **kwargs)
     elif file_type == 'hdf':
-        hdul = read_hdf(file_name)
+        hdul = read_hdf(file_name, hdus=hdus, columns=columns, workers=workers)
         return create_fits(hdul)
     else:
         raise RuntimeError("File type could not be found from file extension.")
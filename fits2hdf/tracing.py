@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+tracing.py
+==========
+
+Lightweight timing spans for the conversion hot paths.
+
+Tracing is off by default, in which case span() returns a shared no-op
+context manager and traced functions only pay for one extra check. When
+enabled, each span records a Chrome trace "complete" event, so a trace can
+be viewed in chrome://tracing, Perfetto or speedscope (as a flame graph).
+
+Example
+-------
+
+    from fits2hdf import tracing
+    tracing.enable()
+    hdul = read_fits('file.fits')
+    tracing.write_chrome_trace(tracing.disable(), 'trace.json')
+"""
+
+import os
+import json
+import time
+import threading
+import functools
+
+# List of recorded events, or None if tracing is disabled
+_events = None
+
+
+class _NullSpan(object):
+    """ Span that does nothing, returned when tracing is disabled """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    """ Span that records a Chrome trace event when it exits """
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        t1 = time.time()
+        if _events is not None:
+            event = {"name": self.name, "ph": "X", "ts": self.t0 * 1e6, "dur": (t1 - self.t0) * 1e6,
+                     "pid": os.getpid(), "tid": threading.current_thread().ident}
+            if self.args:
+                event["args"] = dict((key, str(val)) for key, val in self.args.items())
+            _events.append(event)
+        return False
+
+
+def enable():
+    """ Start recording spans, discarding any recorded so far """
+    global _events
+    _events = []
+
+
+def disable():
+    """ Stop recording spans, and return the list of recorded events """
+    global _events
+    events, _events = _events, None
+    return events or []
+
+
+def is_enabled():
+    return _events is not None
+
+
+def span(name, **args):
+    """ Context manager that times a block of code as a named span
+
+    Parameters
+    ----------
+    name: str
+        Name of span, e.g. the stage or function name
+    args: dict
+        Extra information to attach to the span, e.g. the HDU name
+    """
+    if _events is None:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name=None):
+    """ Decorator that records each call to a function as a span """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _events is None:
+                return func(*args, **kwargs)
+            with _Span(span_name, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class ChromeTraceWriter(object):
+    """ Write events to a Chrome trace file (JSON array format) as they arrive
+
+    Parameters
+    ----------
+    filename: str
+        Output file name
+    """
+    def __init__(self, filename):
+        self._fh = open(filename, 'w')
+        self._fh.write('[\n')
+        self._first = True
+
+    def write(self, events):
+        for event in events or []:
+            if not self._first:
+                self._fh.write(',\n')
+            self._fh.write(json.dumps(event))
+            self._first = False
+        self._fh.flush()
+
+    def close(self):
+        self._fh.write('\n]\n')
+        self._fh.close()
+
+
+def write_chrome_trace(events, filename):
+    """ Write a list of events to a Chrome trace file """
+    writer = ChromeTraceWriter(filename)
+    writer.write(events)
+    writer.close()
@@ -23,7 +23,8 @@ entry_points = {
     'console_scripts' :
         ['fits2hdf = fits2hdf.file_conversion:convert_fits_to_hdf',
          'hdf2fits = fits2hdf.file_conversion:convert_hdf_to_fits',
-         'fits2fits = fits2hdf.file_conversion:convert_fits_to_fits']
+         'fits2fits = fits2hdf.file_conversion:convert_fits_to_fits',
+         'fits2hdf-catalog = fits2hdf.catalog:catalog_cli']
     }
 
 setup(name='fits2hdf',
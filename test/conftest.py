@@ -0,0 +1,38 @@
+import itertools
+
+import numpy as np
+import pytest
+from astropy.io import fits as pf
+
+
+def write_test_fits(filename, n_rows=1000):
+    """ Write a small multi-extension FITS file with an image and a binary table """
+    pri = pf.PrimaryHDU()
+    pri.header['OBJECT'] = 'M31'
+    img = pf.ImageHDU(np.arange(200 * 300, dtype='>i2').reshape(200, 300), name='SCI')
+    cols = [
+        pf.Column(name='a', format='E', unit='m', array=np.arange(n_rows, dtype='f4')),
+        pf.Column(name='b', format='3J', array=np.arange(3 * n_rows).reshape(n_rows, 3)),
+        pf.Column(name='name', format='8A', array=np.array(['x%i' % ii for ii in range(n_rows)])),
+        pf.Column(name='flag', format='L', array=np.arange(n_rows) % 2 == 0),
+    ]
+    tbl = pf.BinTableHDU.from_columns(cols, name='CAT')
+    pf.HDUList([pri, img, tbl]).writeto(filename, overwrite=True)
+
+
+@pytest.fixture
+def make_fits(tmp_path):
+    """ Return a function that writes a test FITS file (see write_test_fits) to tmp_path
+
+    The function is called as make_fits(name=None, n_rows=1000), and returns
+    the path of the file. Files are given unique names unless name is given.
+    """
+    counter = itertools.count()
+
+    def make(name=None, n_rows=1000):
+        if name is None:
+            name = 'test%i.fits' % next(counter)
+        filename = str(tmp_path / name)
+        write_test_fits(filename, n_rows=n_rows)
+        return filename
+    return make
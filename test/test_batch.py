@@ -0,0 +1,169 @@
+import os
+import json
+import shutil
+import argparse
+
+import numpy as np
+import pytest
+
+from fits2hdf import batch
+from fits2hdf.file_conversion import fits_to_hdf, iter_tasks
+from fits2hdf.io.hdfio import read_hdf
+
+
+def test_run_batch(tmp_path, make_fits):
+    tmpdir = str(tmp_path)
+    tasks = []
+    for ii, n_rows in enumerate((10, 1000, 100)):
+        file_in = make_fits('test%i.fits' % ii, n_rows=n_rows)
+        tasks.append((file_in, os.path.join(tmpdir, 'test%i.h5' % ii)))
+    with open(os.path.join(tmpdir, 'bad.fits'), 'w') as fh:
+        fh.write('not a FITS file')
+    tasks.append((os.path.join(tmpdir, 'bad.fits'), os.path.join(tmpdir, 'bad.h5')))
+
+    tasks = batch.sort_largest_first(tasks)
+    assert os.path.basename(tasks[0][0]) == 'test1.fits'
+    assert os.path.basename(tasks[-1][0]) == 'bad.fits'
+
+    for jobs in (1, 2):
+        results = list(batch.run_batch(fits_to_hdf, tasks, jobs=jobs, compression='gzip'))
+        assert sorted(r['file_in'] for r in results) == sorted(t[0] for t in tasks)
+
+        errors = [r for r in results if r['error'] is not None]
+        assert [os.path.basename(r['file_in']) for r in errors] == ['bad.fits']
+        for r in results:
+            if r['error'] is None:
+                assert r['size_out'] == os.path.getsize(r['file_out'])
+
+    a = read_hdf(os.path.join(tmpdir, 'test1.h5'), mode='r')
+    assert len(a['CAT']) == 1000
+    assert np.all(a['CAT']['a'] == np.arange(1000))
+
+
+def crash_on_name(file_in, file_out, **kwargs):
+    """ Conversion function whose worker process dies on files named crash* """
+    if os.path.basename(file_in).startswith('crash'):
+        os._exit(1)
+    return fits_to_hdf(file_in, file_out, **kwargs)
+
+
+def test_run_batch_worker_crash(tmp_path, make_fits):
+    """ Only the file that kills its worker fails, not the others queued with it """
+    tasks = []
+    for name in ('test0', 'test1', 'crash', 'test2', 'test3', 'test4'):
+        file_in = make_fits(name + '.fits', n_rows=10)
+        tasks.append((file_in, str(tmp_path / (name + '.h5'))))
+
+    results = list(batch.run_batch(crash_on_name, tasks, jobs=2))
+    assert sorted(r['file_in'] for r in results) == sorted(t[0] for t in tasks)
+    errors = [r for r in results if r['error'] is not None]
+    assert [os.path.basename(r['file_in']) for r in errors] == ['crash.fits']
+    assert errors[0]['error'].startswith('Worker process died')
+
+
+def test_metrics(tmp_path, make_fits):
+    tasks = [(make_fits(), str(tmp_path / 'test.h5'))]
+
+    for table_type in ('DATA_GROUP', 'TABLE'):
+        result, = batch.run_batch(fits_to_hdf, tasks, metrics=True, compression='gzip',
+                                  table_type=table_type)
+        record = batch.metrics_record(result)
+        json.dumps(record)
+        assert record['size_out'] == os.path.getsize(tasks[0][1])
+        assert record['peak_rss'] > 0
+        assert [hdu['name'] for hdu in record['hdus']] == ['PRIMARY', 'SCI', 'CAT']
+        sci = record['hdus'][1]
+        assert sci['bytes_in'] == 200 * 300 * 2
+        assert sci['compression'] > 1
+        assert record['write_time'] >= sci['write_time'] > 0
+        if table_type == 'DATA_GROUP':
+            columns = record['hdus'][2]['columns']
+            assert [col['name'] for col in columns] == ['a', 'b', 'name', 'flag']
+            assert columns[1]['bytes_in'] == 1000 * 3 * 4
+        else:
+            assert 'columns' not in record['hdus'][2]
+
+
+def test_manifest(tmp_path, make_fits):
+    tmpdir = str(tmp_path)
+    tasks = []
+    for ii in range(3):
+        file_in = make_fits('test%i.fits' % ii, n_rows=10 + ii)
+        tasks.append((file_in, os.path.join(tmpdir, 'test%i.h5' % ii)))
+    manifest_file = os.path.join(tmpdir, batch.MANIFEST_NAME)
+
+    def run(options):
+        manifest = batch.Manifest(manifest_file, options)
+        results = list(batch.run_batch(fits_to_hdf, tasks, manifest=manifest, **options))
+        manifest.close()
+        assert not [f for f in os.listdir(tmpdir) if f.endswith(batch.PARTIAL_SUFFIX)]
+        return sorted(os.path.basename(r['file_in']) for r in results), manifest.n_skipped
+
+    assert run({'compression': 'gzip'}) == (['test0.fits', 'test1.fits', 'test2.fits'], 0)
+    assert run({'compression': 'gzip'}) == ([], 3)
+
+    # Touched but unchanged files are not converted again
+    os.utime(tasks[0][0], (0, 0))
+    assert run({'compression': 'gzip'}) == ([], 3)
+
+    # Changed input, missing output, and new options are converted again
+    make_fits('test1.fits', n_rows=20)
+    os.remove(tasks[2][1])
+    assert run({'compression': 'gzip'}) == (['test1.fits', 'test2.fits'], 1)
+    assert run({'compression': 'lzf'}) == (['test0.fits', 'test1.fits', 'test2.fits'], 0)
+
+    # A truncated record, as left by a crash, is ignored
+    with open(manifest_file, 'a') as fh:
+        fh.write('{"path": "/trunc')
+    assert run({'compression': 'lzf'}) == ([], 3)
+    os.remove(tasks[0][1])
+    assert run({'compression': 'lzf'}) == (['test0.fits'], 2)
+    assert run({'compression': 'lzf'}) == ([], 3)
+
+
+def test_find_files(tmp_path):
+    tmpdir = str(tmp_path)
+    for rel_path in ('a.fits', 'b.txt', '2020/01/c.fits', '2020/02/d.fits', 'tmp/e.fits', 'out/f.fits'):
+        path = os.path.join(tmpdir, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write('x' * len(rel_path))
+
+    files = batch.find_files(tmpdir, ['*.fits'])
+    assert not isinstance(files, list)
+    assert sorted(files) == ['a.fits']
+
+    files = batch.find_files(tmpdir, ['*.fits'], exclude=['tmp', '*/02'], recursive=True,
+                             skip_dirs=[os.path.join(tmpdir, 'out')])
+    assert sorted(files) == ['2020/01/c.fits', 'a.fits']
+
+    # Symbolic links back to a parent directory are not followed round in a loop
+    os.symlink(tmpdir, os.path.join(tmpdir, '2020', 'loop'))
+    files = batch.find_files(tmpdir, ['*.fits'], exclude=['tmp', '*/02'], recursive=True,
+                             skip_dirs=[os.path.join(tmpdir, 'out')])
+    assert sorted(files) == ['2020/01/c.fits', 'a.fits']
+    os.remove(os.path.join(tmpdir, '2020', 'loop'))
+
+    # Only a trailing extension is replaced in output names
+    args = argparse.Namespace(ext='fits', include=None, exclude=[], recursive=True)
+    os.makedirs(os.path.join(tmpdir, 'a.fits.d'))
+    for name in ('x.fits', 'y.fits'):
+        with open(os.path.join(tmpdir, 'a.fits.d', name), 'w') as fh:
+            fh.write('x')
+    tasks = dict(iter_tasks(args, tmpdir, os.path.join(tmpdir, 'out'), '.h5'))
+    assert tasks[os.path.join(tmpdir, 'a.fits.d', 'x.fits')] == os.path.join(tmpdir, 'out', 'a.fits.d', 'x.h5')
+    assert tasks[os.path.join(tmpdir, 'a.fits')] == os.path.join(tmpdir, 'out', 'a.h5')
+    assert len(set(tasks.values())) == len(tasks)
+    shutil.rmtree(os.path.join(tmpdir, 'a.fits.d'))
+
+    # Files are sorted largest first within each window
+    tasks = [(os.path.join(tmpdir, path), path) for path in batch.find_files(tmpdir, recursive=True)]
+    sizes = [os.path.getsize(t[0]) for t in batch.sort_largest_first(iter(tasks), window=2)]
+    assert len(sizes) == len(tasks)
+    for ii in range(0, len(sizes), 2):
+        assert sizes[ii:ii + 2] == sorted(sizes[ii:ii + 2], reverse=True)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,88 @@
+import os
+
+import h5py
+import numpy as np
+import pytest
+from astropy.io import fits as pf
+
+from fits2hdf import catalog
+from fits2hdf.io.fitsio import read_fits
+from fits2hdf.io.hdfio import export_hdf
+
+
+def test_catalog(tmp_path, make_fits):
+    tmpdir = str(tmp_path)
+    export_hdf(read_fits(make_fits('m31.fits')), os.path.join(tmpdir, 'm31.h5'))
+    pri = pf.PrimaryHDU()
+    pri.header['OBJECT'] = 'NGC224'
+    pri.header['EXPTIME'] = 30.0
+    pf.HDUList([pri]).writeto(os.path.join(tmpdir, 'ngc224.fits'))
+    with open(os.path.join(tmpdir, 'bad.fits'), 'w') as fh:
+        fh.write('not a FITS file')
+
+    for ext in ('fits', 'h5'):
+        hdus = catalog.scan_file(os.path.join(tmpdir, 'm31.' + ext))['hdus']
+        assert [(h['name'], h['class']) for h in hdus] == [('PRIMARY', 'PRIMARY'), ('SCI', 'IMAGE'),
+                                                          ('CAT', 'TABLE')]
+        assert hdus[1]['shape'] == [200, 300] and hdus[1]['dtype'] == '>i2'
+        assert hdus[2]['shape'] == [1000]
+        assert hdus[2]['dtype'][:2] == [['a', '>f4'], ['b', '(3,)>i4']]
+        assert ('OBJECT', 'M31', '') in hdus[0]['keywords']
+
+    db_file = os.path.join(tmpdir, 'catalog.db')
+    files = [os.path.join(tmpdir, f) for f in ('m31.fits', 'm31.h5', 'ngc224.fits', 'bad.fits')]
+    cat = catalog.Catalog(db_file)
+    results = list(catalog.build_catalog(cat, files, jobs=2))
+    assert [r['error'] is None for r in results] == [True, True, True, False]
+
+    # Unchanged files are not rescanned, except those that failed
+    results = list(catalog.build_catalog(cat, files))
+    assert [os.path.basename(r['path']) for r in results] == ['bad.fits']
+
+    def paths(*conditions, **kwargs):
+        return [(os.path.basename(p), h) for p, h in cat.query(conditions, **kwargs)]
+
+    assert paths('OBJECT=M31') == [('m31.fits', None), ('m31.h5', None)]
+    assert paths('object = "NGC*"') == [('ngc224.fits', None)]
+    assert paths('OBJECT!=M31') == [('ngc224.fits', None)]
+    assert paths('EXPTIME<100') == [('ngc224.fits', None)]
+    assert paths('EXTNAME=SCI', 'OBJECT=M31') == [('m31.fits', None), ('m31.h5', None)]
+    assert paths('EXTNAME=SCI', 'OBJECT=M31', same_hdu=True) == []
+    assert paths('OBJECT=M31', same_hdu=True) == [('m31.fits', 'PRIMARY'), ('m31.h5', 'PRIMARY')]
+    cat.close()
+
+    try:
+        catalog._parse_condition('OBJECT')
+        assert False
+    except ValueError:
+        pass
+
+
+def test_scan_hdf_no_data(tmp_path, monkeypatch):
+    """ HDFITS files are scanned from the HDU index and dataset metadata, without
+    reading any data (including the OFFSETS of variable-length columns) """
+    fits_file = str(tmp_path / 'vla.fits')
+    n_rows = 50
+    cols = [pf.Column(name='spec', format='PE()',
+                      array=np.array([np.arange(ii % 5, dtype='f4') for ii in range(n_rows)], dtype=object)),
+            pf.Column(name='b', format='3J', array=np.arange(3 * n_rows).reshape(n_rows, 3))]
+    pf.HDUList([pf.PrimaryHDU(), pf.BinTableHDU.from_columns(cols, name='VLA')]).writeto(fits_file)
+    hdf_file = str(tmp_path / 'vla.h5')
+    export_hdf(read_fits(fits_file), hdf_file)
+
+    def no_read(self, args):
+        raise AssertionError("Dataset %s was read" % self.name)
+
+    monkeypatch.setattr(h5py.Dataset, '__getitem__', no_read)
+    for drop_index in (False, True):
+        if drop_index:
+            with h5py.File(hdf_file, 'r+') as h:
+                del h.attrs['HDU_INDEX']
+        hdus = catalog.scan_hdf(hdf_file)
+        assert [(h['name'], h['class']) for h in hdus] == [('PRIMARY', 'PRIMARY'), ('VLA', 'TABLE')]
+        assert hdus[1]['shape'] == [n_rows]
+        assert hdus[1]['dtype'] == [['spec', '>f4'], ['b', '(3,)>i4']]
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,105 @@
+import mmap
+import warnings
+
+import numpy as np
+import pytest
+from astropy.io import fits as pf
+
+from fits2hdf import idi
+from fits2hdf.io.fitsio import parse_fits_header, read_fits
+from fits2hdf.io.hdfio import read_hdf, export_hdf
+
+
+def test_parse_fits_header():
+    """ The fast header parser gives the same values as astropy, including for
+    cards it hands back to astropy (HIERARCH, CONTINUE, complex, undefined) """
+    cards = [
+        "STR1    = 'hello   '           / a comment",
+        "STR2    = '  lead'",
+        "STR3    = 'it''s'/nospace",
+        "INT1    =                  -07 / leading zero",
+        "INT2    =  123456789012345678901234",
+        "FLT1    =               1.5D-3",
+        "FLT2    =                  .25",
+        "FLT3    =                  1E5",
+        "BOOL    =                    F / false",
+        "CPLX    =           (1.0, 2.0)",
+        "UNDEF   =                      / undefined",
+        "HIERARCH ESO DET CHIP = 'ccd' / hierarch",
+        "lower   =                    3",
+        "COMMENT a comment",
+        "HISTORY   history with leading spaces   ",
+    ]
+    header_str = ''.join(card.ljust(80) for card in cards)
+    header_str += pf.Card('LONGSTR', 'x' * 200, 'long comment').image
+    header = pf.Header.fromstring(header_str)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        values, comment, history = parse_fits_header(pf.ImageHDU(header=header))
+        expected = pf.Header.fromstring(header_str)
+
+    assert comment == ['a comment']
+    assert history == ['  history with leading spaces']
+    for key in ('STR1', 'STR2', 'STR3', 'INT1', 'INT2', 'FLT1', 'FLT2', 'FLT3', 'BOOL',
+                'CPLX', 'ESO DET CHIP', 'LONGSTR'):
+        assert values[key] == expected[key]
+        assert type(values[key]) == type(expected[key])
+        assert values[key + '_COMMENT'] == expected.comments[key]
+    assert values['LOWER'] == 3
+    assert 'UNDEF' in values
+
+
+def test_read_fits_table_views(make_fits):
+    """ Table columns are views of the open FITS file's data, not copies """
+    fits_file = make_fits()
+
+    hdul = read_fits(fits_file)
+    fits_data = hdul.fits['CAT'].data
+    cat = hdul['CAT']
+    assert cat.colnames == ['a', 'b', 'name', 'flag']
+    assert np.shares_memory(cat['a'], fits_data)
+    assert np.shares_memory(cat['name'], fits_data)
+    assert cat['name'].dtype.kind == 'S'
+    assert str(cat['a'].unit) == 'm'
+    assert np.all(cat['b'] == np.arange(3000).reshape(1000, 3))
+    assert cat['flag'].dtype == bool and cat['flag'][0] and not cat['flag'][1]
+
+
+def test_read_fits_memmap(tmp_path):
+    """ With memmap, images are views of the mapped file, and scaled images are read lazily """
+    fits_file = str(tmp_path / 'test.fits')
+    hdf_file = str(tmp_path / 'test.h5')
+    img = np.arange(100 * 120, dtype='f4').reshape(100, 120)
+    scaled = np.arange(100 * 120, dtype='uint16').reshape(100, 120) + 40000
+    pf.HDUList([pf.PrimaryHDU(img), pf.ImageHDU(scaled, name='SCALED')]).writeto(fits_file)
+
+    hdul = read_fits(fits_file, memmap=True)
+    assert hdul['PRIMARY'].data.dtype == np.dtype('>f4')
+    assert np.shares_memory(hdul['PRIMARY'].data, hdul.fits['PRIMARY'].data)
+    assert isinstance(hdul['SCALED'].data, idi.IdiLazyArray)
+    assert hdul['SCALED'].data.dtype == np.uint16
+
+    export_hdf(hdul, hdf_file)
+    hdul.close()
+    a = read_hdf(hdf_file, mode='r')
+    assert np.all(a['PRIMARY'].data == img)
+    assert np.all(a['SCALED'].data == scaled)
+
+    def is_mapped(data):
+        while data is not None:
+            if isinstance(data, (np.memmap, mmap.mmap)):
+                return True
+            data = getattr(data, 'base', None)
+        return False
+
+    # memmap is passed to astropy: None maps by default, False reads into memory
+    for memmap in (None, False):
+        hdul = read_fits(fits_file, memmap=memmap)
+        assert is_mapped(hdul['PRIMARY'].data) == (memmap is None)
+        assert np.all(hdul['SCALED'].data == scaled)
+        hdul.close()
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,71 @@
+
+import h5py
+import numpy as np
+import pytest
+
+from fits2hdf import idi
+from fits2hdf.io import hdfcompress as bs
+
+
+def test_write_parallel(tmp_path):
+    """ Parallel direct chunk writes must match the HDF5 filter pipeline exactly """
+    hdf_file = str(tmp_path / 'test.h5')
+    data = (np.random.random((1000, 777)) * 100).astype('>i4')
+
+    with h5py.File(hdf_file, 'w') as h:
+        for shuffle in (False, True):
+            kwargs = dict(compression='gzip', shuffle=shuffle, chunks=(64, 100), max_memory=100000)
+            a = bs.create_dataset(h, 'serial_%s' % shuffle, data, **kwargs)
+            b = bs.create_dataset(h, 'parallel_%s' % shuffle, data, workers=4, **kwargs)
+
+            assert np.all(b[:] == data)
+            assert a.id.get_num_chunks() == b.id.get_num_chunks()
+            for ii in range(a.id.get_num_chunks()):
+                offset = a.id.get_chunk_info(ii).chunk_offset
+                assert a.id.read_direct_chunk(offset) == b.id.read_direct_chunk(offset)
+
+        # Lazy input is read block by block
+        c = bs.create_dataset(h, 'lazy', idi.IdiLazyArray(h['serial_True']), workers=3,
+                              compression='gzip', max_memory=100000)
+        assert np.all(c[:] == data)
+
+        # Filters that can't be reproduced fall back to the filter pipeline
+        d = bs.create_dataset(h, 'lzf', data, workers=4, compression='lzf')
+        assert not bs.write_parallel(d, data, 4)
+        assert np.all(d[:] == data)
+
+
+def test_read_parallel(tmp_path):
+    hdf_file = str(tmp_path / 'test.h5')
+    data = (np.random.random((1000, 777)) * 100).astype('<f8')
+
+    with h5py.File(hdf_file, 'w') as h:
+        for shuffle in (False, True):
+            dset = h.create_dataset('d_%s' % shuffle, data=data, compression='gzip',
+                                    shuffle=shuffle, chunks=(64, 100))
+            assert np.all(bs.read_parallel(dset, 4) == data)
+
+        # Partially written datasets read unwritten chunks as the fill value
+        dset = h.create_dataset('sparse', shape=(300, 300), dtype='i2', compression='gzip',
+                                chunks=(100, 100), fillvalue=-1)
+        dset[150:160, 20:30] = 7
+        assert np.all(bs.read_parallel(dset, 2) == dset[:])
+
+        dset = h.create_dataset('lzf', data=data, compression='lzf')
+        assert bs.read_parallel(dset, 4) is None
+        assert np.all(bs.read_dataset(dset, 4) == data)
+
+
+def test_read_parallel_many_chunks(tmp_path):
+    """ Datasets with thousands of chunks read correctly (see bench_read.py -k chunks for timings) """
+    hdf_file = str(tmp_path / 'test.h5')
+    data = np.arange(400000, dtype='i4')
+
+    with h5py.File(hdf_file, 'w') as h:
+        dset = h.create_dataset('d', data=data, compression='gzip', shuffle=True, chunks=(40, ))
+        assert dset.id.get_num_chunks() == 10000
+        assert np.all(bs.read_parallel(dset, 4) == data)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,381 @@
+import os
+import itertools
+
+import h5py
+import numpy as np
+import pytest
+from astropy.io import fits as pf
+
+from fits2hdf.io.fitsio import read_fits, iter_fits, create_fits
+from fits2hdf.io.hdfio import read_hdf, export_hdf, export_hdf_stream, read_hdu_index
+from fits2hdf.io import hdfcompress as bs
+from fits2hdf import idi
+from fits2hdf import pyhdfits
+
+
+@pytest.fixture
+def make_hdf(tmp_path, make_fits):
+    """ Return a function that converts a test FITS file to HDFITS in tmp_path
+
+    The function is called as make_hdf(table_type='DATA_GROUP', **kwargs), with
+    kwargs passed to export_hdf, and returns the HDF5 filename.
+    """
+    counter = itertools.count()
+
+    def make(table_type='DATA_GROUP', **kwargs):
+        hdf_file = str(tmp_path / ('test%i.h5' % next(counter)))
+        export_hdf(read_fits(make_fits()), hdf_file, table_type=table_type, **kwargs)
+        return hdf_file
+    return make
+
+
+def test_read_hdf_lazy(make_hdf):
+    for table_type in ('DATA_GROUP', 'TABLE'):
+        hdf_file = make_hdf(table_type, compression='gzip')
+        a = read_hdf(hdf_file, mode='r')
+        b = read_hdf(hdf_file, mode='r', lazy=True)
+        c = read_hdf(hdf_file, mode='r', workers=3)
+        assert np.all(c['SCI'].data == a['SCI'].data)
+        for col_name in a['CAT'].colnames:
+            assert np.all(c['CAT'][col_name] == a['CAT'][col_name])
+
+        assert isinstance(b['SCI'].data, idi.IdiLazyArray)
+        assert b['SCI'].data.shape == a['SCI'].data.shape
+        assert np.all(b['SCI'].data[10:20, 5:8] == a['SCI'].data[10:20, 5:8])
+        assert np.all(np.asarray(b['SCI'].data) == a['SCI'].data)
+
+        mask = np.arange(1000) % 3 == 0
+        for col_name in a['CAT'].colnames:
+            col_a, col_b = a['CAT'][col_name], b['CAT'][col_name]
+            assert isinstance(col_b, idi.IdiLazyColumn)
+            assert col_b.unit == col_a.unit
+            assert col_b.shape == col_a.shape
+            assert np.all(col_b.data == col_a.data)
+            assert np.all(col_b[[5, 2, 2]] == col_a[[5, 2, 2]])
+            assert np.all(col_b[mask] == col_a[mask])
+            assert np.all(col_b[10:20] == col_a[10:20])
+        assert np.all(b['CAT']['b'][2:4, 1:] == a['CAT']['b'][2:4, 1:])
+        b.close()
+
+        # Files passed in already open are left open
+        with h5py.File(hdf_file, 'r') as h:
+            for infile in (h, h['/']):
+                c = read_hdf(infile, lazy=True)
+                c.close()
+                assert np.all(c['SCI'].data[10:20] == a['SCI'].data[10:20])
+
+        if table_type == 'TABLE':
+            # Columns should be views of a single compound array read
+            base = a['CAT']['a']
+            while base.base is not None:
+                base = base.base
+            assert base.dtype.names == tuple(a['CAT'].colnames)
+
+
+def test_read_hdf_selection(make_hdf):
+    for table_type in ('DATA_GROUP', 'TABLE'):
+        hdf_file = make_hdf(table_type)
+        a = read_hdf(hdf_file, mode='r')
+
+        b = read_hdf(hdf_file, mode='r', hdus=['cat'], columns=['name', 'a'])
+        assert b.keys() == ['CAT']
+        assert b['CAT'].colnames == ['a', 'name']
+        assert np.all(b['CAT']['name'] == a['CAT']['name'])
+
+        b = read_hdf(hdf_file, mode='r', columns={'CAT': ['b']})
+        assert b.keys() == a.keys()
+        assert b['CAT'].colnames == ['b']
+
+        c = pyhdfits.open(hdf_file, hdus=['PRIMARY', 'CAT'], columns=['flag'])
+        assert [hdu.name for hdu in c] == ['PRIMARY', 'CAT']
+        assert c['CAT'].columns.names == ['flag']
+        assert np.all(c['CAT'].data['flag'] == a['CAT']['flag'])
+
+        try:
+            read_hdf(hdf_file, mode='r', hdus=['NOTHERE'])
+            assert False
+        except KeyError:
+            pass
+
+        try:
+            read_hdf(hdf_file, mode='r', hdus=['CAT'], columns=['a', 'nope'])
+            assert False
+        except KeyError as e:
+            assert 'nope' in str(e) and 'CAT' in str(e)
+
+
+def test_read_hdf_rows_and_section(make_hdf):
+    for table_type in ('DATA_GROUP', 'TABLE'):
+        hdf_file = make_hdf(table_type, compression='gzip')
+        a = read_hdf(hdf_file, mode='r')
+
+        mask = np.arange(1000) % 7 == 0
+        index = np.array([900, 3, 3, 17, -1])
+        for rows in (slice(100, 250), mask, index):
+            b = read_hdf(hdf_file, mode='r', rows=rows, section=(slice(50, 80), slice(None, None, 3)))
+            for col_name in a['CAT'].colnames:
+                assert np.all(b['CAT'][col_name] == a['CAT'][col_name][rows])
+                assert b['CAT'][col_name].unit == a['CAT'][col_name].unit
+            assert np.all(b['SCI'].data == a['SCI'].data[50:80, ::3])
+
+        b = read_hdf(hdf_file, mode='r', rows={'CAT': slice(0, 10)}, lazy=True)
+        assert len(b['CAT']) == 10
+        assert isinstance(b['SCI'].data, idi.IdiLazyArray)
+        b.close()
+
+
+def test_hdu_index(make_hdf):
+    for table_type in ('DATA_GROUP', 'TABLE'):
+        hdf_file = make_hdf(table_type)
+        with h5py.File(hdf_file, 'r') as h:
+            hdu_index = read_hdu_index(h)
+        assert [entry['name'] for entry in hdu_index] == ['PRIMARY', 'SCI', 'CAT']
+        assert [entry['class'] for entry in hdu_index] == ['PRIMARY', 'IMAGE', table_type]
+        assert [col['name'] for col in hdu_index[2]['columns']] == ['a', 'b', 'name', 'flag']
+        assert hdu_index[1]['shape'] == [200, 300]
+
+        a = read_hdf(hdf_file, mode='r')
+
+        # Older files without an index are read by scanning the groups
+        with h5py.File(hdf_file, 'r+') as h:
+            del h.attrs['HDU_INDEX']
+            assert read_hdu_index(h) is None
+        b = read_hdf(hdf_file, mode='r')
+
+        assert a.keys() == b.keys()
+        for name in a.keys():
+            assert type(a[name]) is type(b[name])
+        assert a['CAT'].colnames == b['CAT'].colnames
+        for col_name in a['CAT'].colnames:
+            assert a['CAT'][col_name].unit == b['CAT'][col_name].unit
+            assert np.all(a['CAT'][col_name] == b['CAT'][col_name])
+
+    # Columns deleted or added after the index was written are found by scanning
+    hdf_file = make_hdf()
+    with h5py.File(hdf_file, 'r+') as h:
+        del h['CAT/DATA/a']
+        h['CAT/DATA/c'] = np.arange(1000)
+        h['CAT/DATA/c'].attrs['CLASS'] = np.string_(['COLUMN'])
+        h['CAT/DATA/c'].attrs['COLUMN_ID'] = np.array([4])
+        assert read_hdu_index(h) is not None
+    a = read_hdf(hdf_file, mode='r')
+    assert a['CAT'].colnames == ['b', 'name', 'flag', 'c']
+    assert np.all(a['CAT']['c'] == np.arange(1000))
+
+
+def test_export_hdf_stream(tmp_path, make_fits):
+    tmpdir = str(tmp_path)
+    fits_file = make_fits()
+
+    export_hdf(read_fits(fits_file), os.path.join(tmpdir, 'a.h5'), compression='gzip')
+    export_hdf_stream(iter_fits(fits_file), os.path.join(tmpdir, 'b.h5'), compression='gzip')
+    a = read_hdf(os.path.join(tmpdir, 'a.h5'), mode='r')
+    b = read_hdf(os.path.join(tmpdir, 'b.h5'), mode='r')
+
+    assert a.keys() == b.keys()
+    for name in a.keys():
+        assert type(a[name]) is type(b[name])
+        assert sorted(a[name].header.keys()) == sorted(b[name].header.keys())
+    assert np.all(a['SCI'].data == b['SCI'].data)
+    for col_name in a['CAT'].colnames:
+        assert np.all(a['CAT'][col_name] == b['CAT'][col_name])
+
+
+def test_export_hdf_blocked(tmp_path):
+    tmpdir = str(tmp_path)
+    fits_file = os.path.join(tmpdir, 'big.fits')
+    img = np.random.randint(0, 1000, size=(5, 301, 203)).astype('>i2')
+    hdu = pf.ImageHDU(img, name='SCI')
+    hdu.scale('int16', bscale=0.5, bzero=10)
+    pf.HDUList([pf.PrimaryHDU(), hdu]).writeto(fits_file, overwrite=True)
+    with pf.open(fits_file) as ff:
+        img = ff['SCI'].data[:]
+
+    for block in (bs.guess_block((5, 301, 203), 4, (2, 64, 64), 1e4),
+                  bs.guess_block((5, 301, 203), 4, (2, 64, 64), 1e6)):
+        assert all(b % c == 0 or b == n for b, c, n in zip(block, (2, 64, 64), (5, 301, 203)))
+    assert bs.guess_block((5, 301, 203), 4, (2, 64, 64), 1e9) == (5, 301, 203)
+
+    hdus = iter_fits(fits_file, max_memory=100000)
+    export_hdf_stream(hdus, os.path.join(tmpdir, 'a.h5'), compression='gzip', max_memory=100000)
+    hdus = iter_fits(fits_file, max_memory=10000)
+    name, hdu = next(hdus)
+    name, hdu = next(hdus)
+    assert isinstance(hdu.data, idi.IdiLazyArray)
+    assert np.all(hdu.data[2, 100:110, ::7] == img[2, 100:110, ::7])
+    hdus.close()
+
+    a = read_hdf(os.path.join(tmpdir, 'a.h5'), mode='r')
+    assert a['SCI'].data.dtype == img.dtype
+    assert np.all(a['SCI'].data == img)
+
+    # 2-D images not in memory are read once, with IMAGE_MINMAXRANGE found as they are written
+    class CountingSource(object):
+        shape, dtype, n_read = img[2].shape, img.dtype, 0
+
+        def __getitem__(self, sel):
+            self.n_read += img[2][sel].size
+            return img[2][sel]
+
+    source = CountingSource()
+    hdul = idi.IdiHdulist()
+    hdul.add_image_hdu('SCI', data=idi.IdiLazyArray(source))
+    for workers in (1, 2):
+        source.n_read = 0
+        hdf_file = os.path.join(tmpdir, 'b_%i.h5' % workers)
+        export_hdf(hdul, hdf_file, compression='gzip', max_memory=10000, workers=workers)
+        assert source.n_read == img[2].size
+        with h5py.File(hdf_file, 'r') as h:
+            assert np.all(h['SCI/DATA'][:] == img[2])
+            assert np.all(h['SCI/DATA'].attrs['IMAGE_MINMAXRANGE'] == [img[2].min(), img[2].max()])
+
+
+def test_export_hdf_byteorder(tmp_path, make_fits):
+    """ FITS data are stored big-endian by default, or in the byte order requested """
+    tmpdir = str(tmp_path)
+    fits_file = make_fits()
+    hdul = read_fits(fits_file)
+
+    for table_type in ('DATA_GROUP', 'TABLE'):
+        for byteorder, expected in ((None, '>'), ('<', '<')):
+            hdf_file = os.path.join(tmpdir, 'test_%s_%s.h5' % (table_type, expected))
+            opts = {} if byteorder is None else {'byteorder': byteorder}
+            export_hdf(hdul, hdf_file, table_type=table_type, **opts)
+            with h5py.File(hdf_file, 'r') as h:
+                assert h['SCI/DATA'].dtype == np.dtype(expected + 'i2')
+                if table_type == 'TABLE':
+                    # Applied to each field of the compound dataset
+                    assert h['CAT/DATA'].dtype['a'] == np.dtype(expected + 'f4')
+                    assert h['CAT/DATA'].dtype['b'].base == np.dtype(expected + 'i4')
+                else:
+                    assert h['CAT/DATA/a'].dtype == np.dtype(expected + 'f4')
+                assert read_hdu_index(h)[2]['columns'][0]['dtype'] == expected + 'f4'
+
+            a = read_hdf(hdf_file, mode='r')
+            assert np.all(a['SCI'].data == hdul['SCI'].data)
+            assert np.all(a['CAT']['a'] == hdul['CAT']['a'])
+            fits_a = create_fits(a)
+            assert np.all(fits_a['CAT'].data['a'] == hdul['CAT']['a'])
+            assert np.all(fits_a['CAT'].data['b'] == hdul['CAT']['b'])
+
+
+def test_var_columns(tmp_path):
+    """ P / Q columns are stored as VALUES + OFFSETS and round-trip to FITS """
+    tmpdir = str(tmp_path)
+    fits_file = os.path.join(tmpdir, 'vla.fits')
+    n_rows = 100
+    spec = [np.arange(ii % 7, dtype='f4') * ii for ii in range(n_rows)]
+    flags = [np.arange(ii % 3) % 2 == 0 for ii in range(n_rows)]
+    cols = [pf.Column(name='spec', format='PE()', array=np.array(spec, dtype=object)),
+            pf.Column(name='events', format='QJ()',
+                      array=np.array([np.arange(ii % 4, dtype='i4') for ii in range(n_rows)], dtype=object)),
+            pf.Column(name='flags', format='PL()', array=np.array(flags, dtype=object)),
+            pf.Column(name='x', format='J', array=np.arange(n_rows))]
+    pf.HDUList([pf.PrimaryHDU(), pf.BinTableHDU.from_columns(cols, name='VLA')]).writeto(fits_file)
+
+    hdul = read_fits(fits_file)
+    col = hdul['VLA']['spec']
+    assert isinstance(col, idi.IdiVarColumn)
+    assert np.all(col.lengths == [ii % 7 for ii in range(n_rows)])
+    assert np.all(col[10] == spec[10])
+    assert np.all(col[5:8][1] == spec[6])
+    assert np.all(col[[9, 2, 9]][1] == spec[2])
+    assert np.all(hdul['VLA']['flags'][2] == flags[2])
+
+    hdf_file = os.path.join(tmpdir, 'vla.h5')
+    export_hdf(hdul, hdf_file, compression='gzip', shuffle=True)
+    with h5py.File(hdf_file, 'r') as h:
+        assert h['VLA/DATA/spec/VALUES'].compression == 'gzip'
+        assert h['VLA/DATA/spec/OFFSETS'].shape == (n_rows + 1, )
+
+    for kwargs in ({}, {'lazy': True}, {'rows': slice(10, 20)}):
+        a = read_hdf(hdf_file, mode='r', **kwargs)
+        start = 10 if 'rows' in kwargs else 0
+        assert np.all(a['VLA']['spec'][3] == spec[start + 3])
+        assert np.all(a['VLA']['flags'][3] == flags[start + 3])
+
+        fits_a = create_fits(a)
+        assert fits_a['VLA'].columns['spec'].format == 'PE(6)'
+        data = fits_a['VLA'].data
+        assert np.all(data['spec'][3] == spec[start + 3])
+        assert np.all(data['x'] == np.arange(start, start + len(data)))
+        back_file = os.path.join(tmpdir, 'back_%s.fits' % '_'.join(kwargs))
+        fits_a.writeto(back_file)
+        b = read_fits(back_file)
+        assert np.all(b['VLA']['flags'].values == a['VLA']['flags'].values)
+        a.close()
+
+    try:
+        export_hdf(hdul, os.path.join(tmpdir, 'vla_table.h5'), table_type='TABLE')
+        assert False
+    except RuntimeError:
+        pass
+
+
+def test_export_hdf_table_compressed(tmp_path, make_fits):
+    """ TABLE output is chunked by rows and compressed """
+    tmpdir = str(tmp_path)
+    fits_file = make_fits(n_rows=50000)
+    hdul = read_fits(fits_file)
+
+    for workers in (1, 2):
+        hdf_file = os.path.join(tmpdir, 'table_%i.h5' % workers)
+        export_hdf(hdul, hdf_file, table_type='TABLE', compression='gzip', shuffle=True,
+                   fletcher32=(workers == 1), workers=workers)
+        with h5py.File(hdf_file, 'r') as h:
+            dset = h['CAT/DATA']
+            assert dset.compression == 'gzip' and dset.shuffle
+            assert dset.fletcher32 == (workers == 1)
+            assert dset.chunks[0] * dset.dtype.itemsize <= bs.DEFAULT_ROW_CHUNK_BYTES
+            assert dset.id.get_storage_size() < dset.size * dset.dtype.itemsize
+
+        for read_workers in (1, 2):
+            a = read_hdf(hdf_file, mode='r', workers=read_workers)
+            for col_name in hdul['CAT'].colnames:
+                assert np.all(a['CAT'][col_name] == hdul['CAT'][col_name])
+        b = read_hdf(hdf_file, mode='r', rows=slice(100, 200))
+        assert np.all(b['CAT']['b'] == hdul['CAT']['b'][100:200])
+
+    if bs.USE_BITSHUFFLE:
+        hdf_file = os.path.join(tmpdir, 'table_bitshuffle.h5')
+        export_hdf(hdul, hdf_file, table_type='TABLE', compression='bitshuffle')
+        a = read_hdf(hdf_file, mode='r')
+        assert np.all(a['CAT']['b'] == hdul['CAT']['b'])
+
+
+def test_string_columns(tmp_path):
+    """ Unicode columns are stored as fixed-width UTF-8; string and bool columns are compressed """
+    tmpdir = str(tmp_path)
+    n_rows = 5000
+    names = np.array(['star_%i' % ii for ii in range(n_rows)])
+    names[3] = u'étoile ★'
+    hdul = idi.IdiHdulist()
+    hdul.add_table_hdu('CAT')
+    hdul['CAT'].add_column(idi.IdiColumn('name', names))
+    hdul['CAT'].add_column(idi.IdiColumn('code', np.char.encode(names[::-1], 'utf-8')))
+    hdul['CAT'].add_column(idi.IdiColumn('flag', np.arange(n_rows) % 3 == 0))
+
+    for table_type in ('DATA_GROUP', 'TABLE'):
+        hdf_file = os.path.join(tmpdir, '%s.h5' % table_type)
+        export_hdf(hdul, hdf_file, table_type=table_type, compression='gzip', shuffle=True)
+        with h5py.File(hdf_file, 'r') as h:
+            if table_type == 'DATA_GROUP':
+                for col_name in ('name', 'code', 'flag'):
+                    assert h['CAT/DATA'][col_name].compression == 'gzip'
+                dtype = h['CAT/DATA/name'].dtype
+            else:
+                assert h['CAT/DATA'].compression == 'gzip'
+                dtype = h['CAT/DATA'].dtype['name']
+            assert h5py.check_string_dtype(dtype).encoding == 'utf-8'
+
+        for kwargs in ({}, {'lazy': True}, {'workers': 2}, {'rows': slice(2, 10)}):
+            a = read_hdf(hdf_file, mode='r', **kwargs)
+            rows = kwargs.get('rows', slice(None))
+            assert a['CAT']['name'].dtype.kind == 'U'
+            assert np.all(a['CAT']['name'][:] == names[rows])
+            assert np.all(a['CAT']['code'][:] == np.char.encode(names[::-1], 'utf-8')[rows])
+            assert np.all(a['CAT']['flag'][:] == (np.arange(n_rows) % 3 == 0)[rows])
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
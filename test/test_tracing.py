@@ -0,0 +1,59 @@
+import os
+import json
+import pstats
+
+import pytest
+
+from fits2hdf import tracing, batch
+from fits2hdf.file_conversion import fits_to_hdf
+from fits2hdf.io.fitsio import read_fits, create_fits
+from fits2hdf.io.hdfio import export_hdf
+
+
+def test_tracing(tmp_path, make_fits):
+    tmpdir = str(tmp_path)
+    fits_file = make_fits()
+
+    # Disabled: nothing is recorded
+    assert not tracing.is_enabled()
+    assert tracing.span('nothing') is tracing.span('else')
+    read_fits(fits_file)
+
+    tracing.enable()
+    with tracing.span('test', step=1):
+        hdul = read_fits(fits_file)
+        export_hdf(hdul, os.path.join(tmpdir, 'test.h5'))
+        create_fits(hdul)
+    events = tracing.disable()
+    assert not tracing.is_enabled()
+
+    names = [event['name'] for event in events]
+    for name in ('read_fits', 'read_fits_hdu', 'parse_fits_header', 'export_hdf_stream',
+                 'export_hdu', 'create_dataset', 'create_fits', 'create_column', 'test'):
+        assert name in names
+    assert [e['args']['hdu'] for e in events if e['name'] == 'export_hdu'] == ['PRIMARY', 'SCI', 'CAT']
+
+    # Spans are nested within their parents
+    outer = events[-1]
+    assert outer['name'] == 'test' and outer['args'] == {'step': '1'}
+    for event in events:
+        assert outer['ts'] <= event['ts'] and event['ts'] + event['dur'] <= outer['ts'] + outer['dur'] + 1
+
+    trace_file = os.path.join(tmpdir, 'trace.json')
+    tracing.write_chrome_trace(events, trace_file)
+    assert json.load(open(trace_file)) == json.loads(json.dumps(events))
+
+
+def test_batch_trace_and_profile(tmp_path, make_fits):
+    fits_file = make_fits()
+    file_out = str(tmp_path / 'test.h5')
+
+    result, = batch.run_batch(fits_to_hdf, [(fits_file, file_out)], trace=True, profile=True)
+    assert result['error'] is None
+    assert result['trace'][-1]['name'] == 'convert_file'
+    stats = pstats.Stats(file_out + batch.PSTATS_SUFFIX)
+    assert any(func[2] == 'fits_to_hdf' for func in stats.stats)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])